@@ -0,0 +1,383 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Benchmarks for the preprocessing and training pipeline on synthetic data.
+#
+# Each case writes a synthetic HDF5 file in the usual layout (senders,
+# receivers, node_coords, edge/node/glbl_features over 7 days of ntg
+# timegroups) and times every stage on it, recording tracemalloc peak
+# memory, RSS growth and bytes read/written. Results are JSON so runs on
+# two commits can be compared:
+#
+#   python bench_pipeline.py run --nodes 100 1000 10000 --ntg 24 -o new.json
+#   python bench_pipeline.py compare base.json new.json
+#
+# ntg sets mgt.NTG for the run, so the week is 7*ntg snapshots. --dtype
+# sets mgt.FLOAT_DTYPE, and `accuracy` reports how far the float32
+# preprocessing outputs are from float64 ones on the same data.
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import h5py
+import numpy as np
+
+import my_graph_tools as mgt
+
+STAGES = ("EdgeNodeCovariance", "CalcMFactor", "get_norm_stats",
+          "create_nn_inputset", "snap2graph", "snaps2graph", "epd_step")
+# Stages that skip their stats pass when an earlier run stored the moments
+MOMENT_STAGES = ("get_norm_stats", "create_nn_inputset")
+
+
+def make_synthetic_h5(path, n_node, degree=3, ntg=24, layout="timemajor",
+                      codec="gzip", seed=0, car_frac=0.3):
+    """Random graph with degree out-edges per node and 7*ntg snapshots of
+    raw features with roughly car_frac of the edges carrying cars."""
+    rng = np.random.default_rng(seed)
+    senders = np.repeat(np.arange(n_node), degree)
+    receivers = (senders + rng.integers(1, max(n_node, 2), size=senders.size)) % n_node
+    n_edge = senders.size
+    lengths = 1 + rng.random(n_edge)
+    T = 7*ntg
+    with h5py.File(path, 'w') as h5f:
+        h5f.create_dataset("senders", data=senders)
+        h5f.create_dataset("receivers", data=receivers)
+        h5f.create_dataset("node_coords", data=rng.uniform(size=(n_node, 2)))
+        h5f.attrs['n_nodes'] = n_node
+        h5f.attrs['n_edges'] = n_edge
+        h5f.attrs['ntg'] = ntg
+        # Sparse groups' base rows: no cars, the edge lengths
+        edge_base = np.zeros((n_edge, 4))
+        edge_base[:, 3] = lengths
+        for name, n_ent, n_ft, base in (("edge_features", n_edge, 4, edge_base),
+                                        ("node_features", n_node, 3, None),
+                                        ("glbl_features", 1, 2, None)):
+            grp_layout = layout
+            if layout == "sparse" and name not in mgt.SPARSE_GROUPS:
+                grp_layout = "timemajor"
+            mgt.create_snapset(h5f, name, T, n_ent, n_ft, layout=grp_layout,
+                               codec=codec, base=base)
+        for t0 in range(0, T, mgt.BLOCK_T):
+            t1 = min(t0 + mgt.BLOCK_T, T)
+            B = t1 - t0
+            edges = np.zeros((B, n_edge, 4), dtype=mgt.FLOAT_DTYPE)
+            act = rng.random((B, n_edge)) < car_frac
+            nact = act.sum()
+            edges[act, 0] = rng.integers(1, 5, size=nact)
+            edges[act, 1] = 3*rng.random(nact)
+            edges[act, 2] = rng.random(nact)
+            edges[..., 3] = lengths
+            nodes = rng.integers(0, 4, size=(B, n_node, 3)).astype(mgt.FLOAT_DTYPE)
+            t = np.arange(t0, t1)
+            glbls = np.stack([t//ntg, t % ntg], axis=1)[:, None, :].astype(mgt.FLOAT_DTYPE)
+            mgt.write_snaps(h5f, "edge_features", t0, edges)
+            mgt.write_snaps(h5f, "node_features", t0, nodes)
+            mgt.write_snaps(h5f, "glbl_features", t0, glbls)
+
+
+def _io_counters():
+    # Bytes through read()/write() syscalls for this process (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (IOError, OSError, KeyError):
+        return None, None
+
+
+def _maxrss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if platform.system() == "Darwin" else rss*1024
+
+
+def measure(fn, trace_memory=True):
+    """Run fn() once; returns wall time, tracemalloc peak, max-RSS growth
+    and bytes read/written."""
+    r0, w0 = _io_counters()
+    rss0 = _maxrss_bytes()
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time.time()
+    try:
+        fn()
+        wall = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    r1, w1 = _io_counters()
+    return {"seconds": wall,
+            "peak_bytes": peak,
+            "maxrss_growth_bytes": _maxrss_bytes() - rss0,
+            "read_bytes": None if r0 is None else r1 - r0,
+            "write_bytes": None if w0 is None else w1 - w0}
+
+
+def _epd_step(h5_name, batch_size, nsteps):
+    import tensorflow as tf
+    import train
+    tf.reset_default_graph()
+    trainer = train.StaticBatchTrainer(h5_name, batch_size=batch_size, num_workers=1)
+    with h5py.File(h5_name, 'r') as h5f:
+        T = mgt.n_snaps(h5f, 'nn_edge_features')
+        inp = mgt.snaps2graph(h5f, np.arange(batch_size) % T)
+        tgt = mgt.snaps2graph(h5f, np.arange(1, batch_size+1) % T)
+    feed = train.feed_features(trainer.input_ph, inp)
+    feed.update(train.feed_features(trainer.target_ph, tgt))
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(trainer.step_op, feed_dict=feed)  # warm up
+        def steps():
+            for _ in range(nsteps):
+                sess.run(trainer.step_op, feed_dict=feed)
+        return measure(steps, trace_memory=False)
+
+
+def _drop_moments(h5_name):
+    # So a stage is timed as a standalone run, stats pass included
+    with h5py.File(h5_name, 'a') as h5f:
+        for name in ("edge_moments", "node_moments", "moments_digests"):
+            if name in h5f:
+                del h5f[name]
+
+
+def _stage_fns(h5_name, nsample, batch_size):
+    def snap2graph_loop():
+        with h5py.File(h5_name, 'r') as h5f:
+            T = mgt.n_snaps(h5f, 'nn_edge_features')
+            for t in np.linspace(0, T-1, nsample).astype(int):
+                mgt.snap2graph(h5f, *mgt.snap_daytg(t))
+
+    def snaps2graph_batch():
+        with h5py.File(h5_name, 'r') as h5f:
+            T = mgt.n_snaps(h5f, 'nn_edge_features')
+            mgt.snaps2graph(h5f, np.arange(batch_size) % T)
+
+    return {"EdgeNodeCovariance": lambda: mgt.EdgeNodeCovariance(h5_name),
+            "CalcMFactor": lambda: mgt.CalcMFactor(h5_name),
+            "get_norm_stats": lambda: mgt.get_norm_stats(h5_name),
+            "create_nn_inputset": lambda: mgt.create_nn_inputset(h5_name),
+            "snap2graph": snap2graph_loop,
+            "snaps2graph": snaps2graph_batch}
+
+
+def run_case(n_node, degree=3, ntg=24, layout="timemajor", stages=STAGES,
+             workdir=None, repeat=1, nsample=32, batch_size=16, nsteps=5,
+             seed=0, keep=False, dtype=None):
+    """Benchmark every stage on one synthetic file. Stages run in pipeline
+    order since each needs the outputs of the ones before it; with
+    repeat > 1 the fastest run is kept. Moments stored by get_norm_stats or
+    an earlier run are dropped before every run of MOMENT_STAGES, so each
+    includes its stats pass. dtype sets mgt.FLOAT_DTYPE for the case."""
+    ntg_saved = mgt.NTG
+    dtype_saved = mgt.FLOAT_DTYPE
+    mgt.NTG = ntg
+    if dtype is not None:
+        mgt.set_float_dtype(dtype)
+    mgt.clear_topology_cache()
+    tmpdir = workdir is None
+    workdir = tempfile.mkdtemp(prefix="bench_") if tmpdir else workdir
+    h5_name = os.path.join(workdir, "synth_n%d_d%d_tg%d.hdf5" % (n_node, degree, ntg))
+    case = {"n_node": n_node, "degree": degree, "ntg": ntg, "layout": layout,
+            "dtype": np.dtype(mgt.FLOAT_DTYPE).name}
+    results = []
+    try:
+        gen = measure(lambda: make_synthetic_h5(h5_name, n_node, degree, ntg,
+                                                layout=layout, seed=seed))
+        gen.update(case, stage="generate", file_bytes=os.path.getsize(h5_name))
+        results.append(gen)
+        fns = _stage_fns(h5_name, nsample, batch_size)
+        for stage in stages:
+            runs = []
+            for _ in range(repeat):
+                if stage == "epd_step":
+                    res = _epd_step(h5_name, batch_size, nsteps)
+                    res["seconds"] /= nsteps
+                else:
+                    if stage in MOMENT_STAGES:
+                        _drop_moments(h5_name)
+                    res = measure(fns[stage])
+                runs.append(res)
+            res = min(runs, key=lambda r: r["seconds"])
+            res.update(case, stage=stage, file_bytes=os.path.getsize(h5_name))
+            results.append(res)
+            print("%-20s n_node=%-7d %9.3fs" % (stage, n_node, res["seconds"]))
+    finally:
+        mgt.NTG = ntg_saved
+        mgt.set_float_dtype(dtype_saved)
+        mgt.clear_topology_cache()
+        if not keep:
+            if os.path.exists(h5_name):
+                os.remove(h5_name)
+            if tmpdir:
+                shutil.rmtree(workdir)
+    return results
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(nodes=(100, 1000, 10000), degrees=(3,), ntgs=(24,), out=None, **kw):
+    """run_case over the grid of sizes; returns (and optionally writes) the
+    results document."""
+    doc = {"meta": {"git_rev": _git_rev(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "h5py": h5py.__version__,
+                    "machine": platform.machine(),
+                    "cpus": os.cpu_count()},
+           "results": []}
+    for n_node in nodes:
+        for degree in degrees:
+            for ntg in ntgs:
+                doc["results"] += run_case(n_node, degree, ntg, **kw)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(doc, f, indent=1)
+    return doc
+
+
+def dtype_accuracy(n_node, degree=3, ntg=24, dtype="float32", seed=0, workdir=None):
+    """Preprocess the same synthetic data with FLOAT_DTYPE float64 and
+    dtype; per output, the largest absolute difference and that relative
+    to the float64 values' largest magnitude."""
+    ntg_saved, dtype_saved = mgt.NTG, mgt.FLOAT_DTYPE
+    mgt.NTG = ntg
+    tmpdir = workdir is None
+    workdir = tempfile.mkdtemp(prefix="bench_") if tmpdir else workdir
+    outs = {}
+    try:
+        for dt in ("float64", dtype):
+            mgt.set_float_dtype(dt)
+            mgt.clear_topology_cache()
+            h5_name = os.path.join(workdir, "acc_%s.hdf5" % dt)
+            make_synthetic_h5(h5_name, n_node, degree, ntg, seed=seed)
+            mgt.EdgeNodeCovariance(h5_name)
+            mgt.CalcMFactor(h5_name)
+            mgt.create_nn_inputset(h5_name)
+            with h5py.File(h5_name, 'r') as h5f:
+                outs[dt] = dict((k, h5f[k][:]) for k in
+                                ("edge_node_covs", "M", "edge_stats", "node_stats",
+                                 "nn_edge_features", "nn_node_features"))
+                outs[dt]["bytes"] = os.path.getsize(h5_name)
+    finally:
+        mgt.NTG = ntg_saved
+        mgt.set_float_dtype(dtype_saved)
+        mgt.clear_topology_cache()
+        if tmpdir:
+            shutil.rmtree(workdir)
+    ref, new = outs["float64"], outs[dtype]
+    res = {"n_node": n_node, "dtype": dtype,
+           "file_bytes_float64": ref.pop("bytes"), "file_bytes": new.pop("bytes")}
+    for key in ref:
+        a, b = ref[key].astype(np.float64), new[key].astype(np.float64)
+        err = np.abs(a - b).max()
+        res[key] = {"max_abs_err": float(err),
+                    "max_rel_err": float(err/max(np.abs(a).max(), 1e-30))}
+    return res
+
+
+def _case_key(res):
+    # Results from before the dtype option were all float64
+    return (res["stage"], res["n_node"], res["degree"], res["ntg"], res["layout"],
+            res.get("dtype", "float64"))
+
+
+def compare(base, new, threshold=0.10, metrics=("seconds", "peak_bytes")):
+    """Relative change of each metric for the cases in both documents
+    (dicts or JSON file names). Returns the rows that got worse by more
+    than threshold."""
+    if not isinstance(base, dict):
+        with open(base) as f:
+            base = json.load(f)
+    if not isinstance(new, dict):
+        with open(new) as f:
+            new = json.load(f)
+    old = dict((_case_key(r), r) for r in base["results"])
+    regressions = []
+    print("%-20s %8s %4s %4s %12s %10s %10s %8s" % ("stage", "n_node", "deg", "ntg",
+                                                    "metric", "base", "new", "change"))
+    for res in new["results"]:
+        key = _case_key(res)
+        if key not in old:
+            continue
+        for metric in metrics:
+            a, b = old[key].get(metric), res.get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a)/a
+            flag = " <--" if change > threshold else ""
+            print("%-20s %8d %4d %4d %12s %10.4g %10.4g %+7.1f%%%s"
+                  % (key[0], key[1], key[2], key[3], metric, a, b, 100*change, flag))
+            if change > threshold:
+                regressions.append({"stage": key[0], "n_node": key[1], "degree": key[2],
+                                    "ntg": key[3], "layout": key[4], "dtype": key[5],
+                                    "metric": metric,
+                                    "base": a, "new": b, "change": change})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic graphs")
+    sub = parser.add_subparsers(dest="cmd")
+    run = sub.add_parser("run")
+    run.add_argument("--nodes", type=int, nargs="+", default=[100, 1000, 10000])
+    run.add_argument("--degree", type=int, nargs="+", default=[3])
+    run.add_argument("--ntg", type=int, nargs="+", default=[24])
+    run.add_argument("--layout", default="timemajor", choices=["timemajor", "snapshot", "sparse"])
+    run.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    run.add_argument("--dtype", default=None, choices=["float32", "float64"])
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--workdir", default=None)
+    run.add_argument("-o", "--out", default="bench_results.json")
+    acc = sub.add_parser("accuracy")
+    acc.add_argument("--nodes", type=int, nargs="+", default=[1000])
+    acc.add_argument("--ntg", type=int, default=24)
+    acc.add_argument("--dtype", default="float32")
+    cmp_ = sub.add_parser("compare")
+    cmp_.add_argument("base")
+    cmp_.add_argument("new")
+    cmp_.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    if args.cmd == "run":
+        run_suite(args.nodes, args.degree, args.ntg, out=args.out, layout=args.layout,
+                  stages=args.stages, repeat=args.repeat, workdir=args.workdir,
+                  dtype=args.dtype)
+        print("Wrote", args.out)
+    elif args.cmd == "accuracy":
+        for n_node in args.nodes:
+            print(json.dumps(dtype_accuracy(n_node, ntg=args.ntg, dtype=args.dtype),
+                             indent=1))
+    elif args.cmd == "compare":
+        regressions = compare(args.base, args.new, args.threshold)
+        if regressions:
+            print(len(regressions), "regression(s) over", "%d%%" % (100*args.threshold))
+            return 1
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
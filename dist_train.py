@@ -0,0 +1,260 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Synchronous data-parallel training on one many-core CPU machine.
+#
+# N worker processes each build the StaticBatchTrainer graph, read their own
+# shard of the (t, t+1) snapshot pairs and compute gradients on a batch of
+# batch_size graphs. The gradients are averaged through shared memory and
+# every worker applies the same mean with its own Adam optimizer, so the
+# replicas stay identical and a step is equivalent to one on a batch of
+# N*batch_size graphs. Rank 0 writes the checkpoint with the trainer's
+# tf.train.Saver, so it restores into a plain StaticBatchTrainer.
+#
+#   logs = train_parallel("toys/week.hdf5", num_procs=8, nsteps=5000,
+#                         batch_size=16, checkpoint="ckpts/model.ckpt")
+#   python dist_train.py toys/week.hdf5 --procs 1 2 4 8 --steps 200
+#
+# Workers are spawned, not forked, so no TF state is inherited, and each
+# gets an equal share of the cores for its intra-op threads.
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import featstore
+import my_graph_tools as mgt
+import train
+
+
+class SharedMean(object):
+    """Mean over workers of a flat vector, through a shared
+    (2, num_procs, size) buffer and one barrier per call.
+
+    Calls alternate between the two halves of the buffer, so a worker can
+    write its next vector while slower ones still read the previous mean.
+    Every worker sums the rows in the same order and gets the same result.
+    """
+
+    def __init__(self, buf, barrier, rank, num_procs, size, dtype):
+        self.rows = np.frombuffer(buf, dtype=dtype).reshape(2, num_procs, size)
+        self.barrier = barrier
+        self.rank = rank
+        self._phase = 0
+
+    def __call__(self, vec, timeout=None):
+        rows = self.rows[self._phase]
+        self._phase ^= 1
+        rows[self.rank] = vec
+        self.barrier.wait(timeout)
+        return rows.mean(axis=0)
+
+
+def _flat(arrays):
+    return np.concatenate([np.ravel(a) for a in arrays])
+
+
+def _unflat(vec, shapes):
+    out, i = [], 0
+    for shape in shapes:
+        n = int(np.prod(shape))
+        out.append(vec[i:i+n].reshape(shape))
+        i += n
+    return out
+
+
+def _shard(h5_name, rank, num_procs):
+    with featstore.open_store(h5_name) as h5f:
+        n_snap = mgt.n_snaps(h5f, 'nn_edge_features')
+    return np.arange(n_snap)[rank::num_procs]
+
+
+def _worker(rank, num_procs, cfg, grad_buf, param_buf, barrier, results):
+    mgt.set_float_dtype(cfg["dtype"])
+    tf.reset_default_graph()
+    tf.set_random_seed(cfg["seed"])
+    trainer = train.StaticBatchTrainer(
+        cfg["h5_name"], batch_size=cfg["batch_size"],
+        num_processing_steps=cfg["num_processing_steps"],
+        learning_rate=cfg["learning_rate"], num_workers=cfg["loader_workers"],
+        seed=cfg["seed"] + rank, times=_shard(cfg["h5_name"], rank, num_procs))
+    grads, tvars = zip(*[(tf.convert_to_tensor(g), v)
+                         for g, v in trainer.grads_and_vars if g is not None])
+    shapes = [v.shape.as_list() for v in tvars]
+    size = sum(int(np.prod(s)) for s in shapes)
+    grad_phs = [tf.placeholder(g.dtype, g.shape) for g in grads]
+    apply_op = trainer.optimizer.apply_gradients(zip(grad_phs, tvars))
+    dtype = np.dtype(grads[0].dtype.as_numpy_dtype)
+    # One extra element carries the loss, so it is averaged for free
+    mean = SharedMean(grad_buf, barrier, rank, num_procs, size + 1, dtype)
+
+    threads = max(1, cfg["cores"]//num_procs)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                            inter_op_parallelism_threads=2)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        if cfg["restore"]:
+            trainer.saver.restore(sess, cfg["restore"])
+        else:
+            # Start every replica from rank 0's initial weights
+            params = np.frombuffer(param_buf, dtype=dtype)[:size]
+            if rank == 0:
+                params[:] = _flat(sess.run(list(tvars)))
+            barrier.wait(cfg["timeout"])
+            if rank != 0:
+                for var, val in zip(tvars, _unflat(params, shapes)):
+                    var.load(val, sess)
+            barrier.wait(cfg["timeout"])
+
+        batches = trainer.batches()
+        logs, losses = [], []
+        t_wait = t_compute = t_sync = 0.
+        t_start = time.time()
+        for step in range(1, cfg["nsteps"]+1):
+            t0 = time.time()
+            inp, tgt = next(batches)
+            feed = train.feed_features(trainer.input_ph, inp)
+            feed.update(train.feed_features(trainer.target_ph, tgt))
+            t1 = time.time()
+            out = sess.run([trainer.loss] + list(grads), feed_dict=feed)
+            t2 = time.time()
+            avg = mean(np.append(_flat(out[1:]), out[0]).astype(dtype), cfg["timeout"])
+            t3 = time.time()
+            sess.run(apply_op, feed_dict=dict(zip(grad_phs, _unflat(avg[:-1], shapes))))
+            t_wait += t1 - t0
+            t_compute += time.time() - t3 + t2 - t1
+            t_sync += t3 - t2
+            losses.append(float(avg[-1]))
+            if rank == 0 and (step % cfg["log_every"] == 0 or step == cfg["nsteps"]):
+                logs.append({"step": step, "loss": float(np.mean(losses))})
+                losses = []
+        wall = time.time() - t_start
+        batches.close()
+        if rank == 0 and cfg["checkpoint"]:
+            trainer.saver.save(sess, cfg["checkpoint"])
+    results.put({"rank": rank, "wall_s": wall, "wait_batch_s": t_wait,
+                 "compute_s": t_compute, "sync_s": t_sync, "logs": logs})
+
+
+def train_parallel(h5_name, num_procs=None, nsteps=1000, batch_size=16,
+                   num_processing_steps=3, learning_rate=1e-3, checkpoint=None,
+                   restore=None, log_every=100, loader_workers=1, seed=0,
+                   dtype=None, timeout=600.):
+    """Run nsteps synchronous steps on num_procs workers (default: one per
+    core), batch_size graphs each. Returns rank 0's loss logs and every
+    worker's time split (waiting for batches, TF compute, gradient sync).
+
+    restore continues from a tf.train.Saver checkpoint; checkpoint is
+    written by rank 0 at the end. dtype defaults to mgt.FLOAT_DTYPE.
+    """
+    cores = multiprocessing.cpu_count()
+    num_procs = num_procs or cores
+    if len(_shard(h5_name, num_procs-1, num_procs)) < batch_size:
+        raise ValueError("Too few snapshots for " + str(num_procs)
+                         + " workers with batch_size " + str(batch_size))
+    dtype = np.dtype(mgt.FLOAT_DTYPE if dtype is None else dtype)
+    ctx = multiprocessing.get_context("spawn")
+    cfg = {"h5_name": h5_name, "nsteps": nsteps, "batch_size": batch_size,
+           "num_processing_steps": num_processing_steps,
+           "learning_rate": learning_rate, "checkpoint": checkpoint,
+           "restore": restore, "log_every": log_every,
+           "loader_workers": loader_workers, "seed": seed, "dtype": dtype.name,
+           "cores": cores, "timeout": timeout}
+    n_param = _count_params(h5_name, num_processing_steps, dtype)
+    typecode = 'f' if dtype == np.float32 else 'd'
+    grad_buf = ctx.RawArray(typecode, 2*num_procs*(n_param + 1))
+    param_buf = ctx.RawArray(typecode, n_param)
+    barrier = ctx.Barrier(num_procs)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_worker,
+                         args=(rank, num_procs, cfg, grad_buf, param_buf,
+                               barrier, results))
+             for rank in range(num_procs)]
+    for p in procs:
+        p.start()
+    out = []
+    try:
+        while len(out) < num_procs:
+            try:
+                out.append(results.get(timeout=1.))
+            except queue.Empty:
+                failed = [p for p in procs if p.exitcode not in (None, 0)]
+                if failed:
+                    barrier.abort()
+                    raise RuntimeError("Worker exited with code "
+                                       + str(failed[0].exitcode))
+    finally:
+        for p in procs:
+            p.join(timeout if out else 1.)
+            if p.is_alive():
+                p.terminate()
+    out.sort(key=lambda r: r["rank"])
+    return {"num_procs": num_procs, "batch_size": batch_size,
+            "nsteps": nsteps, "logs": out[0]["logs"],
+            "workers": [dict((k, v) for k, v in r.items() if k != "logs")
+                        for r in out]}
+
+
+def _count_params(h5_name, num_processing_steps, dtype):
+    # Size of the shared buffers, from a throwaway copy of the model
+    saved = mgt.FLOAT_DTYPE
+    mgt.set_float_dtype(dtype)
+    try:
+        with tf.Graph().as_default():
+            trainer = train.StaticBatchTrainer(h5_name, batch_size=1,
+                                               num_processing_steps=num_processing_steps)
+            return sum(int(np.prod(v.shape.as_list()))
+                       for g, v in trainer.grads_and_vars if g is not None)
+    finally:
+        mgt.set_float_dtype(saved)
+
+
+def scaling_report(h5_name, procs=(1, 2, 4, 8), nsteps=200, batch_size=16, **kw):
+    """train_parallel for each worker count. Throughput is graphs/s over the
+    whole run (slowest worker); efficiency is throughput/(N * throughput at
+    the smallest N, per worker)."""
+    rows = []
+    for n in procs:
+        res = train_parallel(h5_name, num_procs=n, nsteps=nsteps,
+                             batch_size=batch_size, **kw)
+        wall = max(w["wall_s"] for w in res["workers"])
+        row = {"num_procs": n, "wall_s": wall,
+               "graphs_per_s": n*batch_size*nsteps/wall,
+               "sync_frac": np.mean([w["sync_s"]/w["wall_s"] for w in res["workers"]]),
+               "wait_batch_frac": np.mean([w["wait_batch_s"]/w["wall_s"]
+                                           for w in res["workers"]])}
+        rows.append(row)
+        base = rows[0]
+        row["speedup"] = row["graphs_per_s"]/base["graphs_per_s"]
+        row["efficiency"] = row["speedup"]*base["num_procs"]/n
+        print("procs %3d  %9.1f graphs/s  speedup %5.2f  efficiency %5.1f%%  sync %4.1f%%"
+              % (n, row["graphs_per_s"], row["speedup"], 100*row["efficiency"],
+                 100*row["sync_frac"]))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Data-parallel training scaling on this machine")
+    parser.add_argument("h5_name")
+    parser.add_argument("--procs", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("-o", "--out", default=None)
+    args = parser.parse_args(argv)
+    rows = scaling_report(args.h5_name, args.procs, args.steps, args.batch_size)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"cpus": os.cpu_count(), "rows": rows}, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class Moments(object):
+    """Exact per-feature count, mean and M2 (sum of squared deviations).
+
+    update() folds in a whole chunk of rows at once and merge() combines two
+    sets of moments with the pairwise formula of Chan et al., so shards,
+    blocks and later weeks of data can be accumulated in any order.
+    """
+
+    def __init__(self, n_feat):
+        self.n = 0
+        self.mean = np.zeros((n_feat,), dtype=np.float64)
+        self.m2 = np.zeros((n_feat,), dtype=np.float64)
+
+    @property
+    def n_feat(self):
+        return self.mean.shape[0]
+
+    def update(self, x, weights=None):
+        """Fold in the rows of x; weights are integer repeat counts per row,
+        e.g. how many snapshots a row stands for."""
+        x = np.asarray(x, dtype=np.float64).reshape(-1, self.n_feat)
+        if weights is not None:
+            weights = np.asarray(weights).ravel()
+            keep = weights > 0
+            x, weights = x[keep], weights[keep]
+            n = int(weights.sum())
+            if n == 0:
+                return self
+            mean = np.dot(weights, x)/n
+            m2 = np.dot(weights, np.square(x - mean))
+            return self._merge(n, mean, m2)
+        if x.shape[0] == 0:
+            return self
+        mean = x.mean(axis=0)
+        m2 = np.square(x - mean).sum(axis=0)
+        return self._merge(x.shape[0], mean, m2)
+
+    def merge(self, other):
+        return self._merge(other.n, other.mean, other.m2)
+
+    def _merge(self, n_b, mean_b, m2_b):
+        n_a = self.n
+        n = n_a + n_b
+        if n_b == 0:
+            return self
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta*(n_b/n)
+        self.m2 = self.m2 + m2_b + np.square(delta)*(n_a*n_b/n)
+        self.n = n
+        return self
+
+    @property
+    def var(self):
+        # Population variance, as the old Welford loops used
+        return self.m2/max(self.n, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def norm_stats(self):
+        """[mean, std] rows, the layout of node_stats/edge_stats. Constant
+        features get std 1, so normalizing them gives 0 rather than NaN."""
+        std = self.std
+        return np.stack([self.mean, np.where(std > 0, std, 1.)])
+
+    def to_array(self):
+        return np.stack([np.full(self.mean.shape, self.n, dtype=np.float64),
+                         self.mean, self.m2])
+
+    @classmethod
+    def from_array(cls, arr):
+        mom = cls(arr.shape[1])
+        mom.n = int(arr[0, 0])
+        mom.mean = np.array(arr[1], dtype=np.float64)
+        mom.m2 = np.array(arr[2], dtype=np.float64)
+        return mom
@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Uncompressed, memory-mapped copy of the create_nn_inputset output.
+#
+# Compressed HDF5 makes every reader process decompress the same chunks.
+# export_feature_store() writes each feature group once as a time-major
+# .npy file, plus a manifest.json of shapes, dtypes, attrs and the
+# day/tg of each snapshot. FeatureStore opens the arrays with
+# np.load(mmap_mode='r'), so every process on a node reads the same
+# pages from the OS page cache, and slices are views, not copies.
+#
+# FeatureStore looks enough like an open h5py.File (store[name], attrs,
+# filename, `in`) for read_snaps, snap2graph, snaps2graph and the input
+# pipeline to take it in place of one:
+#
+#   export_feature_store("toys/week.hdf5", "toys/week.store")
+#   with open_store("toys/week.store") as fs:
+#       graph = mgt.snaps2graph(fs, range(64))
+#
+# open_store() also takes an HDF5 file name, so callers need not care.
+# Graphs built from a store hold read-only views of the mapped arrays;
+# mgt.copy_graph gives a writable copy.
+
+import json
+import os
+
+import h5py
+import numpy as np
+
+import my_graph_tools as mgt
+import tracing
+
+MANIFEST = "manifest.json"
+STORE_VERSION = 1
+
+FEATURE_GROUPS = ("nn_edge_features", "nn_node_features", "nn_glbl_features",
+                  "node_features", "glbl_features")
+STATIC_ARRAYS = ("senders", "receivers", "node_coords",
+                 "node_stats", "edge_stats", "glbl_stats")
+
+
+def _json_value(val):
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, bytes):
+        return val.decode()
+    return val
+
+
+def export_feature_store(h5_name, out_dir, groups=FEATURE_GROUPS, dtype=None):
+    """Write the feature groups of h5_name (either layout) that exist to
+    out_dir as .npy files, with a manifest. dtype casts the features,
+    e.g. np.float32; by default they keep their stored dtype."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    # An old manifest would describe arrays that are about to change
+    if os.path.exists(os.path.join(out_dir, MANIFEST)):
+        os.remove(os.path.join(out_dir, MANIFEST))
+    manifest = {"version": STORE_VERSION, "groups": {}, "arrays": {}, "attrs": {}}
+    with h5py.File(h5_name, 'r') as h5f:
+        # The time groups per day the snapshots were written with
+        ntg = int(h5f.attrs.get('ntg', mgt.NTG))
+        manifest["ntg"] = ntg
+        for key, val in h5f.attrs.items():
+            manifest["attrs"][key] = _json_value(val)
+        T = None
+        for name in groups:
+            if name not in h5f:
+                continue
+            n = mgt.n_snaps(h5f, name)
+            T = n if T is None else min(T, n)
+            first = mgt.read_snaps(h5f, name, 0, 1)
+            shape = (n,) + first.shape[1:]
+            out_dtype = first.dtype if dtype is None else np.dtype(dtype)
+            fname = name + ".npy"
+            arr = np.lib.format.open_memmap(os.path.join(out_dir, fname), mode='w+',
+                                            dtype=out_dtype, shape=shape)
+            print("Exporting", name)
+            for t0 in tracing.progress(range(0, n, mgt.BLOCK_T), "export.block"):
+                t1 = min(t0 + mgt.BLOCK_T, n)
+                if out_dtype == first.dtype:
+                    mgt.read_snaps(h5f, name, t0, t1, out=arr[t0:t1])
+                else:
+                    arr[t0:t1] = mgt.read_snaps(h5f, name, t0, t1)
+            arr.flush()
+            del arr
+            manifest["groups"][name] = {"file": fname, "shape": list(shape),
+                                        "dtype": out_dtype.str}
+        for name in STATIC_ARRAYS:
+            if name not in h5f:
+                continue
+            fname = name + ".npy"
+            np.save(os.path.join(out_dir, fname), h5f[name][:])
+            manifest["arrays"][name] = {"file": fname,
+                                        "shape": list(h5f[name].shape),
+                                        "dtype": h5f[name].dtype.str}
+    if T is None:
+        raise ValueError("No feature groups found in " + str(h5_name))
+    # Time index t = day*ntg + tg, as in the HDF5 file
+    t = np.arange(T)
+    daytg = np.stack([(t//ntg) % 7, t % ntg], axis=1).astype(np.int32)
+    np.save(os.path.join(out_dir, "daytg.npy"), daytg)
+    manifest["n_snaps"] = T
+    manifest["index"] = {"file": "daytg.npy", "columns": ["day", "tg"]}
+    # Written last, so a store with a manifest is always complete
+    tmp = os.path.join(out_dir, MANIFEST + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(tmp, os.path.join(out_dir, MANIFEST))
+    return manifest
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+class FeatureStore(object):
+    """Read-only, memory-mapped view of an exported store.
+
+    store[name] is an np.memmap of shape (time, entity, feature) for the
+    feature groups, or the static array (senders, receivers, stats, ...).
+    """
+
+    def __init__(self, path):
+        self.filename = os.path.abspath(path)
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != STORE_VERSION:
+            raise ValueError("Unsupported store version " + str(self.manifest["version"]))
+        if self.manifest["ntg"] != mgt.NTG:
+            print("Warning: store holds snapshots with ntg =", self.manifest["ntg"],
+                  "but NTG =", mgt.NTG)
+        self.attrs = self.manifest["attrs"]
+        self._arrays = {}
+        entries = dict(self.manifest["groups"])
+        entries.update(self.manifest["arrays"])
+        for name, entry in entries.items():
+            self._arrays[name] = np.load(os.path.join(path, entry["file"]),
+                                         mmap_mode='r')
+        self.daytg = np.load(os.path.join(path, self.manifest["index"]["file"]),
+                             mmap_mode='r')
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    def keys(self):
+        return self._arrays.keys()
+
+    def close(self):
+        # Views handed out keep their pages mapped until they are dropped
+        self._arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_store(name):
+    """FeatureStore for an exported store directory, else the HDF5 file
+    opened read-only."""
+    if os.path.isdir(name) and is_store(name):
+        return FeatureStore(name)
+    return h5py.File(name, 'r')
@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Road graph construction for the toy network, without pandas.
+#
+# toy_traffic.ipynb connects each node to its maxnbr nearest neighbours by
+# re-sorting the whole node table per node, then adds the reverse of every
+# one-way edge so streets are two-way. Here the neighbours come from a
+# spatial index (scipy's cKDTree when available, else a uniform grid in
+# numpy), and the reverse edges, angles and whirlpool directions are
+# computed for all edges at once.
+#
+#   graph = build_graph(random_nodes(100000, seed=0), k=4)
+#   write_graph("toys/big.hdf5", graph)
+#
+# write_graph stores senders/receivers/node_coords and the n_nodes/n_edges
+# attrs that get_node_coord_dict, snap2graph and CalcMFactor read, plus
+# edge_angles and wdir for WhirlpoolSim.
+
+import h5py
+import numpy as np
+
+import my_graph_tools as mgt
+import traffic_sim
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def random_nodes(n_node, seed=None):
+    """Uniform positions in the unit square, like the notebook."""
+    return np.random.default_rng(seed).uniform(size=(n_node, 2))
+
+
+def _drop_self(idx, k):
+    # Rows of k+1 neighbours that include the node itself (usually first,
+    # but not if another node sits at the same position)
+    other = idx != np.arange(idx.shape[0])[:, None]
+    order = np.argsort(~other, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def _knn_kdtree(pos, k):
+    _, idx = cKDTree(pos).query(pos, k=k+1)
+    return _drop_self(idx, k)
+
+
+def _knn_grid(pos, k, max_cand=1 << 22):
+    # Bucket the nodes into square cells of ~2 nodes each. A node's k
+    # nearest among the cells within r of its own are exact once the k-th
+    # is no farther than r cell widths; the rest retry with r doubled.
+    n = pos.shape[0]
+    lo = pos.min(axis=0)
+    ext = pos.max(axis=0) - lo
+    h = max(ext.max(), 1e-12)/max(1, int(np.sqrt(n/2.)))
+    ncell = (ext//h).astype(np.int64) + 1
+    cell = np.minimum(((pos - lo)//h).astype(np.int64), ncell - 1)
+    cid = cell[:, 0]*ncell[1] + cell[:, 1]
+    order = np.argsort(cid, kind='stable')
+    counts = np.bincount(cid, minlength=ncell[0]*ncell[1])
+    start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    maxcnt = counts.max()
+
+    nbrs = np.zeros((n, k), dtype=np.int64)
+    todo = np.arange(n)
+    r = 1
+    while todo.size:
+        off = np.arange(-r, r+1)
+        ox, oy = [o.ravel() for o in np.meshgrid(off, off, indexing='ij')]
+        width = ox.size*maxcnt
+        everything = r >= ncell.max()
+        failed = []
+        if width < k:
+            r *= 2
+            continue
+        chunk = max(1, max_cand//width)
+        for c0 in range(0, todo.size, chunk):
+            q = todo[c0:c0+chunk]
+            cx = cell[q, 0][:, None] + ox
+            cy = cell[q, 1][:, None] + oy
+            inside = (cx >= 0) & (cx < ncell[0]) & (cy >= 0) & (cy < ncell[1])
+            c = np.where(inside, cx*ncell[1] + cy, 0)
+            cnt = np.where(inside, counts[c], 0)
+            j = start[c][:, :, None] + np.arange(maxcnt)
+            valid = np.arange(maxcnt) < cnt[:, :, None]
+            cand = order[np.where(valid, j, 0)].reshape(q.size, width)
+            valid = valid.reshape(q.size, width) & (cand != q[:, None])
+            d2 = np.where(valid, np.square(pos[cand] - pos[q, None]).sum(axis=2), np.inf)
+            part = np.argpartition(d2, k-1, axis=1)[:, :k]
+            pd2 = np.take_along_axis(d2, part, axis=1)
+            srt = np.argsort(pd2, axis=1, kind='stable')
+            pd2 = np.take_along_axis(pd2, srt, axis=1)
+            pidx = np.take_along_axis(np.take_along_axis(cand, part, axis=1), srt, axis=1)
+            ok = np.isfinite(pd2[:, -1])
+            if not everything:
+                ok &= pd2[:, -1] <= (r*h)**2
+            nbrs[q[ok]] = pidx[ok]
+            failed.append(q[~ok])
+        todo = np.concatenate(failed)
+        r *= 2
+    return nbrs
+
+
+def knn(pos, k):
+    """(n_node, k) ids of each node's k nearest other nodes, nearest first."""
+    pos = np.asarray(pos, dtype=np.float64)
+    if pos.shape[0] <= k:
+        raise ValueError("Need more than k=" + str(k) + " nodes, got " + str(pos.shape[0]))
+    if cKDTree is not None:
+        return _knn_kdtree(pos, k)
+    return _knn_grid(pos, k)
+
+
+def two_way_edges(nbrs):
+    """senders/receivers of the k-nearest-neighbour edges plus the reverse
+    of each edge that has none. Edges are grouped by sender, the k nearest
+    first, then the added reverse edges in the order the notebook appends
+    them."""
+    n, k = nbrs.shape
+    senders = np.repeat(np.arange(n), k)
+    receivers = nbrs.ravel()
+    rank = np.tile(np.arange(k), n)
+    keys = senders*n + receivers
+    rev = receivers*n + senders
+    add = ~np.isin(rev, keys)
+    all_s = np.concatenate([senders, receivers[add]])
+    all_r = np.concatenate([receivers, senders[add]])
+    # Added edges come after a node's own, ordered by the node that
+    # triggered them
+    key = np.concatenate([rank, k + keys[add]])
+    order = np.lexsort((key, all_s))
+    return all_s[order], all_r[order]
+
+
+def build_graph(node_pos, k=4, center=(0.5, 0.5)):
+    """Two-way k-nearest-neighbour road graph over node_pos (n_node, 2).
+
+    Returns a dict of senders, receivers, edge_angles (direction of each
+    edge), wdir (clockwise whirlpool direction of each node about center)
+    and node_coords.
+    """
+    node_pos = np.asarray(node_pos, dtype=np.float64)
+    senders, receivers = two_way_edges(knn(node_pos, k))
+    return {"senders": senders, "receivers": receivers,
+            "edge_angles": traffic_sim.edge_angles(senders, receivers, node_pos),
+            "wdir": traffic_sim.whirl_dirs(node_pos, center),
+            "node_coords": node_pos}
+
+
+def write_graph(h5_name, graph):
+    """Store a build_graph result in h5_name (created if needed), replacing
+    any topology already there."""
+    with h5py.File(h5_name, 'a') as h5f:
+        for key in ("senders", "receivers", "node_coords", "edge_angles", "wdir"):
+            if key in h5f:
+                del h5f[key]
+            h5f.create_dataset(key, data=graph[key])
+        h5f.attrs['n_nodes'] = graph["node_coords"].shape[0]
+        h5f.attrs['n_edges'] = graph["senders"].shape[0]
+    mgt.clear_topology_cache()
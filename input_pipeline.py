@@ -0,0 +1,215 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Background prefetching of (t, t+1) snapshot pairs for training.
+#
+# Usage with a feed dict:
+#
+#   with PairPrefetcher(h5name, batch_size=64) as pf:
+#       for inp, tgt in pf:
+#           sess.run(step_op, feed_dict={**utils_tf.get_feed_dict(inp_ph, inp),
+#                                        **utils_tf.get_feed_dict(tgt_ph, tgt)})
+#       print(pf.stats())
+#
+# or as a tf.data pipeline through pf.as_tf_dataset().
+
+import multiprocessing
+import queue
+import threading
+import time
+
+from graph_nets import graphs
+import numpy as np
+import tensorflow as tf
+
+import featstore
+import my_graph_tools as mgt
+import tracing
+
+_DONE = "__done__"
+
+
+def load_pair(h5f, ts, normalize=True):
+    """Input and target GraphsTuples for the snapshots ts and ts+1.
+
+    Both halves are read in one snaps2graph call, so a snapshot that is
+    both an input and a target is only decoded once."""
+    ts = np.asarray(ts)
+    with tracing.span("load_pair") as sp:
+        sp.count("graphs", len(ts))
+        n_snap = mgt.n_snaps(h5f, 'nn_edge_features')
+        both = mgt.snaps2graph(h5f, np.concatenate([ts, mgt.next_snap(ts, n_snap)]),
+                               normalize=normalize)
+        return _split_batch(both, len(ts), mgt.get_topology(h5f))
+
+
+def _split_batch(graph, n, topo):
+    # First n graphs and the rest of a batch of same-topology graphs
+    senders, receivers = mgt.batch_topology(topo, n)
+    n_node, n_edge = n*graph.n_node[0], n*graph.n_edge[0]
+    return tuple(graph.replace(nodes=nodes, edges=edges, globals=glbls,
+                               senders=senders, receivers=receivers,
+                               n_node=graph.n_node[:n], n_edge=graph.n_edge[:n])
+                 for nodes, edges, glbls in
+                 ((graph.nodes[:n_node], graph.edges[:n_edge], graph.globals[:n]),
+                  (graph.nodes[n_node:], graph.edges[n_edge:], graph.globals[n:])))
+
+
+def _worker(h5_name, tasks, out, stop, normalize):
+    h5f = featstore.open_store(h5_name)
+    try:
+        while not stop.is_set():
+            ts = tasks.get()
+            if ts is None:
+                break
+            out.put(load_pair(h5f, ts, normalize))
+    finally:
+        h5f.close()
+        out.put(_DONE)
+
+
+class PairPrefetcher(object):
+    """Yields shuffled (input, target) batches built by background workers.
+
+    Workers are threads by default. h5py serializes HDF5 calls, so threads
+    mainly overlap loading with TF compute; use_processes=True also spreads
+    decompression across cores. epochs=None cycles forever.
+    h5_name may also be a directory from featstore.export_feature_store;
+    its memory-mapped arrays are shared by all workers without decompressing.
+    """
+
+    def __init__(self, h5_name, batch_size=1, times=None, shuffle=True,
+                 seed=None, num_workers=2, queue_size=8,
+                 use_processes=False, normalize=True, epochs=1):
+        with featstore.open_store(h5_name) as h5f:
+            n_snap = mgt.n_snaps(h5f, 'nn_edge_features')
+        self.times = np.arange(n_snap) if times is None else np.asarray(times)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.epochs = epochs
+        self.num_workers = num_workers
+        self._rng = np.random.RandomState(seed)
+
+        if use_processes:
+            self._tasks = multiprocessing.Queue(queue_size)
+            self._out = multiprocessing.Queue(queue_size)
+            self._stop = multiprocessing.Event()
+            spawn = multiprocessing.Process
+        else:
+            self._tasks = queue.Queue(queue_size)
+            self._out = queue.Queue(queue_size)
+            self._stop = threading.Event()
+            spawn = threading.Thread
+        self._workers = [spawn(target=_worker,
+                               args=(h5_name, self._tasks, self._out,
+                                     self._stop, normalize))
+                         for _ in range(num_workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+        self._ndone = 0
+        self._nbatch = 0
+        self._starved = 0.
+        self._t_start = time.time()
+
+    def _batches(self):
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            times = self.times
+            if self.shuffle:
+                times = times[self._rng.permutation(len(times))]
+            for i in range(0, len(times), self.batch_size):
+                # Sorted, so contiguous runs are read as one block
+                yield np.sort(times[i:i+self.batch_size])
+            epoch += 1
+
+    def _feed(self):
+        for ts in self._batches():
+            while not self._stop.is_set():
+                try:
+                    self._tasks.put(ts, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self._stop.is_set():
+                break
+        for _ in range(self.num_workers):
+            self._tasks.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t0 = time.time()
+        while True:
+            item = self._out.get()
+            if isinstance(item, str) and item == _DONE:
+                self._ndone += 1
+                if self._ndone == self.num_workers:
+                    self._starved += time.time() - t0
+                    raise StopIteration
+                continue
+            break
+        self._starved += time.time() - t0
+        self._nbatch += 1
+        return item
+
+    next = __next__
+
+    def stats(self):
+        """Time the consumer spent blocked waiting for a batch."""
+        wall = time.time() - self._t_start
+        return {"batches": self._nbatch,
+                "starved_s": self._starved,
+                "wall_s": wall,
+                "starved_frac": self._starved/wall if wall > 0 else 0.}
+
+    def close(self):
+        self._stop.set()
+        # Drain so blocked workers can see the stop flag
+        while any(w.is_alive() for w in self._workers):
+            try:
+                self._out.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def as_tf_dataset(self, prefetch=2):
+        """A tf.data.Dataset of (input, target) GraphsTuples fed by this prefetcher."""
+        spec = self._spec()
+        types = {k: v[0] for k, v in spec.items()}
+        shapes = {k: v[1] for k, v in spec.items()}
+
+        def as_dict(graph):
+            return {k: np.asarray(v, dtype=types[k].as_numpy_dtype)
+                    for k, v in graph._asdict().items()}
+
+        def gen():
+            for inp, tgt in self:
+                yield as_dict(inp), as_dict(tgt)
+
+        ds = tf.data.Dataset.from_generator(gen, (types, types),
+                                            (shapes, shapes))
+        ds = ds.map(lambda a, b: (graphs.GraphsTuple(**a),
+                                  graphs.GraphsTuple(**b)))
+        return ds.prefetch(prefetch)
+
+    def _spec(self):
+        # dtypes and shapes with a dynamic leading (stacked graphs) dimension
+        spec = {}
+        for field in graphs.ALL_FIELDS:
+            if field in ("senders", "receivers", "n_node", "n_edge"):
+                spec[field] = (tf.int32, tf.TensorShape([None]))
+            else:
+                spec[field] = (tf.as_dtype(mgt.FLOAT_DTYPE), tf.TensorShape([None, None]))
+        return spec
@@ -10,13 +10,20 @@ from graph_nets import utils_tf
 
 import my_graph_tools as mgt
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import networkx as nx
 import numpy as np
 import sonnet as snt
 import tensorflow as tf
 import h5py
-from progressbar import progressbar
+import collections
+import hashlib
+import multiprocessing
+import os
+import subprocess
 from sklearn.preprocessing import normalize
+from featstats import Moments
+import tracing
 import matplotlib.pyplot as plt
 
 pi = np.pi
@@ -29,6 +36,18 @@ LATENT_SIZE = 16  # Hard-code latent layer sizes for demos.
 DTG = 0.5
 NTG = int(60*24/DTG)
 
+# dtype policy. Feature arrays (the HDF5 feature groups, GraphsTuples and
+# so the model) are FLOAT_DTYPE; per-entity statistics (edge_node_covs, M,
+# the norm moments) accumulate and are stored in ACC_DTYPE. MGT_FLOAT_DTYPE
+# or set_float_dtype() switch the features back to float64.
+FLOAT_DTYPE = np.dtype(os.environ.get("MGT_FLOAT_DTYPE","float32")).type
+ACC_DTYPE = np.float64
+
+def set_float_dtype(dtype):
+    """Set FLOAT_DTYPE for everything created from now on."""
+    global FLOAT_DTYPE
+    FLOAT_DTYPE = np.dtype(dtype).type
+
 def make_mlp_model(Lsize=LATENT_SIZE,Nlayer=NUM_LAYERS):
   """Instantiates a new MLP, followed by LayerNorm.
 
@@ -88,9 +107,9 @@ class MLPGraphNetwork(snt.AbstractModule):
 
 def get_empty_graph(nodeshape,edgeshape,glblshape,senders,receivers):
     dic = {
-        "globals": np.zeros(glblshape,dtype=np.float),
-        "nodes": np.zeros(nodeshape,dtype=np.float),
-        "edges": np.zeros(edgeshape,dtype=np.float),
+        "globals": np.zeros(glblshape,dtype=FLOAT_DTYPE),
+        "nodes": np.zeros(nodeshape,dtype=FLOAT_DTYPE),
+        "edges": np.zeros(edgeshape,dtype=FLOAT_DTYPE),
         "senders": senders,
         "receivers": receivers
     }
@@ -169,16 +188,84 @@ class EncodeProcessDecode(snt.AbstractModule):
             self._output_transform = \
                 modules.GraphIndependent(edge_fn, node_fn)
 
-    def _build(self, input_op, num_processing_steps):
+    def _build(self, input_op, num_processing_steps, output_every=1,
+               use_while_loop=False):
+        """Returns the decoded outputs after every output_every-th processing
+        step, and always after the last one. output_every=num_processing_steps
+        gives just the final output.
+
+        use_while_loop runs the core in a tf.while_loop with shared weights, so
+        graph size and build time stay flat as num_processing_steps grows, and
+        only the returned steps are decoded.
+        """
         latent = self._encoder(input_op)
         latent0 = latent
+        if use_while_loop:
+            return self._build_while_loop(input_op, latent0,
+                                          num_processing_steps, output_every)
         output_ops = []
-        for _ in range(num_processing_steps):
-            core_input = utils_tf.concat([latent0, latent], axis=1)
-            latent = self._core(core_input)
-            decoded_op = self._decoder(latent)
-            output_ops.append(self._output_transform(decoded_op).replace(
-                              globals=input_op.globals))
+        for step in range(1, num_processing_steps+1):
+            latent = self._process_step(latent0, latent)
+            if step % output_every == 0 or step == num_processing_steps:
+                output_ops.append(self._decode(latent, input_op))
+        return output_ops
+
+    def _process_step(self, latent0, latent):
+        core_input = utils_tf.concat([latent0, latent], axis=1)
+        return self._core(core_input)
+
+    def _decode(self, latent, input_op):
+        decoded_op = self._decoder(latent)
+        return self._output_transform(decoded_op).replace(
+            globals=input_op.globals)
+
+    def _build_while_loop(self, input_op, latent0, num_processing_steps,
+                          output_every):
+        # The first step is connected outside the loop so the core's variables
+        # are not created inside a control flow context.
+        latent = self._process_step(latent0, latent0)
+        if num_processing_steps == 1:
+            # No loop, which would only add dead ops and zero gradients
+            return [self._decode(latent, input_op)]
+        # Latents kept for the intermediate outputs; decoded after the loop
+        n_keep = (num_processing_steps-1)//output_every
+        fields = ("nodes", "edges", "globals")
+        keep = [tf.TensorArray(getattr(latent, f).dtype, size=n_keep,
+                               infer_shape=False) for f in fields] if n_keep else []
+        if output_every == 1 and n_keep:
+            keep = [ta.write(0, getattr(latent, f)) for ta, f in zip(keep, fields)]
+
+        def cond(step, nodes, edges, glbls, *tas):
+            return step < num_processing_steps
+
+        def body(step, nodes, edges, glbls, *tas):
+            cur = latent.replace(nodes=nodes, edges=edges, globals=glbls)
+            cur = self._process_step(latent0, cur)
+            step += 1
+            new = (cur.nodes, cur.edges, cur.globals)
+            tas = list(tas)
+            if n_keep:
+                def write():
+                    return [ta.write(step//output_every - 1, x)
+                            for ta, x in zip(tas, new)]
+                tas = tf.cond(tf.logical_and(tf.equal(step % output_every, 0),
+                                             step < num_processing_steps),
+                              write, lambda: tas)
+            return [step] + list(new) + list(tas)
+
+        loop_vars = [tf.constant(1), latent.nodes, latent.edges, latent.globals] + keep
+        res = tf.while_loop(cond, body, loop_vars, back_prop=True)
+        final = latent.replace(nodes=res[1], edges=res[2], globals=res[3])
+
+        output_ops = []
+        for j in range(n_keep):
+            kept = [ta.read(j) for ta in res[4:]]
+            for x, f in zip(kept, fields):
+                x.set_shape(getattr(latent, f).shape)
+            output_ops.append(self._decode(
+                latent.replace(nodes=kept[0], edges=kept[1], globals=kept[2]),
+                input_op))
+        output_ops.append(self._decode(final, input_op))
         return output_ops
 
 
@@ -186,10 +273,10 @@ class EncodeProcessDecode(snt.AbstractModule):
 class timecrement(snt.Module):
     # Custom sonnet module for incrementing the global feature. Yeesh
     def __init__(self,ntg,disable=False,name=None):
-        self.adder = tf.constant([0.,1.],dtype=np.double)
-        self.add_day = tf.Variable([[1.,0.]],dtype=np.double,trainable=False)
-        self.add_tg = tf.Variable([[0.,1.]],dtype=np.double,trainable=False)
-        self.T = tf.Variable([[0.,0.]],dtype=np.double,trainable=False)
+        self.adder = tf.constant([0.,1.],dtype=FLOAT_DTYPE)
+        self.add_day = tf.Variable([[1.,0.]],dtype=FLOAT_DTYPE,trainable=False)
+        self.add_tg = tf.Variable([[0.,1.]],dtype=FLOAT_DTYPE,trainable=False)
+        self.T = tf.Variable([[0.,0.]],dtype=FLOAT_DTYPE,trainable=False)
         self.ntg = ntg
         self.disable = disable
     def __call__(self,T):
@@ -197,9 +284,9 @@ class timecrement(snt.Module):
             return T[:,:2]
         day = T[0,0]
         tg = T[0,1]
-        self.T = tf.mod(tf.add(T,self.add_tg),tf.constant([[8.,self.ntg]],dtype=np.double))
+        self.T = tf.mod(tf.add(T,self.add_tg),tf.constant([[8.,self.ntg]],dtype=FLOAT_DTYPE))
         def f1(): return tf.mod(tf.add(self.T,self.add_day),\
-                                tf.constant([[7.,(self.ntg+2)]],dtype=np.double))
+                                tf.constant([[7.,(self.ntg+2)]],dtype=FLOAT_DTYPE))
         def f2(): return self.T
         self.T = tf.cond(tf.math.equal(self.T[0,1],0.),f1,f2)
         return self.T
@@ -212,61 +299,660 @@ def get_node_coord_dict(h5):
         d.update({i:(coords[0],coords[1])})
     return d
 
-def draw_graph(graph, node_pos_dict, col_lims=None, is_normed=False, normfile=None):
-    if col_lims:
-        vmin,vmax = col_lims[0], col_lims[1]
-        e_vmin,e_vmax = col_lims[2], col_lims[3]
-    else:
-        vmin,vmax = -0.5, 10
-        e_vmin,e_vmax = -0.5, 5
-
+def _node_pos_array(node_pos):
+    # Accepts the {node: (x,y)} dict from get_node_coord_dict or an (n,2) array
+    if isinstance(node_pos,dict):
+        pos = np.zeros((len(node_pos),2),dtype=np.float64)
+        for i,xy in node_pos.items():
+            pos[i] = xy
+        return pos
+    return np.asarray(node_pos,dtype=np.float64)
+
+class GraphRenderer(object):
+    """Draws node/edge car counts straight from the topology arrays.
+
+    Edges are one LineCollection in feature-row order, so no edge lookup is
+    needed, and the figure is built once: draw() only swaps the colour
+    arrays, which makes rendering many frames cheap.
+    """
+    def __init__(self, node_pos, senders, receivers, col_lims=None,
+                 figsize=(15,15), node_size=100, arrows=False):
+        if col_lims:
+            vmin,vmax = col_lims[0], col_lims[1]
+            e_vmin,e_vmax = col_lims[2], col_lims[3]
+        else:
+            vmin,vmax = -0.5, 10
+            e_vmin,e_vmax = -0.5, 5
+        pos = _node_pos_array(node_pos)
+        p0, p1 = pos[senders], pos[receivers]
+
+        self.fig, self.ax = plt.subplots(figsize=figsize)
+        self.edge_art = LineCollection(np.stack([p0,p1],axis=1),cmap=plt.cm.winter,
+                                       norm=plt.Normalize(e_vmin,e_vmax),zorder=1)
+        self.edge_art.set_array(np.zeros(len(senders)))
+        self.ax.add_collection(self.edge_art)
+        self.arrow_art = None
+        if arrows:
+            # Arrowheads on the receiving end, one artist for all edges
+            d = p1 - p0
+            self.arrow_art = self.ax.quiver(p0[:,0]+0.9*d[:,0],p0[:,1]+0.9*d[:,1],
+                                            0.1*d[:,0],0.1*d[:,1],np.zeros(len(senders)),
+                                            cmap=plt.cm.winter,norm=plt.Normalize(e_vmin,e_vmax),
+                                            angles='xy',scale_units='xy',scale=1,
+                                            width=0.002,zorder=1)
+        self.node_art = self.ax.scatter(pos[:,0],pos[:,1],c=np.zeros(len(pos)),
+                                        s=node_size,cmap=plt.cm.winter,
+                                        vmin=vmin,vmax=vmax,zorder=2)
+        self.ax.autoscale_view()
+        self.ax.set_axis_off()
+
+    def draw(self, nodecols, edgecols):
+        self.node_art.set_array(np.asarray(nodecols))
+        self.edge_art.set_array(np.asarray(edgecols))
+        if self.arrow_art is not None:
+            self.arrow_art.set_array(np.asarray(edgecols))
+        return self.fig, self.ax
+
+def draw_graph(graph, node_pos_dict, col_lims=None, is_normed=False, normfile=None,
+               arrows=False):
     if is_normed:
         # Need to unnorm for plotting
         hf = h5py.File(normfile,'r')
-        edgestats = hf['edge_stats']
-        nodestats = hf['node_stats']
+        edgestats = hf['edge_stats'][:]
+        nodestats = hf['node_stats'][:]
         graph = unnorm_graph(graph,nodestats,edgestats)
         hf.close()
 
+    renderer = GraphRenderer(node_pos_dict,graph.senders,graph.receivers,
+                             col_lims=col_lims,arrows=arrows)
+    return renderer.draw(graph.nodes[:,0],graph.edges[:,0])
+
+def _frame_name(outdir,day,tg):
+    return os.path.join(outdir,"day%dtg%05d.png" % (day,tg))
+
+def _render_frames(args):
+    h5_name, day, tgs, outdir, col_lims, normalize, dpi = args
+    plt.switch_backend("Agg")
+    with h5py.File(h5_name,'r') as h5f:
+        topo = get_topology(h5f)
+        renderer = GraphRenderer(h5f['node_coords'][:],topo["senders"],
+                                 topo["receivers"],col_lims=col_lims)
+        if normalize:
+            nodestats, edgestats = h5f['node_stats'][:], h5f['edge_stats'][:]
+        graph = None
+        for tg in tgs:
+            graph = snaps2graph(h5f,[(day,tg)],normalize=normalize,out=graph)
+            if normalize:
+                unnorm_graph(graph,nodestats,edgestats,out=graph)
+            fig, ax = renderer.draw(graph.nodes[:,0],graph.edges[:,0])
+            fig.savefig(_frame_name(outdir,day,tg),dpi=dpi)
+        plt.close(renderer.fig)
+    return len(tgs)
+
+def render_day(h5_name, day, outdir, workers=4, video=None, fps=24,
+               col_lims=None, normalize=True, dpi=72):
+    """Render every timegroup of a day to PNG frames using a process pool.
+
+    With video set to a file name, the frames are also encoded with ffmpeg.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tg_chunks = [list(c) for c in np.array_split(np.arange(NTG),4*workers) if len(c)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        pool.map(_render_frames,[(h5_name,day,c,outdir,col_lims,normalize,dpi)
+                                 for c in tg_chunks])
+    finally:
+        pool.close()
+        pool.join()
+
+    if video:
+        subprocess.check_call(["ffmpeg","-y","-loglevel","error",
+                               "-framerate",str(fps),
+                               "-i",os.path.join(outdir,"day%dtg%%05d.png" % day),
+                               "-pix_fmt","yuv420p",video])
+
+# Snapshot storage
+#
+# Three on-disk layouts are supported for the per-timegroup feature groups
+# (edge_features, node_features, glbl_features, nn_*_features):
+#   "snapshot":  a group with one dataset per snapshot, e.g. edge_features/day3tg117
+#   "timemajor": one chunked dataset of shape (time, entity, feature)
+#   "sparse":    a group holding a base row per entity and, per snapshot, only
+#                the rows that differ from it (see the sparse section below)
+# Time index t = day*NTG + tg. Anything past 7*NTG is a later week.
+# Readers wrap t around the stored range, so t+1 of the last snapshot is t=0.
+
+BLOCK_T = 64 # snapshots per block read/write
+
+def snapstr(day,tg):
+    return 'day'+str(day)+'tg'+str(tg)
+
+def snap_index(day,tg):
+    return day*NTG + tg
+
+def snap_daytg(t):
+    return (t//NTG)%7, t%NTG
+
+def next_snap(t,n_snap=None):
+    # Saturday's last timegroup is followed by Sunday's first
+    n_snap = 7*NTG if n_snap is None else n_snap
+    return (t+1) % n_snap
+
+def next_daytg(day,tg):
+    return snap_daytg(next_snap(snap_index(day,tg)))
+
+def get_layout(h5f,name):
+    # ndarrays come from a featstore.FeatureStore standing in for the file
+    obj = h5f[name]
+    if isinstance(obj,(h5py.Dataset,np.ndarray)):
+        return "timemajor"
+    if obj.attrs.get("layout") == "sparse":
+        return "sparse"
+    return "snapshot"
+
+def n_snaps(h5f,name):
+    layout = get_layout(h5f,name)
+    if layout == "timemajor":
+        return h5f[name].shape[0]
+    if layout == "sparse":
+        return h5f[name]["indptr"].shape[0] - 1
+    return 7*NTG
+
+def _codec_kwargs(codec,codec_opts=None):
+    # codec may also be a dict of h5py create_dataset kwargs,
+    # e.g. from hdf5plugin, which is passed through untouched
+    if isinstance(codec,dict):
+        return dict(codec)
+    if codec is None or codec == "none":
+        return {}
+    if codec == "gzip":
+        return {"compression": "gzip",
+                "compression_opts": 4 if codec_opts is None else codec_opts,
+                "shuffle": True}
+    if codec == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    raise ValueError("Unknown codec "+str(codec))
+
+def _default_chunks(shape,itemsize,target=1<<20):
+    # Aim for ~1MB chunks spanning whole snapshots where possible
+    n_snap, n_ent, n_ft = shape
+    per_snap = n_ent*n_ft*itemsize
+    if per_snap >= target:
+        ent = max(1, min(n_ent, target//(n_ft*itemsize)))
+        return (1, ent, n_ft)
+    return (max(1, min(n_snap, target//per_snap)), n_ent, n_ft)
+
+def create_snapset(h5f,name,n_snap,n_entity,n_feat,dtype=None,
+                   layout="timemajor",codec="gzip",codec_opts=None,chunks=None,
+                   base=None):
+    """Create (or replace) a feature group in the given layout.
+
+    A sparse group starts empty and grows as snapshots are written in order;
+    base is its (n_entity,n_feat) base rows, zeros by default.
+    dtype defaults to FLOAT_DTYPE.
+    """
+    if dtype is None:
+        dtype = FLOAT_DTYPE
+    if name in h5f:
+        del h5f[name]
+    if layout == "snapshot":
+        return h5f.create_group(name)
+    elif layout == "sparse":
+        return _create_sparse(h5f,name,n_entity,n_feat,dtype,codec,codec_opts,base)
+    elif layout != "timemajor":
+        raise ValueError("Unknown layout "+str(layout))
+    shape = (n_snap,n_entity,n_feat)
+    if chunks is None:
+        chunks = _default_chunks(shape,np.dtype(dtype).itemsize)
+    return h5f.create_dataset(name,shape=shape,dtype=dtype,chunks=chunks,
+                              maxshape=(None,n_entity,n_feat),
+                              **_codec_kwargs(codec,codec_opts))
+
+def read_snaps(h5f,name,t0,t1,out=None):
+    """Read snapshots t0..t1-1 of a feature group as one (time,entity,feature) array.
+
+    With out, the data is read straight into that preallocated array.
+    """
+    with tracing.span("read_snaps",group=name) as sp:
+        arr = _read_snaps(h5f,name,t0,t1,out)
+        if tracing.enabled():
+            sp.count("bytes_read",arr.nbytes)
+            if getattr(h5f[name],"compression",None):
+                sp.count("bytes_decompressed",arr.nbytes)
+    return arr
+
+def _read_snaps(h5f,name,t0,t1,out=None):
+    T = n_snaps(h5f,name)
+    obj = h5f[name]
+    if get_layout(h5f,name) == "sparse":
+        return densify(read_snaps_active(h5f,name,t0,t1),out=out)
+    if out is not None:
+        t = t0
+        while t < t1:
+            tw = t % T
+            n = min(t1-t, T-tw)
+            if isinstance(obj,np.ndarray):
+                out[t-t0:t-t0+n] = obj[tw:tw+n]
+            elif get_layout(h5f,name) == "timemajor":
+                obj.read_direct(out[t-t0:t-t0+n],np.s_[tw:tw+n])
+            else:
+                for i in range(n):
+                    obj[snapstr(*snap_daytg(tw+i))].read_direct(out[t-t0+i])
+            t += n
+        return out
+    if get_layout(h5f,name) == "timemajor":
+        t0w = t0 % T
+        if t0w + (t1-t0) <= T:
+            return obj[t0w:t0w+(t1-t0)]
+        parts = []
+        t = t0
+        while t < t1:
+            tw = t % T
+            n = min(t1-t, T-tw)
+            parts.append(obj[tw:tw+n])
+            t += n
+        return np.concatenate(parts)
+    return np.stack([obj[snapstr(*snap_daytg(t%T))][:] for t in range(t0,t1)])
+
+def read_snap(h5f,name,day,tg):
+    layout = get_layout(h5f,name)
+    if layout == "timemajor":
+        return h5f[name][snap_index(day,tg)]
+    if layout == "sparse":
+        t = snap_index(day,tg)
+        return read_snaps(h5f,name,t,t+1)[0]
+    return h5f[name+'/'+snapstr(day,tg)][:]
+
+def write_snaps(h5f,name,t0,arr):
+    """Write arr[i] as snapshot t0+i, overwriting what is there.
+
+    Sparse groups are append-only, t0 must be the number of snapshots
+    already written; arr may then also be a SparseBlock.
+    """
+    with tracing.span("write_snaps",group=name) as sp:
+        if isinstance(arr,SparseBlock):
+            sp.count("bytes_written",arr.values.nbytes+arr.index.nbytes)
+        else:
+            sp.count("bytes_written",arr.nbytes)
+        _write_snaps(h5f,name,t0,arr)
+
+def _write_snaps(h5f,name,t0,arr):
+    obj = h5f[name]
+    layout = get_layout(h5f,name)
+    if layout == "sparse":
+        _append_sparse(obj,t0,arr)
+        return
+    if isinstance(arr,SparseBlock):
+        arr = densify(arr)
+    if layout == "timemajor":
+        obj[t0:t0+arr.shape[0]] = arr
+        return
+    for i,a in enumerate(arr):
+        key = snapstr(*snap_daytg(t0+i))
+        if key in obj:
+            obj[key][...] = a
+        else:
+            obj.create_dataset(key,data=a,compression="gzip",compression_opts=6)
 
-    graphs_nx = utils_np.graphs_tuple_to_networkxs(graph)
+class SnapshotWindows(object):
+    """Windows of the k consecutive snapshots t..t+k-1, for t = t0..t1-1 in
+    time order, wrapping past the end of the week like read_snaps.
 
-    nodecols = graph.nodes[:,0]
-    edges = graph.edges
-    edgecols = np.zeros((len(edges),))
-    for i,e in enumerate(graphs_nx[0].edges):
-        j = np.argwhere((graph.senders==e[0]) & (graph.receivers==e[1]))
-        edgecols[i] = edges[j,0]
+    Snapshots are decoded block by block into one buffer of block+k-1 rows
+    per group; the last k-1 rows of a block are carried to the front for the
+    next one, so every snapshot is read once per pass. On a full-week pass
+    the first k-1 snapshots are kept for the windows that wrap onto them.
 
-    fig,ax = plt.subplots(figsize=(15,15))
-    nx.draw(graphs_nx[0],ax=ax,pos=node_pos_dict,node_color=nodecols,
-            edge_color=edgecols,node_size=100,
-            cmap=plt.cm.winter,edge_cmap=plt.cm.winter,
-            vmin=vmin,vmax=vmax,edge_vmin=e_vmin,edge_vmax=e_vmax,
-            arrowsize=10)
-    return fig,ax
+      for t,win in SnapshotWindows(h5f,['edge_features','node_features'],k=2):
+          edges, nodes_post = win['edge_features'][0], win['node_features'][1]
+
+    Windows (and blocks()) are views of the buffer, overwritten as the pass
+    moves on; copy what has to outlive the step.
+    """
+
+    def __init__(self,h5f,names,k=2,t0=0,t1=None,block=BLOCK_T):
+        if k < 1:
+            raise ValueError("Window length must be >= 1, got "+str(k))
+        self.h5f = h5f
+        self.names = list(names)
+        self.k = k
+        self.T = n_snaps(h5f,self.names[0])
+        self.t0 = t0
+        self.t1 = self.T if t1 is None else t1
+        self.block = block
+
+    def __len__(self):
+        return max(0,self.t1-self.t0)
+
+    def _fill(self,name,a,b,out,head):
+        # Snapshots a..b-1 into out; those past t1 of a full pass come from head
+        m = min(max(a,self.t1),b) if head is not None else b
+        if m > a:
+            read_snaps(self.h5f,name,a,m,out=out[:m-a])
+        if b > m:
+            out[m-a:] = head[m-self.t1:b-self.t1]
+        return m - a
+
+    def blocks(self):
+        """Yields (t, {name: (n,k,entity,feature) windows of t..t+n-1})."""
+        k, bufs, heads = self.k, {}, {}
+        full = self.t1 - self.t0 == self.T
+        n_prev = 0
+        with tracing.span("snapshot_windows") as sp:
+            for w0 in range(self.t0,self.t1,self.block):
+                n = min(self.block,self.t1-w0)
+                views = {}
+                for name in self.names:
+                    if name not in bufs:
+                        # A block spanning the whole week wraps onto its own
+                        # first rows, which are copied rather than read again
+                        m = min(n+k-1,max(self.T,k-1)) if full else n+k-1
+                        first = read_snaps(self.h5f,name,w0,w0+m)
+                        bufs[name] = np.empty((self.block+k-1,)+first.shape[1:],
+                                              dtype=first.dtype)
+                        bufs[name][:m] = first
+                        if full:
+                            heads[name] = first[:k-1].copy()
+                            bufs[name][m:n+k-1] = heads[name][:n+k-1-m]
+                        sp.count("snapshots_read",m)
+                    else:
+                        buf = bufs[name]
+                        buf[:k-1] = buf[n_prev:n_prev+k-1]
+                        sp.count("snapshots_read",self._fill(name,w0+k-1,w0+n+k-1,
+                                                             buf[k-1:n+k-1],heads.get(name)))
+                    views[name] = _sliding(bufs[name][:n+k-1],k)
+                n_prev = n
+                yield w0, views
+
+    def __iter__(self):
+        for w0,views in self.blocks():
+            for i in range(len(next(iter(views.values())))):
+                yield w0+i, dict((name,v[i]) for name,v in views.items())
+
+def _sliding(arr,k):
+    # (n,k,...) view of the length-k windows along axis 0 of arr
+    n = arr.shape[0] - k + 1
+    return np.lib.stride_tricks.as_strided(arr,shape=(n,k)+arr.shape[1:],
+                                           strides=(arr.strides[0],)+arr.strides,
+                                           writeable=False)
+
+# Sparse layout
+#
+# Most edges carry no cars in a given timegroup, and an edge without cars
+# has the same features every time. A sparse group stores
+#   base    (n_entity, n_feat)  the row of each entity when it is inactive
+#   indptr  (T+1,)              snapshot t's rows are index/values[indptr[t]:indptr[t+1]]
+#   index   (nnz,)              entity of each stored row
+#   values  (nnz, n_feat)       the rows that differ from base
+# so it is exact whatever the base, and its size scales with traffic rather
+# than with the network. read_snaps densifies; read_snaps_active returns the
+# active rows as a SparseBlock for kernels that only need those.
+
+SparseBlock = collections.namedtuple("SparseBlock",("indptr","index","values","base"))
+
+def _create_sparse(h5f,name,n_entity,n_feat,dtype,codec,codec_opts,base):
+    grp = h5f.create_group(name)
+    grp.attrs['layout'] = "sparse"
+    if base is None:
+        base = np.zeros((n_entity,n_feat),dtype=dtype)
+    grp.create_dataset("base",data=np.asarray(base,dtype=dtype))
+    grp.create_dataset("indptr",data=np.zeros((1,),dtype=np.int64),maxshape=(None,),
+                       chunks=(4096,))
+    kw = _codec_kwargs(codec,codec_opts)
+    rows = max(1,(1<<20)//(n_feat*np.dtype(dtype).itemsize))
+    grp.create_dataset("index",shape=(0,),dtype=np.int32,maxshape=(None,),
+                       chunks=(rows,),**kw)
+    grp.create_dataset("values",shape=(0,n_feat),dtype=dtype,maxshape=(None,n_feat),
+                       chunks=(rows,n_feat),**kw)
+    return grp
+
+def sparse_base(blk,active_col=0):
+    """Base rows for a sparse group from a (time,entity,feature) block: each
+    entity's last row with active_col == 0, or zeros if it has none."""
+    base = np.zeros(blk.shape[1:],dtype=blk.dtype)
+    for row in blk:
+        idle = row[:,active_col] == 0
+        base[idle] = row[idle]
+    return base
+
+def sparsify(arr,base):
+    """SparseBlock of the rows of arr (time,entity,feature) that differ from base."""
+    diff = np.any(arr != base[None],axis=2)
+    counts = diff.sum(axis=1)
+    indptr = np.zeros((arr.shape[0]+1,),dtype=np.int64)
+    np.cumsum(counts,out=indptr[1:])
+    t, index = np.nonzero(diff)
+    return SparseBlock(indptr,index.astype(np.int32),arr[t,index],base)
+
+def densify(blk,out=None):
+    """(time,entity,feature) array of a SparseBlock."""
+    B = blk.indptr.shape[0] - 1
+    if out is None:
+        out = np.empty((B,)+blk.base.shape,dtype=blk.base.dtype)
+    out[...] = blk.base
+    rows = np.repeat(np.arange(B),np.diff(blk.indptr))
+    out[rows,blk.index] = blk.values
+    return out
+
+def read_snaps_active(h5f,name,t0,t1):
+    """SparseBlock of snapshots t0..t1-1 (wrapping like read_snaps).
+    Dense groups are read whole and sparsified against base rows from the
+    block itself, so this only saves work on sparse groups."""
+    obj = h5f[name]
+    if get_layout(h5f,name) != "sparse":
+        arr = read_snaps(h5f,name,t0,t1)
+        return sparsify(arr,sparse_base(arr))
+    T = n_snaps(h5f,name)
+    base = obj["base"][:]
+    indptrs, indices, values = [np.zeros((1,),dtype=np.int64)], [], []
+    t = t0
+    while t < t1:
+        tw = t % T
+        n = min(t1-t, T-tw)
+        ptr = obj["indptr"][tw:tw+n+1]
+        indices.append(obj["index"][ptr[0]:ptr[-1]])
+        values.append(obj["values"][ptr[0]:ptr[-1]])
+        indptrs.append(ptr[1:] - ptr[0] + indptrs[-1][-1])
+        t += n
+    return SparseBlock(np.concatenate(indptrs),np.concatenate(indices),
+                       np.concatenate(values),base)
+
+def _same_rows(a,b):
+    # np.array_equal(a,b,equal_nan=True), which needs numpy 1.19
+    return a.shape == b.shape and bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+
+def _append_sparse(grp,t0,arr):
+    T = grp["indptr"].shape[0] - 1
+    if t0 != T:
+        raise ValueError("Sparse groups are append-only: writing snapshot "
+                         +str(t0)+" after "+str(T))
+    base = grp["base"][:]
+    if not isinstance(arr,SparseBlock):
+        arr = sparsify(arr,base)
+    elif not _same_rows(arr.base,base):
+        arr = sparsify(densify(arr),base)
+    nnz0 = grp["indptr"][T]
+    nnz = arr.index.shape[0]
+    B = arr.indptr.shape[0] - 1
+    grp["indptr"].resize((T+B+1,))
+    grp["indptr"][T+1:] = nnz0 + arr.indptr[1:]
+    grp["index"].resize((nnz0+nnz,))
+    grp["index"][nnz0:] = arr.index
+    grp["values"].resize((nnz0+nnz,arr.values.shape[1]))
+    grp["values"][nnz0:] = arr.values
+
+def _read_block(h5f,name,t0,t1):
+    # What the preprocessing kernels take: a SparseBlock for sparse groups,
+    # else the dense block
+    if get_layout(h5f,name) == "sparse":
+        return read_snaps_active(h5f,name,t0,t1)
+    return read_snaps(h5f,name,t0,t1)
+
+def _as_dense(blk):
+    return densify(blk) if isinstance(blk,SparseBlock) else blk
+
+def active_rows(blk,col=0):
+    """Per snapshot of a block, (entity ids, rows) of the entities with
+    row[col] > 0. On a SparseBlock only the stored rows are looked at."""
+    if isinstance(blk,SparseBlock) and not np.any(blk.base[:,col] > 0):
+        for a,b in zip(blk.indptr[:-1],blk.indptr[1:]):
+            vals = blk.values[a:b]
+            keep = vals[:,col] > 0
+            yield blk.index[a:b][keep], vals[keep]
+        return
+    for arr in _as_dense(blk):
+        act = np.flatnonzero(arr[:,col] > 0)
+        yield act, arr[act]
+
+def _derive(blk,param,fn):
+    # Row-wise feature derivation (_edge_nn_features/_node_nn_features),
+    # applied to the stored rows and base of a SparseBlock
+    if isinstance(blk,SparseBlock):
+        return blk._replace(values=fn(blk.values,param[blk.index]),base=fn(blk.base,param))
+    return fn(blk,param)
+
+def _norm_block(blk,mus,stds):
+    if isinstance(blk,SparseBlock):
+        return blk._replace(values=mynorm(blk.values,mus,stds,out=blk.values),
+                            base=mynorm(blk.base,mus,stds))
+    return mynorm(blk,mus,stds)
+
+def _update_moments(mom,blk):
+    # Base rows count once for every snapshot their entity is not stored
+    if isinstance(blk,SparseBlock):
+        B = blk.indptr.shape[0] - 1
+        stored = np.bincount(blk.index,minlength=blk.base.shape[0])
+        mom.update(blk.base,weights=B-stored)
+        return mom.update(blk.values)
+    return mom.update(blk)
+
+SNAP_GROUPS = ("edge_features","node_features","glbl_features",
+               "nn_edge_features","nn_node_features","nn_glbl_features")
+SPARSE_GROUPS = ("edge_features","node_features")
+
+def convert_layout(h5_name,dst_name=None,groups=SNAP_GROUPS,codec="gzip",
+                   codec_opts=None,chunks=None,layout="timemajor"):
+    """Convert feature groups to the time-major (or sparse) layout.
+
+    With dst_name, everything is written to a new file (the only way to get
+    the space back; HDF5 does not shrink files on delete). Otherwise the
+    groups are replaced in place. For layout="sparse", base rows come from
+    the first block of snapshots (see sparse_base); SPARSE_GROUPS are the
+    groups worth storing that way.
+    """
+    src = h5py.File(h5_name,'r' if dst_name else 'a')
+    dst = h5py.File(dst_name,'w') if dst_name else src
+    if dst_name:
+        for key,val in src.attrs.items():
+            dst.attrs[key] = val
+        for key in src:
+            if key in groups and get_layout(src,key) != layout:
+                continue
+            src.copy(src[key],dst,name=key)
+
+    for name in groups:
+        if name not in src or get_layout(src,name) == layout:
+            continue
+        T = n_snaps(src,name)
+        first = read_snaps(src,name,0,min(BLOCK_T,T))
+        base = sparse_base(first) if layout == "sparse" else None
+        tmpname = name if dst_name else name+"__"+layout
+        create_snapset(dst,tmpname,T,first.shape[1],first.shape[2],
+                       dtype=first.dtype,layout=layout,codec=codec,
+                       codec_opts=codec_opts,chunks=chunks,base=base)
+        print("Converting",name)
+        for t0 in tracing.progress(range(0,T,BLOCK_T),"convert_layout.block"):
+            t1 = min(t0+BLOCK_T,T)
+            write_snaps(dst,tmpname,t0,read_snaps(src,name,t0,t1))
+        if not dst_name:
+            del src[name]
+            src.move(tmpname,name)
+
+    if dst_name:
+        dst.close()
+    src.close()
+
+# Resumable preprocessing
+#
+# Each snapshot gets a fingerprint of its raw edge/node/glbl features.
+# The running accumulators of EdgeNodeCovariance and CalcMFactor are
+# checkpointed under resume/<stage> together with the fingerprints of the
+# snapshots folded in so far; a later run with resume=True continues from
+# the checkpoint if those snapshots are unchanged (after a crash, or when
+# snapshots were appended) and starts over otherwise. create_nn_inputset
+# records, per snapshot, a fingerprint of everything its output depends on
+# in resume/nn_done and only rewrites the snapshots whose record is stale.
+
+CHECKPOINT_BLOCKS = 16 # blocks between accumulator checkpoints
+
+def snapshot_digests(h5f,t0=0,t1=None):
+    """uint64 fingerprint of the raw features of each snapshot t0..t1-1."""
+    t1 = n_snaps(h5f,'edge_features') if t1 is None else t1
+    digests = np.zeros((t1-t0,),dtype=np.uint64)
+    for b0 in range(t0,t1,BLOCK_T):
+        b1 = min(b0+BLOCK_T,t1)
+        blks = [read_snaps(h5f,grp,b0,b1) for grp in
+                ('edge_features','node_features','glbl_features')]
+        for i in range(b1-b0):
+            digests[b0-t0+i] = _digest_int(*[blk[i] for blk in blks])
+    return digests
+
+def _digest_int(*arrays):
+    h = hashlib.blake2b(digest_size=8)
+    for arr in arrays:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return np.uint64(int.from_bytes(h.digest(),'little'))
+
+def save_checkpoint(h5f,stage,state,n_done,digests,key=""):
+    """Store accumulator arrays after the first n_done snapshot pairs.
+    Pair t reads snapshots t and t+1, so digests[:n_done+1] are kept."""
+    path = "resume/"+stage
+    if path in h5f:
+        del h5f[path]
+    grp = h5f.create_group(path)
+    for name,arr in state.items():
+        grp.create_dataset(name,data=arr)
+    grp.create_dataset("digests",data=digests[:n_done+1])
+    grp.attrs['n_done'] = n_done
+    grp.attrs['key'] = key
+    h5f.flush()
+
+def load_checkpoint(h5f,stage,digests,key=""):
+    """(state, n_done) from the stage's checkpoint, or (None, 0) if there is
+    none or the snapshots it covers have changed since."""
+    path = "resume/"+stage
+    if path not in h5f:
+        return None, 0
+    grp = h5f[path]
+    n_done = int(grp.attrs['n_done'])
+    stored = grp["digests"][:]
+    if (grp.attrs['key'] != key or len(stored) != n_done+1
+            or len(digests) < n_done+1 or np.any(stored != digests[:n_done+1])):
+        print(stage,"inputs changed since the checkpoint, starting over")
+        return None, 0
+    return {name: grp[name][:] for name in grp if name != "digests"}, n_done
 
 def snap2graph(h5file,day,tg,use_tf=False,placeholder=False,name=None,normalize=True):
-    snapstr = 'day'+str(day)+'tg'+str(tg)
     if normalize:
-        edges = h5file['nn_edge_features/'+snapstr]
-        nodes = h5file['nn_node_features/'+snapstr]
-        glbls = h5file['nn_glbl_features/'+snapstr]
+        edges = read_snap(h5file,'nn_edge_features',day,tg)
+        nodes = read_snap(h5file,'nn_node_features',day,tg)
+        glbls = read_snap(h5file,'nn_glbl_features',day,tg)
     else:
-        edges = h5file['nn_edge_features/'+snapstr]
-        nodes = h5file['node_features/'+snapstr]
-        glbls = h5file['glbl_features/'+snapstr]
+        edges = read_snap(h5file,'nn_edge_features',day,tg)
+        nodes = read_snap(h5file,'node_features',day,tg)
+        glbls = read_snap(h5file,'glbl_features',day,tg)
     senders = h5file['senders']
     receivers = h5file['receivers']
     
-    node_arr = nodes[:]
-    edge_arr = edges[:]
+    node_arr = nodes
+    edge_arr = edges
     glbl_arr = glbls[0]
 
     graphdat_dict = {
-        "globals": glbl_arr.astype(np.float),
-        "nodes": node_arr.astype(np.float),
-        "edges": edge_arr.astype(np.float),
+        "globals": glbl_arr.astype(FLOAT_DTYPE),
+        "nodes": node_arr.astype(FLOAT_DTYPE),
+        "edges": edge_arr.astype(FLOAT_DTYPE),
         "senders": senders[:],
         "receivers": receivers[:],
         "n_node": node_arr.shape[0],
@@ -285,7 +971,130 @@ def snap2graph(h5file,day,tg,use_tf=False,placeholder=False,name=None,normalize=
             
     return graphs_tuple
 
-def EdgeNodeCovariance(h5_name):
+# Static topology per open file, read once. Keyed on the file's name,
+# so call clear_topology_cache() if senders/receivers are rewritten.
+_topology_cache = {}
+
+def get_topology(h5file):
+    key = h5file.filename
+    if key not in _topology_cache:
+        senders = h5file['senders'][:]
+        receivers = h5file['receivers'][:]
+        senders.flags.writeable = False
+        receivers.flags.writeable = False
+        _topology_cache[key] = {"senders": senders, "receivers": receivers,
+                                "n_node": int(h5file.attrs['n_nodes']),
+                                "offsets": {}}
+    return _topology_cache[key]
+
+def clear_topology_cache():
+    _topology_cache.clear()
+
+def batch_topology(topo,nbatch):
+    """senders/receivers for nbatch stacked copies of the graph, cached per size."""
+    if nbatch not in topo["offsets"]:
+        off = topo["n_node"]*np.arange(nbatch)[:,None]
+        senders = (topo["senders"][None,:] + off).ravel()
+        receivers = (topo["receivers"][None,:] + off).ravel()
+        senders.flags.writeable = False
+        receivers.flags.writeable = False
+        topo["offsets"][nbatch] = (senders,receivers)
+    return topo["offsets"][nbatch]
+
+def _read_times(h5f,name,ts,out=None):
+    # Contiguous runs go through read_snaps, anything else is gathered
+    ts = np.asarray(ts)
+    if out is not None:
+        breaks = np.flatnonzero(np.diff(ts) != 1) + 1
+        for run in np.split(np.arange(len(ts)),breaks):
+            read_snaps(h5f,name,int(ts[run[0]]),int(ts[run[-1]])+1,
+                       out=out[run[0]:run[-1]+1])
+        return out
+    if ts.size and np.all(np.diff(ts) == 1):
+        return read_snaps(h5f,name,int(ts[0]),int(ts[-1])+1)
+    # Repeated times (e.g. the t and t+1 halves of a pair batch) are read once
+    uniq, inv = np.unique(ts,return_inverse=True)
+    if uniq.size and uniq[-1] - uniq[0] == uniq.size - 1:
+        return read_snaps(h5f,name,int(uniq[0]),int(uniq[-1])+1)[inv]
+    if get_layout(h5f,name) == "timemajor":
+        return h5f[name][list(uniq)][inv]
+    return np.stack([read_snap(h5f,name,*snap_daytg(t)) for t in uniq])[inv]
+
+def snaps2graph(h5file,daytgs,use_tf=False,placeholder=False,name=None,normalize=True,
+                out=None):
+    """Batched snap2graph. Returns one GraphsTuple holding len(daytgs) graphs.
+
+    daytgs is a sequence of (day,tg) pairs, or a range/array of time indices.
+    With placeholder=True the placeholders have a dynamic number of graphs,
+    so any batch size from this function can be fed to them.
+    out is a GraphsTuple from an earlier call with the same batch size; its
+    feature arrays are refilled in place and it is returned (numpy only).
+    """
+    with tracing.span("snaps2graph",graphs=len(daytgs)):
+        return _snaps2graph(h5file,daytgs,use_tf,placeholder,name,normalize,out)
+
+def _snaps2graph(h5file,daytgs,use_tf,placeholder,name,normalize,out):
+    daytgs = np.asarray(daytgs)
+    if daytgs.ndim == 2:
+        ts = daytgs[:,0]*NTG + daytgs[:,1]
+    else:
+        ts = daytgs
+    nbatch = len(ts)
+    topo = get_topology(h5file)
+
+    if out is not None:
+        e_name, n_name, g_name = (('nn_edge_features','nn_node_features','nn_glbl_features')
+                                  if normalize else
+                                  ('nn_edge_features','node_features','glbl_features'))
+        n_node, n_edge = out.n_node[0], out.n_edge[0]
+        _read_times(h5file,e_name,ts,out=out.edges.reshape(nbatch,n_edge,-1))
+        _read_times(h5file,n_name,ts,out=out.nodes.reshape(nbatch,n_node,-1))
+        _read_times(h5file,g_name,ts,out=out.globals.reshape(nbatch,1,-1))
+        return out
+
+    if normalize:
+        edges = _read_times(h5file,'nn_edge_features',ts)
+        nodes = _read_times(h5file,'nn_node_features',ts)
+        glbls = _read_times(h5file,'nn_glbl_features',ts)
+    else:
+        edges = _read_times(h5file,'nn_edge_features',ts)
+        nodes = _read_times(h5file,'node_features',ts)
+        glbls = _read_times(h5file,'glbl_features',ts)
+    n_node, n_edge = nodes.shape[1], edges.shape[1]
+    senders, receivers = batch_topology(topo,nbatch)
+
+    graphs_tuple = graphs.GraphsTuple(
+        nodes=np.asarray(nodes.reshape(nbatch*n_node,-1),dtype=FLOAT_DTYPE),
+        edges=np.asarray(edges.reshape(nbatch*n_edge,-1),dtype=FLOAT_DTYPE),
+        globals=np.asarray(glbls.reshape(nbatch,-1),dtype=FLOAT_DTYPE),
+        senders=senders,
+        receivers=receivers,
+        n_node=np.full(nbatch,n_node,dtype=np.int32),
+        n_edge=np.full(nbatch,n_edge,dtype=np.int32))
+
+    if not use_tf:
+        return graphs_tuple
+    if placeholder:
+        name = "placeholders_from_data_dicts" if not name else name
+        return utils_tf.placeholders_from_data_dicts(
+            utils_np.graphs_tuple_to_data_dicts(utils_np.get_graph(graphs_tuple,0)),
+            force_dynamic_num_graphs=True,name=name)
+    name = "tuple_from_graphs_tuple" if not name else name
+    with tf.name_scope(name):
+        return graphs_tuple.map(tf.convert_to_tensor,fields=graphs.ALL_FIELDS)
+
+def EdgeNodeCovariance(h5_name,engine="stream",resume=False,digests=None):
+    """Covariance between each edge's features and its receiver's features
+    on the following timegroup, over the snapshots where the edge has cars.
+
+    engine="stream" keeps per-edge running co-moments, O(nedge) memory.
+    engine="dense" is the original gather-then-np.cov implementation.
+    resume=True (stream only) checkpoints the co-moments and continues from
+    the last checkpoint, see save_checkpoint. digests are the
+    snapshot_digests of the file, computed here if not given.
+    """
+    if resume and engine != "stream":
+        raise ValueError("resume needs engine=\"stream\"")
     h5f = h5py.File(h5_name,'a')
     try:
         covs = h5f['edge_node_covs']
@@ -296,34 +1105,36 @@ def EdgeNodeCovariance(h5_name):
     receivers = h5f['receivers']
     nedge = senders.shape[0]
     h5_cov = h5f.create_dataset("edge_node_covs",compression="gzip",
-                                compression_opts=6,shape=(nedge,3),dtype=np.double)
-    
+                                compression_opts=6,shape=(nedge,3),dtype=ACC_DTYPE)
+
+    if engine == "stream":
+        h5_cov[:] = _edge_node_covs_stream(h5f,resume,digests)
+        h5f.close()
+        return
+    elif engine != "dense":
+        h5f.close()
+        raise ValueError("Unknown engine "+str(engine))
+
     # Iterate over senders and edges
     # Note that these arrays have corresponding indices
     # Each edge-node pair will have 7*NTG data points, gather these.
     # We will have an array of shape=(nedge,2,3,2,7*NTG)
     # First 2 is for send/receive nodes, and second 2 is for x,y data
-    np_dat = np.zeros(shape=(nedge,7*NTG,2,3),dtype=np.float)
-
-    t = 0
-    for day in range(7):
-        for tg in progressbar(range(0,NTG)):
-            tg_post = (tg+1)%NTG
-            day_post = day
-            if tg == (NTG-1):
-                day_post = (day+1)%7
-            edges = h5f['edge_features/day'+str(day)+'tg'+str(tg)]
-            send_idxs = np.argwhere(edges[:,0] > 0).flatten()
-            nodes_post = h5f['node_features/day'+str(day_post)+'tg'+str(tg_post)]
-
-            for i in send_idxs:
-                s,r = senders[i], receivers[i]
-                edge = edges[i]
-                x = edge[:3]
-                y = nodes_post[r]
-
-                np_dat[i,t] = np.array([x,y])
-            t += 1
+    np_dat = np.zeros(shape=(nedge,7*NTG,2,3),dtype=ACC_DTYPE)
+
+    windows = SnapshotWindows(h5f,['edge_features','node_features'],k=2,t1=7*NTG)
+    for t,win in tracing.progress(windows,"edge_node_covs.dense_tg"):
+        edges = win['edge_features'][0]
+        send_idxs = np.argwhere(edges[:,0] > 0).flatten()
+        nodes_post = win['node_features'][1]
+
+        for i in send_idxs:
+            s,r = senders[i], receivers[i]
+            edge = edges[i]
+            x = edge[:3]
+            y = nodes_post[r]
+
+            np_dat[i,t] = np.array([x,y])
 
     for i in range(nedge):
         covs = []
@@ -336,304 +1147,722 @@ def EdgeNodeCovariance(h5_name):
 
     h5f.close()
 
-def CalcMFactor(h5_name):
+def _edge_node_covs_stream(h5f,resume=False,digests=None):
+    # Welford-style co-moment update, applied only to the edges that
+    # carry cars in each snapshot. Same result as np.cov(ddof=1) per edge.
+    receivers = h5f['receivers'][:]
+    nedge = receivers.shape[0]
+    T = n_snaps(h5f,'edge_features')
+    state, n_done = None, 0
+    if resume:
+        digests = snapshot_digests(h5f) if digests is None else digests
+        state, n_done = load_checkpoint(h5f,"edge_node_covs",digests)
+    if state is None:
+        state = {"k": np.zeros((nedge,),dtype=np.int64),
+                 "mean_x": np.zeros((nedge,3),dtype=ACC_DTYPE),
+                 "mean_y": np.zeros((nedge,3),dtype=ACC_DTYPE),
+                 "comom": np.zeros((nedge,3),dtype=ACC_DTYPE)}
+
+    # Every pair but the wrap-around (T-1, 0), which changes when snapshots
+    # are appended, so it is only folded into the result below
+    for i,t0 in enumerate(tracing.progress(range(n_done,T-1,BLOCK_T),
+                                           "edge_node_covs.block")):
+        t1 = min(t0+BLOCK_T,T-1)
+        edge_blk = _read_block(h5f,'edge_features',t0,t1)
+        node_blk = read_snaps(h5f,'node_features',t0+1,t1+1)
+        with tracing.span("edge_node_covs.welford") as sp:
+            sp.count("snapshots",t1-t0)
+            _covs_block_update(edge_blk,node_blk,receivers,**state)
+        if resume and (i+1) % CHECKPOINT_BLOCKS == 0:
+            save_checkpoint(h5f,"edge_node_covs",state,t1,digests)
+    if resume:
+        save_checkpoint(h5f,"edge_node_covs",state,max(T-1,0),digests)
+
+    k, mean_x, mean_y, comom = (state[name].copy() for name in
+                                ("k","mean_x","mean_y","comom"))
+    _covs_block_update(_read_block(h5f,'edge_features',T-1,T),
+                       read_snaps(h5f,'node_features',T,T+1),
+                       receivers,k,mean_x,mean_y,comom)
+
+    covs = np.zeros((nedge,3),dtype=ACC_DTYPE)
+    ok = k >= 2
+    covs[ok] = comom[ok]/(k[ok,None] - 1)
+    return covs
+
+def _covs_block_update(edge_blk,node_blk,receivers,k,mean_x,mean_y,comom):
+    # Welford co-moment update for every snapshot in a block, in place.
+    # edge_blk may be a SparseBlock, only edges with cars are touched.
+    for (act,edges),nodes_post in zip(active_rows(edge_blk),node_blk):
+        if act.size == 0: continue
+        x = edges[:,:3]
+        y = nodes_post[receivers[act],:3]
+
+        k[act] += 1
+        kk = k[act][:,None]
+        dx = x - mean_x[act]
+        mean_x[act] += dx/kk
+        mean_y[act] += (y - mean_y[act])/kk
+        comom[act] += dx*(y - mean_y[act])
+
+def CalcMFactor(h5_name,engine="vectorized",legacy_diff=False,resume=False,
+                digests=None):
+    """Running mean, per node, of (cars at node on t+1) - (cars on its
+    incoming edges at t), over the snapshots where either is nonzero.
+
+    engine="vectorized" does one segmented reduction over receivers per
+    block of snapshots and updates M as an array op. engine="loop" is the
+    original per-node loop, kept as the reference implementation.
+    legacy_diff=True reproduces the old behaviour of differencing against
+    ncars_n[0] (the first node) instead of each node's own count.
+    resume=True (vectorized only) checkpoints the running mean, as in
+    EdgeNodeCovariance.
+    """
+    if resume and engine != "vectorized":
+        raise ValueError("resume needs engine=\"vectorized\"")
     h5f = h5py.File(h5_name,'a')
+    if engine == "vectorized":
+        M_np = _mfactor_vectorized(h5f,legacy_diff,resume,digests)
+    elif engine == "loop":
+        M_np = _mfactor_loop(h5f,legacy_diff)
+    else:
+        h5f.close()
+        raise ValueError("Unknown engine "+str(engine))
+
+    try:
+        h5f.create_dataset('M',data=M_np,compression="gzip",compression_opts=6)
+    except:
+        del h5f['M']
+        h5f.create_dataset('M',data=M_np,compression="gzip",compression_opts=6)
+
+    h5f.close()
+    return
+
+def _mfactor_loop(h5f,legacy_diff=False):
     senders = h5f['senders'][:]
     receivers = h5f['receivers'][:]
     n_node = h5f.attrs['n_nodes']
-    M_np = np.zeros((n_node),dtype=np.float)
-    ks = np.ones((n_node),dtype=np.float)
+    M_np = np.zeros((n_node),dtype=ACC_DTYPE)
+    ks = np.ones((n_node),dtype=ACC_DTYPE)
 
     # Create lookup table of senders for each node
     send_edges = {}
     for i in range(n_node):
         send_edges.update({i: np.argwhere(receivers==i).flatten()})
 
-    for day in range(7):
-        for tg in progressbar(range(NTG)):
-            tg_post = (tg+1)%NTG
-            day_post = day
-            if tg == (NTG-1):
-                day_post = (day+1)%7
-            nodes_post = h5f['node_features/day'+str(day_post)+'tg'+str(tg_post)]
-            edges = h5f['edge_features/day'+str(day)+'tg'+str(tg)]
-
-            ncars_n = nodes_post[:,0]
-            ncars_e = edges[:,0]
-            for i in range(n_node):
-                ncar_e = 0
-                for i_send in send_edges[i]:
-                    #j = list(set(np.where(senders==sender)[0]) & set(np.where(receivers==i)[0]))
-                    #assert len(j)==1
-                    #ncar_e += int(j_edge[0])
-                    ncar_e += ncars_e[i_send]
-
-                if (ncar_e==0) and (ncars_n[i]==0):
-                    # Nothing happening, skip this data
-                    continue
-                diff = ncars_n[0] - ncar_e
-                M_np[i] = M_np[i] + (diff - M_np[i])/ks[i]
-                ks[i] += 1
+    windows = SnapshotWindows(h5f,['edge_features','node_features'],k=2)
+    for t,win in tracing.progress(windows,"mfactor.loop_tg"):
+        ncars_n = win['node_features'][1][:,0]
+        ncars_e = win['edge_features'][0][:,0]
+        for i in range(n_node):
+            ncar_e = 0
+            for i_send in send_edges[i]:
+                ncar_e += ncars_e[i_send]
+
+            if (ncar_e==0) and (ncars_n[i]==0):
+                # Nothing happening, skip this data
+                continue
+            diff = (ncars_n[0] if legacy_diff else ncars_n[i]) - ncar_e
+            M_np[i] = M_np[i] + (diff - M_np[i])/ks[i]
+            ks[i] += 1
+
+    return M_np
+
+def _incoming_cars(ncars_e,receivers,n_node,seg=None):
+    """Sum edge car counts into their receiving nodes.
+
+    ncars_e has shape (B,n_edge) for a block of B snapshots; returns (B,n_node).
+    seg, the flattened segment ids, can be passed in when B is fixed.
+    """
+    nblock = ncars_e.shape[0]
+    if seg is None:
+        seg = (receivers[None,:] + n_node*np.arange(nblock)[:,None]).ravel()
+    return np.bincount(seg,weights=ncars_e.ravel(),
+                       minlength=nblock*n_node).reshape(nblock,n_node)
+
+def _incoming_cars_block(blk,receivers,n_node):
+    # _incoming_cars of a block's car counts; for a SparseBlock only the
+    # stored edges are summed
+    if isinstance(blk,SparseBlock) and not np.any(blk.base[:,0]):
+        B = blk.indptr.shape[0] - 1
+        rows = np.repeat(np.arange(B),np.diff(blk.indptr))
+        return np.bincount(receivers[blk.index] + n_node*rows,weights=blk.values[:,0],
+                           minlength=B*n_node).reshape(B,n_node)
+    return _incoming_cars(_as_dense(blk)[:,:,0],receivers,n_node)
+
+def _mfactor_update(M_np,counts,ncars_n,ncars_e,legacy_diff=False):
+    # Fold a block of snapshots into the running mean in one step.
+    # Merging the block's sum and count is the same running mean as
+    # updating one snapshot at a time.
+    active = (ncars_e != 0) | (ncars_n != 0)
+    if legacy_diff:
+        diff = ncars_n[:,:1] - ncars_e
+    else:
+        diff = ncars_n - ncars_e
+    c = active.sum(axis=0)
+    tot = np.where(active,diff,0.).sum(axis=0)
+    counts += c
+    upd = c > 0
+    M_np[upd] += (tot[upd] - c[upd]*M_np[upd])/counts[upd]
+
+def _mfactor_vectorized(h5f,legacy_diff=False,resume=False,digests=None):
+    receivers = h5f['receivers'][:]
+    n_node = h5f.attrs['n_nodes']
+    T = n_snaps(h5f,'edge_features')
+    key = "legacy_diff" if legacy_diff else ""
+    state, n_done = None, 0
+    if resume:
+        digests = snapshot_digests(h5f) if digests is None else digests
+        state, n_done = load_checkpoint(h5f,"mfactor",digests,key)
+    if state is None:
+        state = {"M": np.zeros((n_node,),dtype=ACC_DTYPE),
+                 "counts": np.zeros((n_node,),dtype=np.int64)}
+
+    def update(t0,t1,M_np,counts):
+        edge_blk = _read_block(h5f,'edge_features',t0,t1)
+        ncars_n = read_snaps(h5f,'node_features',t0+1,t1+1)[:,:,0]
+        with tracing.span("mfactor.segment_sum"):
+            ncars_e = _incoming_cars_block(edge_blk,receivers,n_node)
+        with tracing.span("mfactor.update") as sp:
+            sp.count("snapshots",t1-t0)
+            _mfactor_update(M_np,counts,ncars_n,ncars_e,legacy_diff)
+
+    # As in _edge_node_covs_stream, the wrap-around pair is left out of
+    # the checkpointed state. So is a ragged last block: a block's merged
+    # mean rounds differently from its parts', so after an append it is
+    # redone whole, exactly as a fresh run would
+    n_whole = n_done + (max(T-1,0)-n_done)//BLOCK_T*BLOCK_T
+    for i,t0 in enumerate(tracing.progress(range(n_done,n_whole,BLOCK_T),"mfactor.block")):
+        t1 = t0+BLOCK_T
+        update(t0,t1,state["M"],state["counts"])
+        if resume and (i+1) % CHECKPOINT_BLOCKS == 0:
+            save_checkpoint(h5f,"mfactor",state,t1,digests,key)
+    if resume:
+        save_checkpoint(h5f,"mfactor",state,n_whole,digests,key)
+
+    M_np, counts = state["M"].copy(), state["counts"].copy()
+    if n_whole < T-1:
+        update(n_whole,T-1,M_np,counts)
+    update(T-1,T,M_np,counts)
+    return M_np
+
+def _edge_nn_features(edges,covs):
+    # edges is (B,n_edge,4), covs is (n_edge,3)
+    e_fts = np.zeros(edges.shape[:-1]+(13,),dtype=FLOAT_DTYPE)
+    e_fts[...,:4] = edges
+    e_fts[...,4:7] = covs
+    e_fts[...,7:10] = covs*edges[...,:3]
+    e_fts[...,10] = edges[...,0]*edges[...,1]
+    e_fts[...,11] = (DTG/60.)*edges[...,1]/edges[...,3]
+    e_fts[...,12] = e_fts[...,11] * edges[...,0]
+    return e_fts
+
+def _node_nn_features(nodes,M):
+    # nodes is (B,n_node,3), M is (n_node,)
+    n_fts = np.zeros(nodes.shape[:-1]+(4,),dtype=FLOAT_DTYPE)
+    n_fts[...,:3] = nodes
+    n_fts[...,3] = M
+    return n_fts
+
+NN_GROUPS = (("nn_edge_features",13),("nn_node_features",4),("nn_glbl_features",2))
+
+def _nn_group_sizes(h5f):
+    return {"nn_edge_features": h5f.attrs['n_edges'],
+            "nn_node_features": h5f.attrs['n_nodes'],
+            "nn_glbl_features": 1}
+
+def _glbl_norm_stats():
+    # [mean, std] rows like node_stats/edge_stats; columns are day, tg
+    return np.array([[3.0, np.mean(range(NTG))],
+                     [2.0, np.std(range(NTG))]])
+
+def _array_digest(*arrays):
+    h = hashlib.blake2b(digest_size=8)
+    for arr in arrays:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+def nn_feature_moments(h5f,covs,M,t0=0,t1=None,edge_mom=None,node_mom=None):
+    """Exact moments of the derived nn edge/node features over snapshots
+    t0..t1-1, computed from the raw features one block at a time."""
+    t1 = n_snaps(h5f,'edge_features') if t1 is None else t1
+    edge_mom = Moments(13) if edge_mom is None else edge_mom
+    node_mom = Moments(4) if node_mom is None else node_mom
+    for b0 in range(t0,t1,BLOCK_T):
+        b1 = min(b0+BLOCK_T,t1)
+        edges = _read_block(h5f,'edge_features',b0,b1)
+        nodes = _read_block(h5f,'node_features',b0,b1)
+        with tracing.span("nn_moments.derive"):
+            e_fts = _derive(edges,covs,_edge_nn_features)
+            n_fts = _derive(nodes,M,_node_nn_features)
+        with tracing.span("nn_moments.update") as sp:
+            sp.count("snapshots",b1-b0)
+            _update_moments(edge_mom,e_fts)
+            _update_moments(node_mom,n_fts)
+    return edge_mom, node_mom
+
+def _save_moments(h5f,edge_mom,node_mom,n_snap,digest,digests):
+    # Kept alongside the stats so appended weeks can be folded in later,
+    # with the fingerprints of the snapshots they cover
+    for name,mom in (("edge_moments",edge_mom),("node_moments",node_mom)):
+        if name in h5f:
+            del h5f[name]
+        dset = h5f.create_dataset(name,data=mom.to_array())
+        dset.attrs['n_snaps'] = n_snap
+        dset.attrs['inputs_digest'] = digest
+    if "moments_digests" in h5f:
+        del h5f["moments_digests"]
+    h5f.create_dataset("moments_digests",data=digests[:n_snap])
+
+def _load_moments(h5f,digest,digests):
+    # Returns (edge_mom, node_mom, n_snaps), or fresh moments if the stored
+    # ones are missing, were computed against different covs/M, or cover
+    # snapshots whose raw features (digests) have changed since
+    try:
+        e_dset, n_dset = h5f['edge_moments'], h5f['node_moments']
+        n_done = int(e_dset.attrs['n_snaps'])
+        stored = h5f['moments_digests'][:]
+        if (e_dset.attrs['inputs_digest'] == digest and len(stored) == n_done
+                and n_done <= len(digests) and np.all(stored == digests[:n_done])):
+            return Moments.from_array(e_dset[:]),Moments.from_array(n_dset[:]),n_done
+    except KeyError:
+        pass
+    return Moments(13), Moments(4), 0
 
+def _write_norm_stats(h5f,node_stats,edge_stats,glbl_stats):
     try:
-        h5f.create_dataset('M',data=M_np,compression="gzip",compression_opts=6)
+        h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
+        h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
+        h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
     except:
-        del h5f['M']
-        h5f.create_dataset('M',data=M_np,compression="gzip",compression_opts=6)
-
-    return
-
+        del h5f['node_stats'], h5f['edge_stats'], h5f['glbl_stats']
+        h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
+        h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
+        h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
 
-    
-def create_nn_inputset(h5_name):
+def _nn_groups(keep_unnormed=False):
+    groups = list(NN_GROUPS)
+    if keep_unnormed:
+        groups += [(grp+"_unnormed",n_ft) for grp,n_ft in NN_GROUPS[:2]]
+    return groups
+
+def _nn_block(h5f,covs,M,t0,t1,stats,keep_unnormed=False):
+    # Derive and normalize one block of snapshots; returns {group: array}
+    # Sparse raw groups stay sparse through derive and normalize
+    edges = _read_block(h5f,'edge_features',t0,t1)
+    nodes = _read_block(h5f,'node_features',t0,t1)
+    g_blk = read_snaps(h5f,'glbl_features',t0,t1)
+    with tracing.span("nn_block.derive"):
+        e_blk = _derive(edges,covs,_edge_nn_features)
+        n_blk = _derive(nodes,M,_node_nn_features)
+    out = {}
+    if keep_unnormed:
+        out["nn_edge_features_unnormed"] = e_blk
+        out["nn_node_features_unnormed"] = n_blk
+        e_blk = _copy_block(e_blk)
+        n_blk = _copy_block(n_blk)
+    with tracing.span("nn_block.normalize") as sp:
+        sp.count("snapshots",t1-t0)
+        for grp,blk in (("nn_edge_features",e_blk),("nn_node_features",n_blk),
+                        ("nn_glbl_features",g_blk)):
+            out[grp] = _norm_block(blk,stats[grp][0,:],stats[grp][1,:])
+    return out
+
+def _copy_block(blk):
+    if isinstance(blk,SparseBlock):
+        return blk._replace(values=blk.values.copy())
+    return blk
+
+def _norm_stats_dict(node_stats,edge_stats,glbl_stats):
+    return {"nn_node_features": node_stats, "nn_edge_features": edge_stats,
+            "nn_glbl_features": glbl_stats}
+
+def create_nn_inputset(h5_name,layout=None,codec="gzip",codec_opts=None,chunks=None,
+                       workers=1,stats=None,keep_unnormed=False,resume=False,
+                       digests=None):
+    """Build the normalized nn_*_features groups from the raw features.
+
+    Norm stats come from a read-only pass over the raw features (skipped when
+    the stored moments are still current), or from stats=(node_stats,
+    edge_stats). Stored moments are current if covs, M and the raw
+    snapshots they cover are unchanged; digests (snapshot_digests of the
+    file) are computed here if not given. Each snapshot is then derived, normalized and written once.
+    keep_unnormed also writes nn_{edge,node}_features_unnormed.
+
+    layout defaults to that of edge_features (time-major if that is sparse); codec/codec_opts/chunks are
+    used for time-major output (see create_snapset).
+    workers>1 shards the snapshots over a process pool, see _create_nn_parallel.
+    layout="sparse" writes the nn edge/node groups as sparse groups (the
+    globals stay time-major); sparse raw features are derived and normalized
+    without being densified. It needs workers=1 and resume=False.
+    resume=True keeps the existing output and only rewrites the snapshots
+    whose raw features, covs, M or norm stats changed since they were
+    written (see resume/nn_done). Appended snapshots usually change covs and
+    M, and with them every snapshot.
+    """
+    if resume and workers > 1:
+        raise ValueError("resume needs workers=1")
+    if layout == "sparse" and (resume or workers > 1):
+        raise ValueError("sparse output needs workers=1 and resume=False")
     h5f = h5py.File(h5_name,'a')
 
     try:
-        covs = h5f['edge_node_covs']
+        covs = h5f['edge_node_covs'][:]
     except:
         print("edge_node_covs DNE, exiting.")
         h5f.close()
         return
 
     try:
-        M = h5f['M']
+        M = h5f['M'][:]
     except:
         print("M factor dataset DNE, exiting.")
         h5f.close()
         return
 
-    try:
-        nn_edgegroup = h5f.create_group("nn_edge_features")
-    except:
-        print("nn_edge_features group already exists. Overwriting")
-        del h5f['nn_edge_features']
-        nn_edgegroup = h5f.create_group("nn_edge_features")
-    try:
-        nn_nodegroup = h5f.create_group("nn_node_features")
-    except:
-        print("nn_node_features group already exists. Overwriting")
-        del h5f['nn_node_features']
-        nn_nodegroup = h5f.create_group("nn_node_features")
-    try:
-        nn_glblgroup = h5f.create_group("nn_glbl_features")
-    except:
-        print("nn_glbl_features group already exists. Overwriting")
-        del h5f['nn_glbl_features']
-        nn_glblgroup = h5f.create_group("nn_glbl_features")
-
-    node_stats = np.zeros((2,4),dtype=np.float64)
-    edge_stats = np.zeros((2,13),dtype=np.float64)
-    glbl_stats = np.zeros((2,2),dtype=np.float64)
-    nk, ek = 1, 1
+    T = n_snaps(h5f,'edge_features')
+    if layout is None:
+        layout = get_layout(h5f,'edge_features')
+        if layout == "sparse":
+            # Training readers want dense nn features
+            layout = "timemajor"
+    sizes = _nn_group_sizes(h5f)
+    fresh = False
+    for grp,n_ft in _nn_groups(keep_unnormed):
+        n_ent = sizes[grp.replace("_unnormed","")]
+        if resume and _reuse_snapset(h5f,grp,T,n_ent,n_ft,layout):
+            continue
+        if grp in h5f:
+            print(grp,"already exists. Overwriting")
+        grp_layout = layout
+        if layout == "sparse" and grp == "nn_glbl_features":
+            grp_layout = "timemajor"
+        create_snapset(h5f,grp,T,n_ent,n_ft,
+                       layout=grp_layout,codec=codec,codec_opts=codec_opts,chunks=chunks)
+        fresh = True
+    if not resume and "resume/nn_done" in h5f:
+        # Output is being rebuilt from scratch, the records no longer apply
+        del h5f["resume/nn_done"]
+
+    if (resume or stats is None) and digests is None:
+        # Stored moments and nn_done records only apply to unchanged snapshots
+        digests = snapshot_digests(h5f)
+    if workers > 1:
+        _create_nn_parallel(h5f,covs,M,layout,codec,codec_opts,workers,
+                            stats,keep_unnormed,digests)
+        return
 
-    n_edge = h5f.attrs['n_edges']
-    n_node = h5f.attrs['n_nodes']
-    for d in progressbar(range(7)):
-        for tg in range(NTG):
-            snapstr = "day"+str(d)+"tg"+str(tg)
-            e_fts = np.zeros((n_edge,13),dtype=np.float64)
-            edges = h5f['edge_features/'+snapstr]
-            e_fts[:,:4] = edges[:]
-            e_fts[:,4:7] = covs[:]
-            e_fts[:,7:10] = covs[:]*edges[:,:3]
-            e_fts[:,10] = edges[:,0]*edges[:,1]
-            e_fts[:,11] = (DTG/60.)*edges[:,1]/edges[:,3]
-            e_fts[:,12] = e_fts[:,11] * edges[:,0]
-
-            n_fts = np.zeros((n_node,4),dtype=np.float64)
-            nodes = h5f['node_features/'+snapstr]
-            n_fts[:,:3] = nodes[:]
-            n_fts[:,3] = M[:]
-
-            # You could do some stat stuff here
-            np.random.shuffle(e_fts)
-            np.random.shuffle(n_fts)
-            for e_ft in e_fts[:50]:
-                m_k = edge_stats[0,:] + (e_ft - edge_stats[0,:])/ek
-                edge_stats[1,:] = edge_stats[1,:] + (e_ft - edge_stats[0,:])*(e_ft - m_k)
-                edge_stats[0,:] = m_k
-                ek+=1
-            for n_ft in n_fts[:20]:
-                m_k = node_stats[0,:] + (n_ft - node_stats[0,:])/nk
-                node_stats[1,:] = node_stats[1,:] + (n_ft - node_stats[0,:])*(n_ft - m_k)
-                node_stats[0,:] = m_k
-                nk+=1
-
-            nn_edgegroup.create_dataset(snapstr,data=e_fts,compression="gzip",compression_opts=6)
-            nn_nodegroup.create_dataset(snapstr,data=n_fts,compression='gzip',compression_opts=6)
+    if stats is None:
+        print("Calculating norm stats")
+        digest = _array_digest(covs,M)
+        with tracing.span("create_nn_inputset.norm_stats") as sp:
+            edge_mom, node_mom, n_done = _load_moments(h5f,digest,digests)
+            sp.count("snapshots",T-n_done)
+            edge_mom, node_mom = nn_feature_moments(h5f,covs,M,n_done,T,edge_mom,node_mom)
+            _save_moments(h5f,edge_mom,node_mom,T,digest,digests)
+        node_stats, edge_stats = node_mom.norm_stats(), edge_mom.norm_stats()
+    else:
+        node_stats, edge_stats = stats
+    glbl_stats = _glbl_norm_stats()
+    norms = _norm_stats_dict(node_stats,edge_stats,glbl_stats)
+    if layout == "sparse":
+        _set_nn_bases(h5f,covs,M,norms,keep_unnormed)
+
+    blocks = [(t0,min(t0+BLOCK_T,T)) for t0 in range(0,T,BLOCK_T)]
+    if resume:
+        want = digests ^ _digest_int(covs,M,node_stats,edge_stats,glbl_stats,
+                                     np.array([keep_unnormed]))
+        done = _load_nn_done(h5f,T,fresh)
+        blocks = [(t0,t1) for t0,t1 in blocks if np.any(done[t0:t1] != want[t0:t1])]
+        print(sum(t1-t0 for t0,t1 in blocks),"of",T,"snapshots to write")
 
     print("Creating normalized dataset")
+    with tracing.span("create_nn_inputset.write") as sp:
+        for t0,t1 in tracing.progress(blocks,"create_nn_inputset.block"):
+            sp.count("snapshots",t1-t0)
+            for grp,blk in _nn_block(h5f,covs,M,t0,t1,norms,keep_unnormed).items():
+                write_snaps(h5f,grp,t0,blk)
+            if resume:
+                h5f['resume/nn_done'][t0:t1] = want[t0:t1]
+                h5f.flush()
 
-    #
-    #
-    # Lets not have separate datasets for the unnormed and normed features
-    # Just overwrite the unnormed stuff with the normed stuff
-    #
-    #
-
-
-    try:
-        normed_edge_group = h5f.create_group("nn_edge_features_normed")
-        normed_node_group = h5f.create_group("nn_node_features_normed")
-        normed_glbl_group = h5f.create_group("nn_glbl_features_normed")
-    except:
-        print("Normed features exist. Overwriting")
-        del h5f['nn_edge_features_normed'], h5f['nn_node_features_normed'],\
-            h5f['nn_glbl_features_normed']
-        normed_edge_group = h5f.create_group("nn_edge_features_normed")
-        normed_node_group = h5f.create_group("nn_node_features_normed")
-        normed_glbl_group = h5f.create_group("nn_glbl_features_normed")
+    # Save the stats to hdf5
+    _write_norm_stats(h5f,node_stats,edge_stats,glbl_stats)
 
-    """
-    print("Calculating norm stats")
-    node_stats = np.zeros((2,4),dtype=np.float64)
-    edge_stats = np.zeros((2,13),dtype=np.float64)
-    glbl_stats = np.zeros((2,2),dtype=np.float64)
-    glblgroup = h5f['glbl_features']
-
-    # This loop goes over each tg and then each
-    # edge or node within the tg
-    # This is costly, let's do Sun,Mon,Thur,Sat
-    # and some random selection of 25% of the nodes/edges
-    # ...later
-    #
-    # You could also in theory gather stats as you build the
-    # nn_nodegroup.items in the above loops
-    #
-    k = 1 # data iter
-    for key,dset in progressbar(nn_nodegroup.items()):
-        np.random.shuffle(dset)
-        for row in dset[:10]:
-            m_k = node_stats[0,:] + (row - node_stats[0,:])/k
-            node_stats[1,:] = node_stats[1,:] + (row - node_stats[0,:])*(row - m_k)
-            node_stats[0,:] = m_k
-            k+=1
-    node_stats[1,:] = np.sqrt(node_stats[1,:]/(k-1))
-    
-    k = 1
-    for key,dset in progressbar(nn_edgegroup.items()):
-        np.random.shuffle(dset)
-        for row in dset[:10]:
-            m_k = edge_stats[0,:] + (row - edge_stats[0,:])/k
-            edge_stats[1,:] = edge_stats[1,:] + (row - edge_stats[0,:])*(row - m_k)
-            edge_stats[0,:] = m_k
-            k+=1
-    edge_stats[1,:] = np.sqrt(edge_stats[1,:]/(k-1))
-    """
+    h5f.close()
 
-    node_stats[1,:] = np.sqrt(node_stats[1,:]/(nk-1))
-    edge_stats[1,:] = np.sqrt(edge_stats[1,:]/(ek-1))
-    glbl_stats[:] = [[3.0,2.0], [np.mean(range(NTG)),np.std(range(NTG))]]
-
-    glblgroup = h5f['glbl_features']
-    # Now that we have the norm stats, we apply it to the existing datasets
-    print("Applying norm to feature sets")
-    for d in progressbar(range(7)):
-        for tg in range(NTG):
-            snapstr="day"+str(d)+"tg"+str(tg)
-            nodes = nn_nodegroup[snapstr]
-            edges = nn_edgegroup[snapstr]
-            glbls = glblgroup[snapstr]
-            normed_nodes = mynorm(nodes,node_stats[0,:],node_stats[1,:])
-            normed_edges = mynorm(edges,edge_stats[0,:],edge_stats[1,:])
-            normed_glbls = mynorm(glbls,glbl_stats[0,:],glbl_stats[1,:])
-
-            if 0:
-                normed_node_group.create_dataset(snapstr,compression="gzip",compression_opts=6,
-                                                 data=normed_nodes)
-                normed_edge_group.create_dataset(snapstr,compression="gzip",compression_opts=6,
-                                                 data=normed_edges)
-                normed_glbl_group.create_dataset(snapstr,compression="gzip",compression_opts=6,
-                                                 data=normed_glbls)
-            else:
-                nodes[:] = normed_nodes.copy()
-                edges[:] = normed_edges.copy()
-                nn_glblgroup.create_dataset(snapstr,data=normed_glbls,compression='gzip',compression_opts=6)
+def _raw_base(h5f,name):
+    if get_layout(h5f,name) == "sparse":
+        return h5f[name]["base"][:]
+    return sparse_base(read_snaps(h5f,name,0,min(BLOCK_T,n_snaps(h5f,name))))
+
+def _set_nn_bases(h5f,covs,M,norms,keep_unnormed):
+    # Base rows of the sparse nn groups: the raw base rows, derived and
+    # normalized like any other row
+    bases = {"nn_edge_features":_derive(_raw_base(h5f,'edge_features'),covs,_edge_nn_features),
+             "nn_node_features":_derive(_raw_base(h5f,'node_features'),M,_node_nn_features)}
+    for grp,base in list(bases.items()):
+        if keep_unnormed:
+            h5f[grp+"_unnormed"]["base"][...] = base
+        h5f[grp]["base"][...] = mynorm(base,norms[grp][0,:],norms[grp][1,:])
+
+def preprocess(h5_name,resume=True,**nn_kw):
+    """EdgeNodeCovariance, CalcMFactor and create_nn_inputset in turn. With
+    resume, the snapshot fingerprints are computed once for all three."""
+    digests = None
+    if resume:
+        with h5py.File(h5_name,'r') as h5f:
+            digests = snapshot_digests(h5f)
+    EdgeNodeCovariance(h5_name,resume=resume,digests=digests)
+    CalcMFactor(h5_name,resume=resume,digests=digests)
+    create_nn_inputset(h5_name,resume=resume,digests=digests,**nn_kw)
+
+def _reuse_snapset(h5f,name,T,n_entity,n_feat,layout):
+    # True if an existing feature group can be kept, grown to T snapshots
+    if name not in h5f or get_layout(h5f,name) != layout:
+        return False
+    if layout == "snapshot":
+        return True
+    dset = h5f[name]
+    if dset.shape[1:] != (n_entity,n_feat) or dset.maxshape[0] is not None:
+        return False
+    if dset.shape[0] != T:
+        dset.resize(T,axis=0)
+    return True
+
+def _load_nn_done(h5f,T,fresh=False):
+    # Per-snapshot record of what nn output was written from, 0 if nothing
+    if fresh or "resume/nn_done" not in h5f:
+        if "resume/nn_done" in h5f:
+            del h5f["resume/nn_done"]
+        h5f.create_dataset("resume/nn_done",shape=(T,),dtype=np.uint64,
+                           maxshape=(None,))
+    done = h5f["resume/nn_done"]
+    if done.shape[0] != T:
+        old = done.shape[0]
+        done.resize((T,))
+        if T > old:
+            done[old:] = 0
+    return done[:]
+
+# Parallel create_nn_inputset
+#
+# HDF5 allows one writer per file, so each shard of snapshots goes to its own
+# scratch file next to the output:
+#   1. unless stats are given, workers return exact Moments of their shard's
+#      derived features (read-only), which the parent merges into norm stats
+#   2. workers derive, normalize and compress their shard with the output
+#      codec into the scratch file
+#   3. the parent, the only writer on the real file, copies the compressed
+#      chunks across without decompressing them
+
+def _nn_shard_bounds(T,nshard,align):
+    size = -(-T//nshard)
+    size = -(-size//align)*align
+    return [(t0,min(t0+size,T)) for t0 in range(0,T,size)]
+
+def _nn_shard_moments(args):
+    h5_name, t0, t1, covs, M = args
+    with h5py.File(h5_name,'r') as src:
+        edge_mom, node_mom = nn_feature_moments(src,covs,M,t0,t1)
+    return edge_mom, node_mom, tracing.drain()
+
+def _nn_shard_write(args):
+    (h5_name, shard_name, t0, t1, covs, M, norms, keep_unnormed,
+     layout, codec, codec_opts, chunks) = args
+    with h5py.File(h5_name,'r') as src, h5py.File(shard_name,'w') as dst:
+        sizes = _nn_group_sizes(src)
+        for grp,n_ft in _nn_groups(keep_unnormed):
+            create_snapset(dst,grp,t1-t0,sizes[grp.replace("_unnormed","")],n_ft,
+                           layout=layout,codec=codec,codec_opts=codec_opts,
+                           chunks=chunks[grp])
+        for b0 in range(t0,t1,BLOCK_T):
+            b1 = min(b0+BLOCK_T,t1)
+            for grp,blk in _nn_block(src,covs,M,b0,b1,norms,keep_unnormed).items():
+                # Per-snapshot datasets are named by their global time
+                write_snaps(dst,grp,b0 if layout == "snapshot" else b0-t0,blk)
+    return tracing.drain()
+
+def _copy_snaps(src,dst,t0):
+    # Move a shard's snapshots into the output at time t0. Compressed chunks
+    # are copied as-is when the shard lines up with the output's chunk grid.
+    if isinstance(dst,h5py.Group):
+        for key in src:
+            dst.file.copy(src[key],dst,name=key)
+        return
+    n = src.shape[0]
+    ct = dst.chunks[0]
+    aligned = (src.chunks == dst.chunks and src.compression == dst.compression
+               and src.compression_opts == dst.compression_opts
+               and src.shuffle == dst.shuffle and t0 % ct == 0
+               and (n % ct == 0 or t0+n == dst.shape[0]))
+    if not aligned:
+        dst[t0:t0+n] = src[:]
+        return
+    for tc in range(0,n,ct):
+        for ec in range(0,src.shape[1],src.chunks[1]):
+            mask, data = src.id.read_direct_chunk((tc,ec,0))
+            dst.id.write_direct_chunk((t0+tc,ec,0),data,mask)
+
+def _create_nn_parallel(h5f,covs,M,layout,codec,codec_opts,workers,
+                        stats=None,keep_unnormed=False,digests=None):
+    h5_name = h5f.filename
+    T = n_snaps(h5f,'edge_features')
+    groups = _nn_groups(keep_unnormed)
+    chunks = {}
+    for grp,n_ft in groups:
+        chunks[grp] = h5f[grp].chunks if layout == "timemajor" else None
+    align = chunks["nn_edge_features"][0] if layout == "timemajor" else 1
+    digest = _array_digest(covs,M)
+    if stats is None:
+        edge_mom, node_mom, n_done = _load_moments(h5f,digest,digests)
+    # Nobody else can open the file while it is open for writing
+    h5f.close()
 
-    # Save the stats to hdf5
+    bounds = _nn_shard_bounds(T,4*workers,align)
+    shard_names = [h5_name+".shard"+str(i) for i in range(len(bounds))]
+    # Workers start with no trace events and send theirs back with each result
+    pool = multiprocessing.Pool(workers,initializer=tracing.reset)
     try:
-        h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
-        h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
-        h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
-    except:
-        del h5f['node_stats'], h5f['edge_stats'], h5f['glbl_stats']
-        h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
-        h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
-        h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
+        if stats is None:
+            print("Calculating norm stats")
+            if n_done < T:
+                new_bounds = _nn_shard_bounds(T-n_done,4*workers,1)
+                res = pool.map(_nn_shard_moments,
+                               [(h5_name,n_done+t0,n_done+t1,covs,M)
+                                for t0,t1 in new_bounds])
+                for e_mom,n_mom,trace in res:
+                    edge_mom.merge(e_mom)
+                    node_mom.merge(n_mom)
+                    tracing.merge(trace)
+            node_stats, edge_stats = node_mom.norm_stats(), edge_mom.norm_stats()
+        else:
+            node_stats, edge_stats = stats
+        glbl_stats = _glbl_norm_stats()
+        norms = _norm_stats_dict(node_stats,edge_stats,glbl_stats)
+
+        print("Creating normalized dataset")
+        traces = pool.map(_nn_shard_write,
+                          [(h5_name,shard_names[i],t0,t1,covs,M,norms,keep_unnormed,
+                            layout,codec,codec_opts,chunks)
+                           for i,(t0,t1) in enumerate(bounds)])
+        for trace in traces:
+            tracing.merge(trace)
+    finally:
+        pool.close()
+        pool.join()
 
+    h5f = h5py.File(h5_name,'a')
+    for name,(t0,t1) in tracing.progress(list(zip(shard_names,bounds)),
+                                         "create_nn_inputset.copy_shard"):
+        with h5py.File(name,'r') as f:
+            for grp,n_ft in groups:
+                _copy_snaps(f[grp],h5f[grp],t0)
+        os.remove(name)
+
+    _write_norm_stats(h5f,node_stats,edge_stats,glbl_stats)
+    if stats is None:
+        _save_moments(h5f,edge_mom,node_mom,T,digest,digests)
     h5f.close()
 
 
-def mynorm(nparr,mus,stds):
-    return np.divide(np.subtract(nparr,mus),stds)
-
-def my_unnorm(nparr,norms):
-    return np.add(np.multiply(nparr,norms[1,:]),norms[0,:])
-
-def unnorm_graph(graph, node_norms, edge_norms):
-    return graph.replace(nodes=my_unnorm(graph.nodes,node_norms),
-                         edges=my_unnorm(graph.edges,edge_norms))
-                                         
-    
-def copy_graph(graphs_tuple):
-    return utils_np.data_dicts_to_graphs_tuple(
-        utils_np.graphs_tuple_to_data_dicts(graphs_tuple))
+# The norm helpers take an optional out array; out may be nparr itself to
+# (un)normalize in place without allocating.
+
+def _norm_out(nparr,out):
+    # float64 stats must not promote FLOAT_DTYPE features
+    if out is None:
+        out = np.empty(np.shape(nparr),dtype=np.result_type(nparr,FLOAT_DTYPE))
+    return out
+
+def _stat_row(row,out):
+    # Stats in out's dtype, so the ufuncs need no casting buffers
+    return np.asarray(row,dtype=out.dtype)
+
+def mynorm(nparr,mus,stds,out=None):
+    out = _norm_out(nparr,out)
+    out = np.subtract(nparr,_stat_row(mus,out),out=out)
+    return np.divide(out,_stat_row(stds,out),out=out)
+
+def my_unnorm(nparr,norms,out=None):
+    out = _norm_out(nparr,out)
+    out = np.multiply(nparr,_stat_row(norms[1,:],out),out=out)
+    return np.add(out,_stat_row(norms[0,:],out),out=out)
+
+def unnorm_graph(graph, node_norms, edge_norms, out=None):
+    """out is a GraphsTuple whose node/edge arrays receive the result;
+    pass graph itself to unnorm in place."""
+    if out is None:
+        return graph.replace(nodes=my_unnorm(graph.nodes,node_norms),
+                             edges=my_unnorm(graph.edges,edge_norms))
+    my_unnorm(graph.nodes,node_norms,out=out.nodes)
+    my_unnorm(graph.edges,edge_norms,out=out.edges)
+    if out is not graph:
+        np.copyto(out.globals,graph.globals)
+    return out
+
+def _readonly(arr):
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+def share_topology(graphs_tuple):
+    """Same graph with read-only views of senders/receivers/n_node/n_edge,
+    so copies can share them without one copy mutating another's."""
+    return graphs_tuple.replace(senders=_readonly(graphs_tuple.senders),
+                                receivers=_readonly(graphs_tuple.receivers),
+                                n_node=_readonly(graphs_tuple.n_node),
+                                n_edge=_readonly(graphs_tuple.n_edge))
+
+def replace_features(graphs_tuple, nodes=None, edges=None, globals=None):
+    """Copy-on-write: a new tuple with the given feature arrays swapped in.
+    Everything not replaced, topology included, is shared, not copied."""
+    kw = {}
+    if nodes is not None: kw["nodes"] = nodes
+    if edges is not None: kw["edges"] = edges
+    if globals is not None: kw["globals"] = globals
+    return share_topology(graphs_tuple).replace(**kw)
+
+def copy_graph(graphs_tuple, out=None):
+    """Copies the feature arrays; the topology is shared read-only.
+    With out, features are copied into out's arrays instead of new ones."""
+    if out is None:
+        return replace_features(graphs_tuple,nodes=graphs_tuple.nodes.copy(),
+                                edges=graphs_tuple.edges.copy(),
+                                globals=graphs_tuple.globals.copy())
+    np.copyto(out.nodes,graphs_tuple.nodes)
+    np.copyto(out.edges,graphs_tuple.edges)
+    np.copyto(out.globals,graphs_tuple.globals)
+    return out
 
 
 def get_daytimes():
-    daytimes = np.zeros((7*NTG,2),dtype=int)
-    i=0
-    for d in range(7):
-        for tg in range(NTG):
-            daytimes[i] = [d,tg]
-            i+=1
-    return daytimes
+    t = np.arange(7*NTG)
+    return np.stack(snap_daytg(t),axis=1)
     
 
-def get_norm_stats(hfname):
+def get_norm_stats(hfname,digests=None):
+    """Exact node/edge norm stats of the derived nn features.
+
+    Moments are stored with the file, so after new weeks of raw features
+    are appended only the new snapshots are read. Everything is recomputed
+    if edge_node_covs or M have changed since, or the raw features of a
+    snapshot they cover (compared by snapshot_digests, which are computed
+    here if not given).
+    """
     h5f = h5py.File(hfname,'a')
-    node_stats = np.zeros((2,5),dtype=np.float64)
-    edge_stats = np.zeros((2,13),dtype=np.float64)
-    glbl_stats = np.zeros((2,2),dtype=np.float64)
-    nodegroup = h5f['nn_node_features']
-    edgegroup = h5f['nn_edge_features']
-    glblgroup = h5f['glbl_features']
+    covs = h5f['edge_node_covs'][:]
+    M = h5f['M'][:]
+    digest = _array_digest(covs,M)
+    T = n_snaps(h5f,'edge_features')
+    digests = snapshot_digests(h5f) if digests is None else digests
 
     print("Calculating norm stats")
-    k = 1 # data iter
-    for key,dset in progressbar(nodegroup.items()):
-        for row in dset:
-            m_k = node_stats[0,:] + (row - node_stats[0,:])/k
-            node_stats[1,:] = node_stats[1,:] + (row - node_stats[0,:])*(row - m_k)
-            node_stats[0,:] = m_k
-            k+=1
-    node_stats[1,:] = np.sqrt(node_stats[1,:]/(k-1))
-    
-    k = 1
-    for key,dset in progressbar(edgegroup.items()):
-        for row in dset:
-            m_k = edge_stats[0,:] + (row - edge_stats[0,:])/k
-            edge_stats[1,:] = edge_stats[1,:] + (row - edge_stats[0,:])*(row - m_k)
-            edge_stats[0,:] = m_k
-            k+=1
-    edge_stats[1,:] = np.sqrt(edge_stats[1,:]/(k-1))
+    edge_mom, node_mom, n_done = _load_moments(h5f,digest,digests)
+    edge_mom, node_mom = nn_feature_moments(h5f,covs,M,n_done,T,edge_mom,node_mom)
 
-    glbl_stats[:] = [[3.0,2.0], [np.mean(range(NTG)),np.std(range(NTG))]]
-
-    # Save the stats to hdf5
-    try:
-        del h5f['node_stats'],h5f['edge_stats'],h5f['glbl_stats']
-    except:
-        pass
-    h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
-    h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
-    h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
+    _write_norm_stats(h5f,node_mom.norm_stats(),edge_mom.norm_stats(),_glbl_norm_stats())
+    _save_moments(h5f,edge_mom,node_mom,T,digest,digests)
 
     h5f.close()
 
     return
-
-
-
-
-
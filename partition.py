@@ -0,0 +1,349 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Partitioned EncodeProcessDecode for road graphs too big for one process.
+#
+# The nodes are split into balanced parts by recursive coordinate bisection
+# of node_coords. Each edge belongs to the part of its receiver, so a part
+# holds its own nodes, the edges into them, and as halo the nodes outside
+# the part that send into it (one hop). Halo edges are not needed: an edge
+# update only reads its own edge and its two end nodes, and a node update
+# only the edges it receives, which are all local.
+#
+# One worker process per part encodes its subgraph, then runs the core one
+# message-passing step at a time. After each step but the last, the halo
+# node latents are stale (their incoming edges live elsewhere); every part
+# writes the new latents of its nodes that others use as halo into its own
+# shared-memory buffer and reads its halo rows from the owners'. The
+# globals only depend on the globals (global_block_opt in MLPGraphNetwork),
+# so every part computes the same ones. Outputs are gathered back into one
+# GraphsTuple equal to the unpartitioned model's last output.
+#
+#   with PartitionedEPD("toys/city.hdf5", "ckpts/model.ckpt", n_parts=8) as pm:
+#       out = pm.run([0, 1, 2, 3])      # like model(snaps2graph(h5f, ts))[-1]
+#
+# Workers read only their own rows of the features, so their memory grows
+# with the part's size, not the city's.
+
+import collections
+import multiprocessing
+import queue
+import time
+
+from graph_nets import graphs
+import numpy as np
+import tensorflow as tf
+
+import featstore
+import my_graph_tools as mgt
+import train
+
+# nodes: global ids of the local nodes, the n_owned owned ones first, then
+# the halo. edges: global ids of the owned edges, whose senders/receivers
+# are local node indices. exports: local indices of owned nodes that other
+# parts use as halo. halo_owner/halo_slot: each halo node's owning part and
+# its row in that part's exports.
+Partition = collections.namedtuple(
+    "Partition", ("nodes", "n_owned", "edges", "senders", "receivers",
+                  "exports", "halo_owner", "halo_slot"))
+
+
+def rcb_partition(node_coords, n_parts):
+    """Part id of every node: recursive coordinate bisection, splitting the
+    longer side at the point that keeps the part sizes within one node."""
+    node_coords = np.asarray(node_coords)
+    part = np.zeros(node_coords.shape[0], dtype=np.int32)
+    stack = [(np.arange(node_coords.shape[0]), 0, n_parts)]
+    while stack:
+        idx, p0, n = stack.pop()
+        if n == 1:
+            part[idx] = p0
+            continue
+        n_left = n//2
+        xy = node_coords[idx]
+        axis = np.argmax(xy.max(axis=0) - xy.min(axis=0)) if idx.size else 0
+        cut = int(round(idx.size*n_left/n))
+        order = np.argsort(xy[:, axis], kind='stable')
+        stack.append((idx[order[:cut]], p0, n_left))
+        stack.append((idx[order[cut:]], p0 + n_left, n - n_left))
+    return part
+
+
+def build_partitions(senders, receivers, part):
+    """List of Partition for the node assignment part (n_node,)."""
+    senders, receivers = np.asarray(senders), np.asarray(receivers)
+    n_parts = int(part.max()) + 1
+    loc = np.full(part.shape[0], -1, dtype=np.int64)
+    edge_part = part[receivers]
+    pieces = []
+    for p in range(n_parts):
+        owned = np.flatnonzero(part == p)
+        edges = np.flatnonzero(edge_part == p)
+        src = senders[edges]
+        halo = np.unique(src[part[src] != p])
+        nodes = np.concatenate([owned, halo])
+        loc[nodes] = np.arange(nodes.size)
+        pieces.append((nodes, owned.size, edges, loc[src], loc[receivers[edges]]))
+        loc[nodes] = -1
+    # A part exports the owned nodes that appear in any other part's halo
+    halo_ids = [nodes[n_owned:] for nodes, n_owned, _, _, _ in pieces]
+    all_halo = np.unique(np.concatenate(halo_ids)) if halo_ids else np.zeros(0, int)
+    export_ids = [all_halo[part[all_halo] == p] for p in range(n_parts)]
+    parts = []
+    for p, (nodes, n_owned, edges, s_loc, r_loc) in enumerate(pieces):
+        owned = nodes[:n_owned]
+        exports = np.searchsorted(owned, export_ids[p])
+        halo = nodes[n_owned:]
+        owner = part[halo]
+        slot = np.zeros(halo.size, dtype=np.int64)
+        for o in np.unique(owner):
+            sel = owner == o
+            slot[sel] = np.searchsorted(export_ids[o], halo[sel])
+        parts.append(Partition(nodes, n_owned, edges, s_loc, r_loc,
+                               exports, owner, slot))
+    return parts
+
+
+def partition_graph(h5f, n_parts):
+    """build_partitions of an open file's topology, split by node_coords
+    (or by node id if it has none)."""
+    topo = mgt.get_topology(h5f)
+    n_node = topo["n_node"]
+    if 'node_coords' in h5f:
+        part = rcb_partition(np.asarray(h5f['node_coords'][:]), n_parts)
+    else:
+        part = (np.arange(n_node)*n_parts//n_node).astype(np.int32)
+    return build_partitions(topo["senders"], topo["receivers"], part)
+
+
+def partition_stats(parts):
+    """Per part: owned/halo nodes and edges; plus the fraction of nodes
+    that are someone's halo."""
+    rows = [{"owned_nodes": int(p.n_owned), "halo_nodes": int(p.nodes.size - p.n_owned),
+             "edges": int(p.edges.size), "exports": int(p.exports.size)} for p in parts]
+    n_node = sum(r["owned_nodes"] for r in rows)
+    return {"parts": rows,
+            "halo_frac": sum(r["exports"] for r in rows)/max(n_node, 1)}
+
+
+class HaloExchange(object):
+    """Refreshes the halo rows of a part's (batch, n_local, size) node array
+    from their owners, through one shared (2, batch, n_exports, size) buffer
+    per part and one barrier per call.
+
+    Calls alternate between the two halves of the buffers, as in
+    dist_train.SharedMean, so a part can write its next exports while slower
+    ones still read the previous ones.
+    """
+
+    def __init__(self, part, rank, bufs, n_exports, barrier, batch_size, size, dtype):
+        views = [np.frombuffer(buf, dtype=dtype)[:2*batch_size*n*size].reshape(
+            2, batch_size, n, size) for buf, n in zip(bufs, n_exports)]
+        self.exports = part.exports
+        self.view = views[rank]
+        self.barrier = barrier
+        self.sources = []
+        for owner in np.unique(part.halo_owner):
+            sel = np.flatnonzero(part.halo_owner == owner)
+            self.sources.append((views[owner], part.n_owned + sel, part.halo_slot[sel]))
+        self._phase = 0
+
+    def __call__(self, nodes, timeout=None):
+        phase = self._phase
+        self._phase ^= 1
+        self.view[phase] = nodes[:, self.exports]
+        self.barrier.wait(timeout)
+        for view, rows, slots in self.sources:
+            nodes[:, rows] = view[phase][:, slots]
+        return nodes
+
+
+def _read_rows(h5f, name, ts, rows):
+    # (len(ts), len(rows), n_feat) for sorted rows, without holding whole
+    # snapshots where the layout allows it
+    obj = h5f[name]
+    layout = mgt.get_layout(h5f, name)
+    if layout == "timemajor":
+        return np.stack([obj[int(t)][rows] if isinstance(obj, np.ndarray)
+                         else obj[int(t), rows] for t in ts])
+    return np.stack([mgt.read_snap(h5f, name, *mgt.snap_daytg(t))[rows] for t in ts])
+
+
+def load_part(h5f, part, ts, normalize=True):
+    """Node, edge and global features of part for the times ts, shaped
+    (len(ts), n_local, n_feat), (len(ts), n_edges, n_feat) and (len(ts), n_feat).
+    The groups are the ones snaps2graph reads."""
+    e_name, n_name, g_name = (('nn_edge_features', 'nn_node_features', 'nn_glbl_features')
+                              if normalize else
+                              ('nn_edge_features', 'node_features', 'glbl_features'))
+    ts = np.asarray(ts) % mgt.n_snaps(h5f, e_name)
+    # Read the local nodes in increasing id order, then put them back in
+    # local order (owned first, then halo)
+    order = np.argsort(part.nodes)
+    rows = _read_rows(h5f, n_name, ts, part.nodes[order])
+    nodes = np.empty(rows.shape, dtype=mgt.FLOAT_DTYPE)
+    nodes[:, order] = rows
+    edges = np.asarray(_read_rows(h5f, e_name, ts, part.edges), dtype=mgt.FLOAT_DTYPE)
+    glbls = np.asarray(mgt._read_times(h5f, g_name, ts), dtype=mgt.FLOAT_DTYPE)
+    return nodes, edges, glbls.reshape(len(ts), -1)
+
+
+def _worker(rank, cfg, part, bufs, n_exports, barrier, tasks, results):
+    mgt.set_float_dtype(cfg["dtype"])
+    B, S = cfg["batch_size"], cfg["num_processing_steps"]
+    n_local, n_edge = part.nodes.size, part.edges.size
+    topo = {"senders": part.senders, "receivers": part.receivers,
+            "n_node": n_local, "offsets": {}}
+    n_ft, e_ft, g_ft = cfg["n_feat"]
+    inp_ph = train.static_batch_graph(topo, B, n_ft, e_ft, g_ft, name="part_input")
+    # Built like StaticBatchTrainer's model, so the variable names match
+    # its checkpoints
+    model = mgt.EncodeProcessDecode(edge_output_size=e_ft, node_output_size=n_ft)
+    latent0_op = model._encoder(inp_ph)
+
+    def placeholders(name):
+        return latent0_op.replace(**dict(
+            (f, tf.placeholder(getattr(latent0_op, f).dtype,
+                               getattr(latent0_op, f).shape, name=name + "_" + f))
+            for f in ("nodes", "edges", "globals")))
+
+    latent0_ph, latent_ph = placeholders("latent0"), placeholders("latent")
+    step_op = model._process_step(latent0_ph, latent_ph)
+    decode_op = model._decode(latent_ph, inp_ph)
+    exchange = HaloExchange(part, rank, bufs, n_exports, barrier, B,
+                            latent0_op.nodes.shape[-1].value,
+                            latent0_op.nodes.dtype.as_numpy_dtype)
+
+    threads = max(1, cfg["cores"]//cfg["n_parts"])
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                            inter_op_parallelism_threads=2)
+    h5f = featstore.open_store(cfg["h5_name"])
+    try:
+        with tf.Session(config=config) as sess:
+            tf.train.Saver(tf.global_variables()).restore(sess, cfg["checkpoint"])
+            while True:
+                ts = tasks.get()
+                if ts is None:
+                    break
+                nodes, edges, glbls = load_part(h5f, part, ts, cfg["normalize"])
+                inp = {inp_ph.nodes: nodes.reshape(B*n_local, -1),
+                       inp_ph.edges: edges.reshape(B*n_edge, -1),
+                       inp_ph.globals: glbls}
+                latent0 = sess.run(latent0_op, feed_dict=inp)
+                latent = latent0
+                for step in range(1, S+1):
+                    feed = train.feed_features(latent0_ph, latent0)
+                    feed.update(train.feed_features(latent_ph, latent))
+                    latent = sess.run(step_op, feed_dict=feed)
+                    if step < S:
+                        # The halo nodes' new latents were computed by their owners
+                        nodes = exchange(np.array(latent.nodes).reshape(B, n_local, -1),
+                                         cfg["timeout"])
+                        latent = latent.replace(nodes=nodes.reshape(B*n_local, -1))
+                feed = train.feed_features(latent_ph, latent)
+                feed[inp_ph.globals] = glbls
+                out = sess.run(decode_op, feed_dict=feed)
+                results.put((rank, out.nodes.reshape(B, n_local, -1)[:, :part.n_owned],
+                             out.edges.reshape(B, n_edge, -1), out.globals))
+    finally:
+        h5f.close()
+
+
+class PartitionedEPD(object):
+    """EncodeProcessDecode split over n_parts worker processes, restored
+    from a StaticBatchTrainer checkpoint.
+
+    run(ts) takes up to batch_size snapshot times and returns the model's
+    last output for them as one GraphsTuple, like
+    model(snaps2graph(h5f, ts), num_processing_steps)[-1].
+    """
+
+    def __init__(self, h5_name, checkpoint, n_parts, batch_size=1,
+                 num_processing_steps=3, normalize=True, timeout=600.):
+        with featstore.open_store(h5_name) as h5f:
+            self.parts = partition_graph(h5f, n_parts)
+            self.topo = mgt.get_topology(h5f)
+            sample = mgt.snaps2graph(h5f, [0], normalize=normalize)
+        self.n_node = self.topo["n_node"]
+        self.n_edge = len(self.topo["senders"])
+        self.batch_size = batch_size
+        self.timeout = timeout
+        n_feat = (sample.nodes.shape[1], sample.edges.shape[1], sample.globals.shape[1])
+        self._n_out = n_feat[:2]
+        ctx = multiprocessing.get_context("spawn")
+        dtype = np.dtype(mgt.FLOAT_DTYPE)
+        typecode = 'f' if dtype == np.float32 else 'd'
+        n_exports = [p.exports.size for p in self.parts]
+        bufs = [ctx.RawArray(typecode, max(1, 2*batch_size*n*mgt.LATENT_SIZE))
+                for n in n_exports]
+        cfg = {"h5_name": h5_name, "checkpoint": checkpoint, "n_parts": n_parts,
+               "batch_size": batch_size, "num_processing_steps": num_processing_steps,
+               "normalize": normalize, "n_feat": n_feat, "dtype": dtype.name,
+               "cores": multiprocessing.cpu_count(), "timeout": timeout}
+        self._barrier = ctx.Barrier(n_parts)
+        self._tasks = [ctx.Queue() for _ in self.parts]
+        self._results = ctx.Queue()
+        # Each worker only gets its own part and the others' export counts
+        self._procs = [ctx.Process(target=_worker,
+                                   args=(rank, cfg, part, bufs, n_exports, self._barrier,
+                                         self._tasks[rank], self._results))
+                       for rank, part in enumerate(self.parts)]
+        for p in self._procs:
+            p.daemon = True
+            p.start()
+
+    def run(self, ts):
+        ts = np.asarray(ts)
+        n = len(ts)
+        if not 0 < n <= self.batch_size:
+            raise ValueError("Need 1 to batch_size=" + str(self.batch_size)
+                             + " snapshots, got " + str(n))
+        # Short batches repeat the last time; the extra graphs are dropped
+        ts_pad = np.concatenate([ts, np.repeat(ts[-1:], self.batch_size - n)])
+        for q in self._tasks:
+            q.put(ts_pad)
+        B = self.batch_size
+        nodes = np.zeros((B, self.n_node, self._n_out[0]), dtype=mgt.FLOAT_DTYPE)
+        edges = np.zeros((B, self.n_edge, self._n_out[1]), dtype=mgt.FLOAT_DTYPE)
+        t_end = time.time() + self.timeout
+        for _ in self.parts:
+            rank, p_nodes, p_edges, glbls = self._get(t_end)
+            part = self.parts[rank]
+            nodes[:, part.nodes[:part.n_owned]] = p_nodes
+            edges[:, part.edges] = p_edges
+        senders, receivers = mgt.batch_topology(self.topo, n)
+        return graphs.GraphsTuple(
+            nodes=nodes[:n].reshape(n*self.n_node, -1),
+            edges=edges[:n].reshape(n*self.n_edge, -1),
+            globals=glbls[:n], senders=senders, receivers=receivers,
+            n_node=np.full(n, self.n_node, dtype=np.int32),
+            n_edge=np.full(n, self.n_edge, dtype=np.int32))
+
+    def _get(self, t_end):
+        while True:
+            try:
+                return self._results.get(timeout=1.)
+            except queue.Empty:
+                failed = [p for p in self._procs if p.exitcode not in (None, 0)]
+                if failed:
+                    self._barrier.abort()
+                    raise RuntimeError("Worker exited with code "
+                                       + str(failed[0].exitcode))
+                if time.time() > t_end:
+                    raise RuntimeError("No result within timeout=" + str(self.timeout) + "s")
+
+    def close(self):
+        for q, p in zip(self._tasks, self._procs):
+            if p.is_alive():
+                q.put(None)
+        for p in self._procs:
+            p.join(self.timeout)
+            if p.is_alive():
+                p.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
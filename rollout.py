@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Autoregressive forecasts with a trained EncodeProcessDecode.
+#
+# Each forecast step feeds the model's prediction for t+1 back in as the
+# next input and advances the (normalized) day/tg globals, which is what
+# timecrement was sketching. The whole horizon runs inside one
+# tf.while_loop, for a batch of starting times at once, so a week-long
+# rollout is a single sess.run. Only the steps asked for are kept.
+#
+#   model = trainer.model                      # already trained
+#   ro = Rollout(model, h5name, n_start=256, horizon=7*mgt.NTG,
+#                output_steps=[mgt.NTG*d for d in range(1, 7)])
+#   with tf.Session() as sess:
+#       trainer.saver.restore(sess, "ckpts/model.ckpt")
+#       preds = ro.run(sess, starts)           # {step: GraphsTuple}
+
+from graph_nets import graphs
+import numpy as np
+import tensorflow as tf
+
+import featstore
+import my_graph_tools as mgt
+import train
+
+# nn feature columns that are constant per edge/node (edge_node_covs and M),
+# see _edge_nn_features/_node_nn_features. Rollouts carry them over from
+# the starting snapshot instead of using the model's prediction.
+STATIC_EDGE_COLS = (4, 5, 6)
+STATIC_NODE_COLS = (3,)
+
+
+def advance_globals_np(glbls, glbl_stats, ntg=None):
+    """Normalized (day, tg) globals of the next snapshot (numpy)."""
+    ntg = mgt.NTG if ntg is None else ntg
+    raw = np.rint(glbls*glbl_stats[1] + glbl_stats[0])
+    day, tg = raw[:, 0], raw[:, 1] + 1
+    wrap = tg >= ntg
+    tg = np.where(wrap, tg - ntg, tg)
+    day = np.where(wrap, (day + 1) % 7, day)
+    out = (np.stack([day, tg], axis=1) - glbl_stats[0])/glbl_stats[1]
+    return out.astype(glbls.dtype)
+
+
+def advance_globals(glbls, glbl_stats, ntg=None):
+    """TF version of advance_globals_np."""
+    ntg = mgt.NTG if ntg is None else ntg
+    mean = tf.constant(glbl_stats[0], dtype=glbls.dtype)
+    std = tf.constant(glbl_stats[1], dtype=glbls.dtype)
+    raw = tf.round(glbls*std + mean)
+    day, tg = raw[:, 0], raw[:, 1] + 1.
+    wrap = tf.cast(tg >= ntg, glbls.dtype)
+    tg = tg - wrap*ntg
+    day = tf.mod(day + wrap, 7.)
+    return (tf.stack([day, tg], axis=1) - mean)/std
+
+
+def _pin_mask(n_ft, cols):
+    mask = np.zeros((n_ft,))
+    mask[list(cols)] = 1.
+    return mask
+
+
+class Rollout(object):
+    """Builds the rollout graph for n_start starting snapshots at a time.
+
+    output_steps are the forecast steps (1..horizon) returned by run(); the
+    last step is always included. static_edge_cols/static_node_cols are
+    held at their starting values. inner_while_loop is passed to the model
+    as use_while_loop for its processing steps.
+    """
+
+    def __init__(self, model, h5_name, n_start, horizon, num_processing_steps=3,
+                 output_steps=None, static_edge_cols=STATIC_EDGE_COLS,
+                 static_node_cols=STATIC_NODE_COLS, inner_while_loop=False,
+                 name="rollout"):
+        self.h5_name = h5_name
+        self.n_start = n_start
+        self.horizon = horizon
+        self.output_steps = sorted(set(output_steps or []) | set([horizon]))
+        if self.output_steps[0] < 1 or self.output_steps[-1] > horizon:
+            raise ValueError("output_steps must be in 1.."+str(horizon))
+        with featstore.open_store(h5_name) as h5f:
+            self.topo = mgt.get_topology(h5f)
+            sample = mgt.snaps2graph(h5f, [0])
+            if 'glbl_stats' in h5f:
+                self.glbl_stats = np.asarray(h5f['glbl_stats'][:])
+            else:
+                self.glbl_stats = mgt._glbl_norm_stats()
+            self.node_stats = np.asarray(h5f['node_stats'][:]) if 'node_stats' in h5f else None
+            self.edge_stats = np.asarray(h5f['edge_stats'][:]) if 'edge_stats' in h5f else None
+        n_node_ft = sample.nodes.shape[1]
+        n_edge_ft = sample.edges.shape[1]
+        n_glbl_ft = sample.globals.shape[1]
+        self._node_mask = _pin_mask(n_node_ft, static_node_cols)
+        self._edge_mask = _pin_mask(n_edge_ft, static_edge_cols)
+
+        self.input_ph = train.static_batch_graph(self.topo, n_start, n_node_ft,
+                                                 n_edge_ft, n_glbl_ft,
+                                                 name=name+"_input")
+        with tf.name_scope(name):
+            self.output_ops = self._build(model, num_processing_steps,
+                                          inner_while_loop)
+
+    def _step(self, model, graph, num_processing_steps, inner_while_loop):
+        out = model(graph, num_processing_steps,
+                    output_every=num_processing_steps,
+                    use_while_loop=inner_while_loop)[-1]
+        node_mask = tf.constant(self._node_mask, dtype=graph.nodes.dtype)
+        edge_mask = tf.constant(self._edge_mask, dtype=graph.edges.dtype)
+        return graph.replace(
+            nodes=out.nodes*(1. - node_mask) + graph.nodes*node_mask,
+            edges=out.edges*(1. - edge_mask) + graph.edges*edge_mask,
+            globals=advance_globals(graph.globals, self.glbl_stats))
+
+    def _build(self, model, num_processing_steps, inner_while_loop):
+        # Step 1 is connected outside the loop so the model's variables (if
+        # it has not been connected before) are not created in a control
+        # flow context
+        graph = self._step(model, self.input_ph, num_processing_steps,
+                           inner_while_loop)
+        fields = ("nodes", "edges", "globals")
+        n_keep = len(self.output_steps)
+        slots = np.full((self.horizon+1,), -1, dtype=np.int32)
+        slots[self.output_steps] = np.arange(n_keep)
+        tas = [tf.TensorArray(getattr(graph, f).dtype, size=n_keep,
+                              element_shape=getattr(graph, f).shape)
+               for f in fields]
+        if slots[1] >= 0:
+            tas = [ta.write(int(slots[1]), getattr(graph, f))
+                   for ta, f in zip(tas, fields)]
+        slots = tf.constant(slots)
+
+        def cond(step, nodes, edges, glbls, *tas):
+            return step < self.horizon
+
+        def body(step, nodes, edges, glbls, *tas):
+            cur = graph.replace(nodes=nodes, edges=edges, globals=glbls)
+            cur = self._step(model, cur, num_processing_steps, inner_while_loop)
+            step += 1
+            new = [cur.nodes, cur.edges, cur.globals]
+            slot = tf.gather(slots, step)
+            kept = tf.cond(slot >= 0,
+                           lambda: [ta.write(slot, x) for ta, x in zip(tas, new)],
+                           lambda: list(tas))
+            return [step] + new + list(kept)
+
+        if self.horizon > 1:
+            loop_vars = [tf.constant(1), graph.nodes, graph.edges, graph.globals] + tas
+            res = tf.while_loop(cond, body, loop_vars, back_prop=False,
+                                parallel_iterations=1)
+            tas = res[4:]
+        return [ta.stack() for ta in tas]
+
+    def run(self, sess, starts, unnormalize=False):
+        """Forecasts from each starting time index in starts (any number;
+        they are run n_start at a time). Returns {step: GraphsTuple} with
+        the graphs in the order of starts, normalized unless unnormalize."""
+        starts = np.asarray(starts)
+        pieces = {step: [] for step in self.output_steps}
+        with featstore.open_store(self.h5_name) as h5f:
+            for i in range(0, len(starts), self.n_start):
+                ts = starts[i:i+self.n_start]
+                n = len(ts)
+                # A short last batch is padded, its extra graphs dropped
+                ts = np.concatenate([ts, np.repeat(ts[-1:], self.n_start - n)])
+                inp = mgt.snaps2graph(h5f, ts)
+                nodes, edges, glbls = sess.run(
+                    self.output_ops,
+                    feed_dict=train.feed_features(self.input_ph, inp))
+                for j, step in enumerate(self.output_steps):
+                    pieces[step].append(
+                        (nodes[j].reshape(self.n_start, -1, nodes.shape[-1])[:n],
+                         edges[j].reshape(self.n_start, -1, edges.shape[-1])[:n],
+                         glbls[j][:n]))
+        out = {}
+        senders, receivers = mgt.batch_topology(self.topo, len(starts))
+        for step, parts in pieces.items():
+            nodes = np.concatenate([p[0] for p in parts])
+            edges = np.concatenate([p[1] for p in parts])
+            n_node, n_edge = nodes.shape[1], edges.shape[1]
+            graph = graphs.GraphsTuple(
+                nodes=nodes.reshape(-1, nodes.shape[-1]),
+                edges=edges.reshape(-1, edges.shape[-1]),
+                globals=np.concatenate([p[2] for p in parts]),
+                senders=senders, receivers=receivers,
+                n_node=np.full(len(starts), n_node, dtype=np.int32),
+                n_edge=np.full(len(starts), n_edge, dtype=np.int32))
+            if unnormalize:
+                graph = mgt.unnorm_graph(graph, self.node_stats, self.edge_stats, out=graph)
+            out[step] = graph
+        return out
@@ -0,0 +1,292 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Long-lived next-interval prediction service.
+#
+# The model, norm stats, edge_node_covs and M are loaded once. Requests
+# are raw snapshots (edge_features (n_edge,4), node_features (n_node,3) and
+# the (day, tg) global), submitted in-process or over HTTP. A batching
+# thread gathers whatever arrives within max_delay_ms of the first waiting
+# request (up to max_batch), derives and normalizes the nn features for
+# all of them at once, runs one sess.run and returns each caller its
+# unnormalized prediction for the next timegroup.
+#
+#   server = InferenceServer("toys/week.hdf5", "ckpts/model.ckpt")
+#   pred = server.predict({"edges": e, "nodes": n, "globals": (day, tg)})
+#   serve_http(server, port=8080)   # POST /predict, GET /stats
+#   server.close()
+#
+# Batches are padded up to the next power of two, so only a handful of
+# static-topology graphs are ever built.
+
+import collections
+import json
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from graph_nets import graphs
+import numpy as np
+import tensorflow as tf
+
+import featstore
+import my_graph_tools as mgt
+import train
+
+_STOP = "__stop__"
+
+
+def latency_summary(latencies, wall, n_request):
+    latencies = np.asarray(latencies)
+    if latencies.size == 0:
+        return {"requests": n_request, "requests_per_s": 0.}
+    return {"requests": n_request,
+            "requests_per_s": n_request/wall if wall > 0 else 0.,
+            "latency_ms_p50": 1e3*np.percentile(latencies, 50),
+            "latency_ms_p99": 1e3*np.percentile(latencies, 99),
+            "latency_ms_max": 1e3*latencies.max()}
+
+
+class InferenceServer(object):
+    """Micro-batching predictor around a trained EncodeProcessDecode.
+
+    h5_name (or a feature store) supplies the topology, covs, M and norm
+    stats; checkpoint is restored into the server's own graph and session.
+    """
+
+    def __init__(self, h5_name, checkpoint, num_processing_steps=3,
+                 max_batch=64, max_delay_ms=5., window=10000):
+        with featstore.open_store(h5_name) as h5f:
+            self.topo = mgt.get_topology(h5f)
+            self.covs = np.asarray(h5f['edge_node_covs'][:])
+            self.M = np.asarray(h5f['M'][:])
+            self.node_stats = np.asarray(h5f['node_stats'][:])
+            self.edge_stats = np.asarray(h5f['edge_stats'][:])
+            self.glbl_stats = np.asarray(h5f['glbl_stats'][:])
+        self.n_node = self.topo["n_node"]
+        self.n_edge = len(self.topo["senders"])
+        self.num_processing_steps = num_processing_steps
+        self.max_batch = max_batch
+        self.max_delay = 1e-3*max_delay_ms
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.model = mgt.EncodeProcessDecode(
+                edge_output_size=self.edge_stats.shape[1],
+                node_output_size=self.node_stats.shape[1])
+            self._buckets = {}
+            size = 1
+            while True:
+                self._bucket(min(size, max_batch))
+                if size >= max_batch:
+                    break
+                size *= 2
+            self.sess = tf.Session(graph=self.graph)
+            tf.train.Saver().restore(self.sess, checkpoint)
+        self.graph.finalize()
+
+        self._queue = queue.Queue()
+        self._latencies = collections.deque(maxlen=window)
+        self._batch_sizes = collections.deque(maxlen=window)
+        self._n_request = 0
+        self._t_start = time.time()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _bucket(self, size):
+        if size not in self._buckets:
+            ph = train.static_batch_graph(self.topo, size, self.node_stats.shape[1],
+                                          self.edge_stats.shape[1],
+                                          self.glbl_stats.shape[1],
+                                          name="serve_batch"+str(size))
+            out = self.model(ph, self.num_processing_steps,
+                             output_every=self.num_processing_steps)[-1]
+            self._buckets[size] = (ph, out)
+        return self._buckets[size]
+
+    def submit(self, request):
+        """Queue one snapshot; returns a Future resolving to its predicted
+        GraphsTuple for the next timegroup (unnormalized)."""
+        fut = Future()
+        edges = np.asarray(request["edges"], dtype=mgt.FLOAT_DTYPE)
+        nodes = np.asarray(request["nodes"], dtype=mgt.FLOAT_DTYPE)
+        if edges.shape != (self.n_edge, 4) or nodes.shape != (self.n_node, 3):
+            raise ValueError("Expected edges (%d,4) and nodes (%d,3), got %s and %s"
+                             % (self.n_edge, self.n_node, edges.shape, nodes.shape))
+        glbls = np.asarray(request["globals"], dtype=mgt.FLOAT_DTYPE).reshape(2)
+        self._queue.put((time.time(), edges, nodes, glbls, fut))
+        return fut
+
+    def predict(self, request, timeout=None):
+        return self.submit(request).result(timeout)
+
+    def _gather(self):
+        # Block for the first request, then take what else arrives before
+        # its deadline
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_delay
+        while len(batch) < self.max_batch:
+            wait = deadline - time.time()
+            try:
+                item = self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._gather()
+            if batch is None:
+                return
+            try:
+                results = self._run(batch)
+            except Exception as err:
+                for item in batch:
+                    item[4].set_exception(err)
+                continue
+            t_done = time.time()
+            with self._lock:
+                for item in batch:
+                    self._latencies.append(t_done - item[0])
+                self._batch_sizes.append(len(batch))
+                self._n_request += len(batch)
+            for item, res in zip(batch, results):
+                item[4].set_result(res)
+
+    def _run(self, batch):
+        n = len(batch)
+        size = 1
+        while size < n:
+            size *= 2
+        size = min(size, self.max_batch)
+        ph, out_op = self._bucket(size)
+
+        # Pad by repeating the last request; its outputs are dropped
+        idx = list(range(n)) + [n-1]*(size - n)
+        edges = np.stack([batch[i][1] for i in idx])
+        nodes = np.stack([batch[i][2] for i in idx])
+        glbls = np.stack([batch[i][3] for i in idx])
+        e_fts = mgt._edge_nn_features(edges, self.covs).reshape(size*self.n_edge, -1)
+        n_fts = mgt._node_nn_features(nodes, self.M).reshape(size*self.n_node, -1)
+        mgt.mynorm(e_fts, self.edge_stats[0], self.edge_stats[1], out=e_fts)
+        mgt.mynorm(n_fts, self.node_stats[0], self.node_stats[1], out=n_fts)
+        g_fts = mgt.mynorm(glbls, self.glbl_stats[0], self.glbl_stats[1])
+
+        feed = {ph.nodes: n_fts, ph.edges: e_fts, ph.globals: g_fts}
+        out_nodes, out_edges = self.sess.run([out_op.nodes, out_op.edges], feed_dict=feed)
+        b_senders, b_receivers = mgt.batch_topology(self.topo, size)
+        pred = graphs.GraphsTuple(nodes=out_nodes, edges=out_edges, globals=glbls,
+                                  senders=b_senders, receivers=b_receivers,
+                                  n_node=np.full(size, self.n_node, dtype=np.int32),
+                                  n_edge=np.full(size, self.n_edge, dtype=np.int32))
+        pred = mgt.unnorm_graph(pred, self.node_stats, self.edge_stats, out=pred)
+
+        senders, receivers = mgt.batch_topology(self.topo, 1)
+        results = []
+        for i in range(n):
+            day, tg = mgt.next_daytg(int(glbls[i, 0]), int(glbls[i, 1]))
+            results.append(graphs.GraphsTuple(
+                nodes=pred.nodes[i*self.n_node:(i+1)*self.n_node],
+                edges=pred.edges[i*self.n_edge:(i+1)*self.n_edge],
+                globals=np.array([[day, tg]], dtype=mgt.FLOAT_DTYPE),
+                senders=senders, receivers=receivers,
+                n_node=pred.n_node[:1], n_edge=pred.n_edge[:1]))
+        return results
+
+    def stats(self):
+        """p50/p99 latency (queueing included) over the recent window,
+        throughput since start and the mean batch size."""
+        with self._lock:
+            out = latency_summary(list(self._latencies), time.time() - self._t_start,
+                                  self._n_request)
+            out["mean_batch"] = float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.
+        return out
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        self.sess.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, server.stats())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                fut = server.submit(json.loads(self.rfile.read(length).decode()))
+            except (ValueError, KeyError, TypeError) as err:
+                self._reply(400, {"error": str(err)})
+                return
+            try:
+                pred = fut.result()
+            except Exception as err:
+                # The request was well formed, the prediction failed
+                self._reply(500, {"error": type(err).__name__ + ": " + str(err)})
+                return
+            self._reply(200, {"nodes": pred.nodes.tolist(),
+                              "edges": pred.edges.tolist(),
+                              "globals": pred.globals[0].tolist()})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve_http(server, host="127.0.0.1", port=8080, block=True):
+    """Serve POST /predict (JSON body like a submit() request, returns
+    nodes/edges/globals) and GET /stats. Each HTTP request waits on its
+    own thread, so concurrent clients are batched together."""
+    httpd = _ThreadingHTTPServer((host, port), _handler(server))
+    if not block:
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return httpd
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
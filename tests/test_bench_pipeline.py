@@ -0,0 +1,22 @@
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+
+
+def test_moment_stages_are_timed_standalone(tmp_path, monkeypatch):
+    # Every run of get_norm_stats and create_nn_inputset does its own stats
+    # pass over all snapshots, not just the first one
+    calls = []
+    moments = mgt.nn_feature_moments
+
+    def spy(h5f, covs, M, t0=0, t1=None, *args, **kw):
+        calls.append((t0, mgt.n_snaps(h5f, 'edge_features') if t1 is None else t1))
+        return moments(h5f, covs, M, t0, t1, *args, **kw)
+
+    monkeypatch.setattr(mgt, "nn_feature_moments", spy)
+    stages = ("EdgeNodeCovariance", "CalcMFactor") + bench_pipeline.MOMENT_STAGES
+    res = bench_pipeline.run_case(20, ntg=4, stages=stages, repeat=2,
+                                  workdir=str(tmp_path))
+    assert [r["stage"] for r in res] == ["generate"] + list(stages)
+    assert calls == [(0, 7*4)]*4
@@ -0,0 +1,62 @@
+import multiprocessing
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+dist_train = pytest.importorskip("dist_train")
+
+N_CALL = 6
+SIZE = 5
+
+
+def _vec(rank, call):
+    return rank*10. + call + np.arange(SIZE)
+
+
+class _LateReader(object):
+    # Holds the caller back after the barrier opens, so the other workers
+    # write their next rows while it has yet to read this call's mean
+    def __init__(self, barrier, delay):
+        self.barrier = barrier
+        self.delay = delay
+
+    def wait(self, timeout=None):
+        self.barrier.wait(timeout)
+        time.sleep(self.delay)
+
+
+def _mean_worker(rank, num_procs, buf, barrier, results):
+    mean = dist_train.SharedMean(buf, _LateReader(barrier, 0.2*(rank > 0)),
+                                 rank, num_procs, SIZE, np.float64)
+    out = []
+    for call in range(N_CALL):
+        out.append(mean(_vec(rank, call), timeout=60))
+    results.put((rank, np.array(out)))
+
+
+@pytest.mark.parametrize("num_procs", [1, 3])
+def test_shared_mean_across_processes(num_procs):
+    ctx = multiprocessing.get_context("spawn")
+    buf = ctx.RawArray('d', 2*num_procs*SIZE)
+    barrier = ctx.Barrier(num_procs)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_mean_worker,
+                         args=(rank, num_procs, buf, barrier, results))
+             for rank in range(num_procs)]
+    for p in procs:
+        p.start()
+    try:
+        got = dict(results.get(timeout=120) for _ in procs)
+    finally:
+        for p in procs:
+            p.join(10)
+            if p.is_alive():
+                p.terminate()
+    assert all(p.exitcode == 0 for p in procs)
+    expect = np.array([np.mean([_vec(r, c) for r in range(num_procs)], axis=0)
+                       for c in range(N_CALL)])
+    for rank in range(num_procs):
+        np.testing.assert_array_equal(got[rank], got[0])
+        np.testing.assert_allclose(got[rank], expect, rtol=1e-12)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+mgt = pytest.importorskip("my_graph_tools")
+from graph_nets import utils_tf  # noqa: E402
+
+
+def _input(seed=0):
+    rng = np.random.RandomState(seed)
+    dicts = [{"nodes": rng.rand(6, 4).astype(np.float32),
+              "edges": rng.rand(10, 13).astype(np.float32),
+              "globals": rng.rand(2).astype(np.float32),
+              "senders": rng.randint(0, 6, 10), "receivers": rng.randint(0, 6, 10)}
+             for _ in range(2)]
+    return utils_tf.data_dicts_to_graphs_tuple(dicts)
+
+
+@pytest.mark.parametrize("num_steps,output_every",
+                         [(1, 1), (4, 1), (4, 2), (5, 2), (4, 4)])
+def test_while_loop_matches_unrolled(num_steps, output_every):
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        inp = _input()
+        model = mgt.EncodeProcessDecode(edge_output_size=13, node_output_size=4)
+        unrolled = model(inp, num_steps, output_every=output_every)
+        n_var = len(tf.trainable_variables())
+        looped = model(inp, num_steps, output_every=output_every, use_while_loop=True)
+        # Both modes share the same weights
+        assert len(tf.trainable_variables()) == n_var
+        assert len(looped) == len(unrolled)
+
+        def loss(outs):
+            return tf.add_n([tf.reduce_sum(tf.square(o.nodes)) + tf.reduce_sum(tf.square(o.edges))
+                             for o in outs])
+
+        tvars = tf.trainable_variables()
+        grads_u = tf.gradients(loss(unrolled), tvars)
+        grads_l = tf.gradients(loss(looped), tvars)
+        # The decoder's globals are replaced by the input's, so its global
+        # MLP gets no gradient in either mode
+        assert [g is None for g in grads_u] == [g is None for g in grads_l]
+        grads_u = [g for g in grads_u if g is not None]
+        grads_l = [g for g in grads_l if g is not None]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            out_u, out_l, g_u, g_l = sess.run(
+                [[(o.nodes, o.edges, o.globals) for o in unrolled],
+                 [(o.nodes, o.edges, o.globals) for o in looped], grads_u, grads_l])
+    for a, b in zip(out_u, out_l):
+        for x, y in zip(a, b):
+            np.testing.assert_allclose(y, x, rtol=1e-5, atol=1e-6)
+    for x, y in zip(g_u, g_l):
+        np.testing.assert_allclose(y, x, rtol=1e-4, atol=1e-5)
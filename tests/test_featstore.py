@@ -0,0 +1,89 @@
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+featstore = pytest.importorskip("featstore")
+
+NTG = 6
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(mgt, "NTG", NTG)
+    path, out_dir = str(tmp_path/"week.hdf5"), str(tmp_path/"week.store")
+    bench_pipeline.make_synthetic_h5(path, 25, ntg=NTG, car_frac=0.3)
+    mgt.EdgeNodeCovariance(path)
+    mgt.CalcMFactor(path)
+    mgt.create_nn_inputset(path)
+    featstore.export_feature_store(path, out_dir)
+    return path, out_dir
+
+
+def _assert_graphs_equal(a, b):
+    for field in ("nodes", "edges", "globals", "senders", "receivers", "n_node", "n_edge"):
+        np.testing.assert_array_equal(getattr(a, field), getattr(b, field), err_msg=field)
+
+
+def test_store_reads_match_hdf5(store, capsys):
+    path, out_dir = store
+    T = 7*NTG
+    with h5py.File(path, 'r') as h5f, featstore.open_store(out_dir) as fs:
+        assert isinstance(fs, featstore.FeatureStore)
+        assert "Warning" not in capsys.readouterr().out
+        for name in featstore.FEATURE_GROUPS:
+            assert mgt.n_snaps(fs, name) == T
+            np.testing.assert_array_equal(mgt.read_snaps(fs, name, 0, T),
+                                          mgt.read_snaps(h5f, name, 0, T))
+        for name in featstore.STATIC_ARRAYS:
+            np.testing.assert_array_equal(fs[name], h5f[name][:])
+        np.testing.assert_array_equal(fs.daytg, [mgt.snap_daytg(t) for t in range(T)])
+
+        # Into a preallocated array, and wrapping round the end of the week
+        want = mgt.read_snaps(h5f, "nn_edge_features", T - 3, T + 4)
+        np.testing.assert_array_equal(want[3:], mgt.read_snaps(h5f, "nn_edge_features", 0, 4))
+        out = np.zeros_like(want)
+        assert mgt.read_snaps(fs, "nn_edge_features", T - 3, T + 4, out=out) is out
+        np.testing.assert_array_equal(out, want)
+
+        for ts in (range(5, 12), [T - 1, 0, 17, 3], [(6, NTG - 1), (0, 0)]):
+            _assert_graphs_equal(mgt.snaps2graph(fs, ts), mgt.snaps2graph(h5f, ts))
+            _assert_graphs_equal(mgt.snaps2graph(fs, ts, normalize=False),
+                                 mgt.snaps2graph(h5f, ts, normalize=False))
+        buf = mgt.copy_graph(mgt.snaps2graph(h5f, [0, 1, 2]))
+        assert mgt.snaps2graph(fs, [T - 1, 0, 9], out=buf) is buf
+        _assert_graphs_equal(buf, mgt.snaps2graph(h5f, [T - 1, 0, 9]))
+
+
+def test_store_views_are_read_only(store):
+    _, out_dir = store
+    with featstore.open_store(out_dir) as fs:
+        with pytest.raises(ValueError):
+            fs["nn_node_features"][0, 0, 0] = 1.
+        view = mgt.read_snaps(fs, "nn_node_features", 2, 6)
+        assert not view.flags.writeable
+        assert np.shares_memory(view, fs["nn_node_features"])
+        graph = mgt.snaps2graph(fs, range(2, 6))
+        with pytest.raises(ValueError):
+            graph.nodes[0, 0] = 1.
+        copy = mgt.copy_graph(graph)
+        copy.nodes[0, 0] = 1.
+        assert graph.nodes[0, 0] != 1.
+
+
+def test_store_keeps_the_source_ntg(store, monkeypatch, capsys):
+    path, out_dir = store
+    with featstore.open_store(out_dir) as fs:
+        assert fs.manifest["ntg"] == NTG
+    # A process with another NTG is warned about the store's
+    monkeypatch.setattr(mgt, "NTG", 2*NTG)
+    capsys.readouterr()
+    with featstore.open_store(out_dir) as fs:
+        np.testing.assert_array_equal(fs.daytg[NTG], [1, 0])
+    assert "ntg = " + str(NTG) in capsys.readouterr().out
+    # Exporting under the wrong NTG still indexes by the file's
+    featstore.export_feature_store(path, out_dir)
+    with featstore.open_store(out_dir) as fs:
+        assert fs.manifest["ntg"] == NTG
+        np.testing.assert_array_equal(fs.daytg[NTG], [1, 0])
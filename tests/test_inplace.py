@@ -0,0 +1,71 @@
+import gc
+import tracemalloc
+
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+
+
+def _write_nn(path, n_node=4000, degree=3, T=16):
+    # Just the groups snaps2graph reads; a week-long loop cycles through them
+    rng = np.random.default_rng(0)
+    senders = np.repeat(np.arange(n_node), degree)
+    receivers = rng.integers(0, n_node, size=senders.size)
+    with h5py.File(path, 'w') as h5f:
+        h5f.create_dataset("senders", data=senders)
+        h5f.create_dataset("receivers", data=receivers)
+        h5f.attrs['n_nodes'] = n_node
+        for name, n_ent, n_ft in (("nn_edge_features", senders.size, 13),
+                                  ("nn_node_features", n_node, 4),
+                                  ("nn_glbl_features", 1, 2)):
+            h5f.create_dataset(name, data=rng.normal(size=(T, n_ent, n_ft)).astype(mgt.FLOAT_DTYPE))
+    stats = [np.stack([rng.normal(size=n), 1 + rng.random(n)]) for n in (4, 13)]
+    return T, stats
+
+
+def _traced(fn, nsteps):
+    # (growth after a final collection, peak), both from the start
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for t in range(nsteps):
+            fn(t)
+        peak = tracemalloc.get_traced_memory()[1]
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0] - start, peak - start
+    finally:
+        tracemalloc.stop()
+
+
+def test_inplace_rollout_memory_is_flat(tmp_path):
+    path = str(tmp_path/"nn.hdf5")
+    T, (node_stats, edge_stats) = _write_nn(path)
+    mgt.clear_topology_cache()
+    with h5py.File(path, 'r') as h5f:
+        graph = mgt.snaps2graph(h5f, [0])
+        state = mgt.copy_graph(graph)
+        prev = mgt.copy_graph(graph)
+        snap_bytes = graph.nodes.nbytes + graph.edges.nbytes
+
+        def inplace(t):
+            mgt.copy_graph(state, out=prev)
+            mgt.snaps2graph(h5f, [t % T], out=graph)
+            mgt.unnorm_graph(graph, node_stats, edge_stats, out=state)
+
+        def allocating(t):
+            mgt.unnorm_graph(mgt.snaps2graph(h5f, [t % T]), node_stats, edge_stats)
+
+        for t in range(T):
+            inplace(t)
+        # A week of 30-minute steps
+        growth, peak = _traced(inplace, 7*48)
+        assert growth < 16*1024
+        assert peak < snap_bytes/2
+        np.testing.assert_allclose(
+            state.edges, mgt.my_unnorm(h5f['nn_edge_features'][(7*48 - 1) % T], edge_stats),
+            rtol=1e-6)
+        # The same loop allocating every step, to show the bound means something
+        assert _traced(allocating, 10)[1] > snap_bytes
@@ -0,0 +1,75 @@
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+
+
+def _write_tiny(path, edge_cars, node_cars):
+    # 3 nodes, edges 0->1, 1->2, 0->2, time-major features
+    with h5py.File(path, 'w') as h5f:
+        h5f.create_dataset("senders", data=np.array([0, 1, 0]))
+        h5f.create_dataset("receivers", data=np.array([1, 2, 2]))
+        h5f.attrs['n_nodes'] = 3
+        h5f.attrs['n_edges'] = 3
+        edges = np.zeros(np.shape(edge_cars) + (4,))
+        edges[..., 0] = edge_cars
+        nodes = np.zeros(np.shape(node_cars) + (3,))
+        nodes[..., 0] = node_cars
+        h5f.create_dataset("edge_features", data=edges)
+        h5f.create_dataset("node_features", data=nodes)
+
+
+def _read_M(path):
+    with h5py.File(path, 'r') as h5f:
+        return h5f['M'][:]
+
+
+@pytest.mark.parametrize("engine", ["loop", "vectorized"])
+def test_mfactor_hand_computed(tmp_path, engine):
+    # Two snapshots; the pairs are (edges t0, nodes t1) and, wrapping, (edges t1, nodes t0).
+    # Incoming cars at t0: node0 0, node1 1, node2 0+2; at t1 none.
+    #   pair 0, nodes t1 = [0,2,0]: node0 idle, node1 2-1, node2 0-2
+    #   pair 1, nodes t0 = [3,0,1]: node0 3-0, node1 idle, node2 1-0
+    # Each node differences its own count; the baseline used node 0's count
+    # (0 in pair 0, 3 in pair 1) for every node.
+    path = str(tmp_path/"tiny.hdf5")
+    _write_tiny(path, [[1, 0, 2], [0, 0, 0]], [[3, 0, 1], [0, 2, 0]])
+    mgt.CalcMFactor(path, engine=engine)
+    np.testing.assert_array_equal(_read_M(path), [3., 1., (-2.+1.)/2])
+    mgt.CalcMFactor(path, engine=engine, legacy_diff=True)
+    np.testing.assert_array_equal(_read_M(path), [3., -1., (-2.+3.)/2])
+
+
+def _baseline_mfactor(path):
+    # The original CalcMFactor loop, over time-major snapshots
+    with h5py.File(path, 'r') as h5f:
+        receivers = h5f['receivers'][:]
+        edges = h5f['edge_features'][:]
+        nodes = h5f['node_features'][:]
+    n_node, T = nodes.shape[1], nodes.shape[0]
+    M = np.zeros(n_node)
+    ks = np.ones(n_node)
+    for t in range(T):
+        ncars_n = nodes[(t+1) % T, :, 0]
+        ncars_e = edges[t, :, 0]
+        for i in range(n_node):
+            ncar_e = ncars_e[receivers == i].sum()
+            if ncar_e == 0 and ncars_n[i] == 0:
+                continue
+            M[i] += (ncars_n[0] - ncar_e - M[i])/ks[i]
+            ks[i] += 1
+    return M
+
+
+@pytest.mark.parametrize("legacy_diff", [False, True])
+def test_mfactor_engines_agree(tmp_path, legacy_diff):
+    path = str(tmp_path/"synth.hdf5")
+    bench_pipeline.make_synthetic_h5(path, 40, degree=3, ntg=12, car_frac=0.2)
+    mgt.CalcMFactor(path, engine="loop", legacy_diff=legacy_diff)
+    M_loop = _read_M(path)
+    mgt.CalcMFactor(path, engine="vectorized", legacy_diff=legacy_diff)
+    np.testing.assert_allclose(_read_M(path), M_loop, rtol=1e-12, atol=1e-12)
+    if legacy_diff:
+        np.testing.assert_allclose(M_loop, _baseline_mfactor(path), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,81 @@
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+
+
+def _stats(path):
+    with h5py.File(path, 'r') as h5f:
+        return h5f['node_stats'][:], h5f['edge_stats'][:]
+
+
+def _fresh_stats(path, tmp_path, fn):
+    # fn on a copy of the file without the stored moments
+    copy = str(tmp_path/"fresh.hdf5")
+    shutil.copy(path, copy)
+    with h5py.File(copy, 'a') as h5f:
+        for name in ("edge_moments", "node_moments", "moments_digests"):
+            if name in h5f:
+                del h5f[name]
+    fn(copy)
+    return _stats(copy)
+
+
+@pytest.mark.parametrize("stage", ["get_norm_stats", "create_nn_inputset"])
+def test_stored_moments_follow_raw_edits(tmp_path, stage):
+    fn = getattr(mgt, stage)
+    path = str(tmp_path/"synth.hdf5")
+    bench_pipeline.make_synthetic_h5(path, 30, ntg=4)
+    mgt.EdgeNodeCovariance(path)
+    mgt.CalcMFactor(path)
+    fn(path)
+    before = _stats(path)
+
+    # Edge lengths and node columns 1-2 feed neither covs nor M
+    with h5py.File(path, 'a') as h5f:
+        h5f['edge_features'][5, :, 3] *= 2
+        h5f['node_features'][7, :, 1:] += 1
+    fn(path)
+    after = _stats(path)
+    expect = _fresh_stats(path, tmp_path, fn)
+    for a, b, e in zip(before, after, expect):
+        assert not np.allclose(a, b)
+        np.testing.assert_allclose(b, e, rtol=1e-12)
+
+
+def test_appended_snapshots_fold_in(tmp_path):
+    path = str(tmp_path/"synth.hdf5")
+    bench_pipeline.make_synthetic_h5(path, 30, ntg=4)
+    mgt.EdgeNodeCovariance(path)
+    mgt.CalcMFactor(path)
+    # Moments of the first half only, as if the second half was appended later
+    with h5py.File(path, 'a') as h5f:
+        covs, M = h5f['edge_node_covs'][:], h5f['M'][:]
+        digests = mgt.snapshot_digests(h5f)
+        T = len(digests)
+        e_mom, n_mom = mgt.nn_feature_moments(h5f, covs, M, 0, T//2)
+        mgt._save_moments(h5f, e_mom, n_mom, T//2, mgt._array_digest(covs, M), digests)
+        assert mgt._load_moments(h5f, mgt._array_digest(covs, M), digests)[2] == T//2
+    mgt.get_norm_stats(path)
+    expect = _fresh_stats(path, tmp_path, mgt.get_norm_stats)
+    for a, e in zip(_stats(path), expect):
+        np.testing.assert_allclose(a, e, rtol=1e-12)
+
+
+def test_constant_features_normalize_to_zero(tmp_path):
+    # Simulator output has all-zero raw columns
+    path = str(tmp_path/"synth.hdf5")
+    bench_pipeline.make_synthetic_h5(path, 30, ntg=4)
+    with h5py.File(path, 'a') as h5f:
+        h5f['node_features'][:, :, 2] = 0
+    mgt.preprocess(path, resume=False)
+    node_stats, edge_stats = _stats(path)
+    assert node_stats[1, 2] == 1
+    with h5py.File(path, 'r') as h5f:
+        graph = mgt.snaps2graph(h5f, [0, 1])
+    assert np.all(np.isfinite(graph.nodes)) and np.all(np.isfinite(graph.edges))
+    np.testing.assert_array_equal(graph.nodes[:, 2], 0)
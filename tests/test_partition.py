@@ -0,0 +1,107 @@
+import multiprocessing
+import threading
+
+import h5py
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+mgt = pytest.importorskip("my_graph_tools")
+graph_build = pytest.importorskip("graph_build")
+partition = pytest.importorskip("partition")
+
+
+def _graph(n_node=200, seed=1):
+    return graph_build.build_graph(graph_build.random_nodes(n_node, seed=seed), k=4)
+
+
+def test_rcb_partition_is_balanced():
+    g = _graph(1003)
+    for n_parts in (2, 3, 7):
+        part = partition.rcb_partition(g["node_coords"], n_parts)
+        sizes = np.bincount(part, minlength=n_parts)
+        assert sizes.max() - sizes.min() <= 1
+
+
+@pytest.mark.parametrize("n_parts", [1, 2, 4])
+def test_halo_exchange_gives_one_hop_sums(n_parts):
+    # Each part fills only its owned rows; after one exchange, summing the
+    # senders' rows over the local edges must give the full graph's
+    # segment sum over receivers for every owned node
+    g = _graph()
+    senders, receivers = g["senders"], g["receivers"]
+    n_node, B, size = g["node_coords"].shape[0], 2, 3
+    x = np.random.default_rng(0).normal(size=(B, n_node, size))
+    expect = np.stack([np.bincount(receivers, weights=x[b, senders, j], minlength=n_node)
+                       for b in range(B) for j in range(size)], axis=1)
+    expect = expect.reshape(n_node, B, size).transpose(1, 0, 2)
+
+    parts = partition.build_partitions(
+        senders, receivers, partition.rcb_partition(g["node_coords"], n_parts))
+    assert sorted(np.concatenate([p.nodes[:p.n_owned] for p in parts])) == list(range(n_node))
+    assert sorted(np.concatenate([p.edges for p in parts])) == list(range(len(senders)))
+    n_exports = [p.exports.size for p in parts]
+    bufs = [multiprocessing.RawArray('d', max(1, 2*B*n*size)) for n in n_exports]
+    barrier = threading.Barrier(n_parts)
+    got = np.full((B, n_node, size), np.nan)
+
+    def run(rank):
+        p = parts[rank]
+        local = np.full((B, p.nodes.size, size), np.nan)
+        local[:, :p.n_owned] = x[:, p.nodes[:p.n_owned]]
+        partition.HaloExchange(p, rank, bufs, n_exports, barrier, B, size,
+                               np.float64)(local, timeout=10)
+        agg = np.zeros((B, p.nodes.size, size))
+        np.add.at(agg, (slice(None), p.receivers), local[:, p.senders])
+        got[:, p.nodes[:p.n_owned]] = agg[:, :p.n_owned]
+
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(n_parts)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    np.testing.assert_allclose(got, expect, rtol=1e-12, atol=1e-12)
+
+
+def _write_nn(path, g, T=4):
+    graph_build.write_graph(path, g)
+    rng = np.random.default_rng(0)
+    with h5py.File(path, 'a') as h5f:
+        for name, n_ent, n_ft in (("nn_edge_features", len(g["senders"]), 13),
+                                  ("nn_node_features", g["node_coords"].shape[0], 4),
+                                  ("nn_glbl_features", 1, 2)):
+            h5f.create_dataset(name, data=rng.normal(size=(T, n_ent, n_ft)).astype(mgt.FLOAT_DTYPE))
+
+
+@pytest.mark.parametrize("n_parts,num_steps", [(2, 3), (4, 1), (3, 4)])
+def test_partitioned_epd_matches_full_model(tmp_path, n_parts, num_steps):
+    path, ckpt = str(tmp_path/"city.hdf5"), str(tmp_path/"model.ckpt")
+    _write_nn(path, _graph())
+    ts = [1, 3]
+    mgt.clear_topology_cache()
+    with h5py.File(path, 'r') as h5f:
+        full = mgt.snaps2graph(h5f, ts)
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        inp = full.map(tf.convert_to_tensor, fields=("nodes", "edges", "globals",
+                                                     "senders", "receivers",
+                                                     "n_node", "n_edge"))
+        # Built like StaticBatchTrainer's model, so the checkpoint matches
+        model = mgt.EncodeProcessDecode(edge_output_size=13, node_output_size=4)
+        out_op = model(inp, num_steps)[-1]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            expect = sess.run(out_op)
+            tf.train.Saver().save(sess, ckpt)
+
+    with partition.PartitionedEPD(path, ckpt, n_parts, batch_size=2,
+                                  num_processing_steps=num_steps, timeout=120.) as pm:
+        got = pm.run(ts)
+        # A short batch is padded and trimmed again
+        one = pm.run(ts[1:])
+    for field in ("nodes", "edges", "globals", "senders", "receivers"):
+        np.testing.assert_allclose(getattr(got, field), getattr(expect, field),
+                                   rtol=1e-4, atol=1e-5)
+    n_node, n_edge = expect.n_node[0], expect.n_edge[0]
+    np.testing.assert_allclose(one.nodes, expect.nodes[n_node:], rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(one.edges, expect.edges[n_edge:], rtol=1e-4, atol=1e-5)
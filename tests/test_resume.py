@@ -0,0 +1,160 @@
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+
+OUTPUTS = ("edge_node_covs", "M", "nn_edge_features", "nn_node_features",
+           "nn_glbl_features", "node_stats", "edge_stats", "glbl_stats")
+RAW = ("edge_features", "node_features", "glbl_features")
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # Blocks of 5 snapshots and a checkpoint every 2 blocks, so a 56
+    # snapshot file has several checkpoints and a ragged last block
+    monkeypatch.setattr(mgt, "BLOCK_T", 5)
+    monkeypatch.setattr(mgt, "CHECKPOINT_BLOCKS", 2)
+
+
+def _outputs(path):
+    with h5py.File(path, 'r') as h5f:
+        return dict((name, h5f[name][:]) for name in OUTPUTS)
+
+
+def _fresh(src, tmp_path, name="fresh.hdf5"):
+    path = str(tmp_path/name)
+    shutil.copy(src, path)
+    mgt.preprocess(path, resume=False)
+    return _outputs(path)
+
+
+def _assert_same(got, want):
+    for name in OUTPUTS:
+        np.testing.assert_array_equal(got[name], want[name], err_msg=name)
+
+
+def _synthetic(tmp_path, ntg=8):
+    path = str(tmp_path/"raw.hdf5")
+    bench_pipeline.make_synthetic_h5(path, 30, degree=3, ntg=ntg, car_frac=0.4)
+    return path
+
+
+def _crash_after(monkeypatch, name, n_calls):
+    # Make mgt.<name> raise on its n_calls-th call; returns the call counter
+    real = getattr(mgt, name)
+    calls = []
+
+    def wrapped(*args, **kw):
+        calls.append(1)
+        if len(calls) == n_calls:
+            raise RuntimeError("crash")
+        return real(*args, **kw)
+    monkeypatch.setattr(mgt, name, wrapped)
+    return calls
+
+
+def _counting(monkeypatch, name):
+    real = getattr(mgt, name)
+    calls = []
+
+    def wrapped(*args, **kw):
+        calls.append(1)
+        return real(*args, **kw)
+    monkeypatch.setattr(mgt, name, wrapped)
+    return calls
+
+
+@pytest.mark.parametrize("stage,fn,checkpoint", [
+    ("covs", "_covs_block_update", "resume/edge_node_covs"),
+    ("mfactor", "_mfactor_update", "resume/mfactor")])
+def test_crash_resumes_from_checkpoint(tmp_path, monkeypatch, stage, fn, checkpoint):
+    src = _synthetic(tmp_path)
+    want = _fresh(src, tmp_path)
+    path = str(tmp_path/"run.hdf5")
+    shutil.copy(src, path)
+    with monkeypatch.context() as m:
+        _crash_after(m, fn, 8)
+        with pytest.raises(RuntimeError):
+            mgt.preprocess(path)
+    with h5py.File(path, 'r') as h5f:
+        # The crash hit the 8th block, after the checkpoint of the 6th
+        assert h5f[checkpoint].attrs['n_done'] == 30
+    calls = _counting(monkeypatch, fn)
+    mgt.preprocess(path)
+    # 55 pairs in blocks of 5, of which the first 6 were checkpointed, and
+    # the wrap-around pair
+    assert len(calls) == 11 - 6 + 1
+    _assert_same(_outputs(path), want)
+
+
+def test_crash_during_nn_write(tmp_path, monkeypatch):
+    src = _synthetic(tmp_path)
+    want = _fresh(src, tmp_path)
+    path = str(tmp_path/"run.hdf5")
+    shutil.copy(src, path)
+    with monkeypatch.context() as m:
+        # Fails half way through the 5th block's three groups
+        _crash_after(m, "write_snaps", 3*4 + 2)
+        with pytest.raises(RuntimeError):
+            mgt.preprocess(path)
+    with h5py.File(path, 'r') as h5f:
+        done = h5f["resume/nn_done"][:]
+    assert np.all(done[:20] != 0) and np.all(done[20:] == 0)
+    writes = _counting(monkeypatch, "write_snaps")
+    mgt.preprocess(path)
+    # Only the 8 blocks from snapshot 20 on are rewritten
+    assert len(writes) == 3*8
+    _assert_same(_outputs(path), want)
+    # Nothing left to do
+    writes[:] = []
+    mgt.preprocess(path)
+    assert len(writes) == 0
+    _assert_same(_outputs(path), want)
+
+
+def test_appended_snapshots(tmp_path, monkeypatch):
+    src = _synthetic(tmp_path)
+    want = _fresh(src, tmp_path)
+    with h5py.File(src, 'r') as h5f:
+        T = mgt.n_snaps(h5f, 'edge_features')
+        full = dict((name, h5f[name][:]) for name in RAW)
+    path = str(tmp_path/"run.hdf5")
+    shutil.copy(src, path)
+    n_first = 33
+    with h5py.File(path, 'a') as h5f:
+        for name in RAW:
+            h5f[name].resize(n_first, axis=0)
+    mgt.preprocess(path)
+    _assert_same(_outputs(path), _fresh(path, tmp_path, "first.hdf5"))
+
+    with h5py.File(path, 'a') as h5f:
+        for name in RAW:
+            h5f[name].resize(T, axis=0)
+            mgt.write_snaps(h5f, name, n_first, full[name][n_first:])
+    calls = _counting(monkeypatch, "_covs_block_update")
+    mgt.preprocess(path)
+    # The covs pick up from the first run's last pair instead of starting
+    # over, then fold in the new wrap-around pair
+    assert len(calls) == len(range(n_first - 1, T - 1, 5)) + 1
+    _assert_same(_outputs(path), want)
+
+
+def test_mid_file_edit(tmp_path, monkeypatch):
+    src = _synthetic(tmp_path)
+    path = str(tmp_path/"run.hdf5")
+    shutil.copy(src, path)
+    mgt.preprocess(path)
+    with h5py.File(path, 'a') as h5f:
+        edges = mgt.read_snaps(h5f, 'edge_features', 23, 24)
+        edges[0, :, 0] += 1
+        mgt.write_snaps(h5f, 'edge_features', 23, edges)
+    want = _fresh(path, tmp_path)
+    writes = _counting(monkeypatch, "write_snaps")
+    mgt.preprocess(path)
+    # New covs and M change every snapshot's nn features
+    assert len(writes) == 3*12
+    _assert_same(_outputs(path), want)
@@ -0,0 +1,79 @@
+import h5py
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+mgt = pytest.importorskip("my_graph_tools")
+graph_build = pytest.importorskip("graph_build")
+rollout = pytest.importorskip("rollout")
+train = pytest.importorskip("train")
+
+NTG = 4
+
+
+def _write_nn(path, T=7*NTG):
+    g = graph_build.build_graph(graph_build.random_nodes(30, seed=1), k=3)
+    graph_build.write_graph(path, g)
+    rng = np.random.default_rng(0)
+    ts = np.arange(T)
+    glbls = (np.stack([(ts//NTG) % 7, ts % NTG], axis=1) - mgt._glbl_norm_stats()[0]) \
+        / mgt._glbl_norm_stats()[1]
+    with h5py.File(path, 'a') as h5f:
+        for name, n_ent, n_ft in (("nn_edge_features", len(g["senders"]), 13),
+                                  ("nn_node_features", g["node_coords"].shape[0], 4)):
+            h5f.create_dataset(name, data=rng.normal(size=(T, n_ent, n_ft)).astype(mgt.FLOAT_DTYPE))
+        h5f.create_dataset("nn_glbl_features", data=glbls[:, None].astype(mgt.FLOAT_DTYPE))
+
+
+@pytest.mark.parametrize("horizon", [1, 2, 5])
+def test_rollout_matches_stepping_by_hand(tmp_path, monkeypatch, horizon):
+    monkeypatch.setattr(mgt, "NTG", NTG)
+    path = str(tmp_path/"city.hdf5")
+    _write_nn(path)
+    # Two full batches and a short one, with a start whose globals wrap
+    # round the end of the week
+    starts = [0, 3, 7, 26, 27, 12, 5]
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        model = mgt.EncodeProcessDecode(edge_output_size=13, node_output_size=4)
+        ro = rollout.Rollout(model, path, n_start=3, horizon=horizon,
+                             output_steps=range(1, horizon + 1))
+        with h5py.File(path, 'r') as h5f:
+            topo = mgt.get_topology(h5f)
+            inp = [mgt.snaps2graph(h5f, [t]) for t in starts]
+        one_ph = train.static_batch_graph(topo, 1, 4, 13, 2, name="one")
+        one_out = model(one_ph, 3, output_every=3)[-1]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            preds = ro.run(sess, starts)
+            for i, graph in enumerate(inp):
+                for step in range(1, horizon + 1):
+                    nodes, edges = sess.run([one_out.nodes, one_out.edges],
+                                            feed_dict=train.feed_features(one_ph, graph))
+                    graph = graph.replace(
+                        nodes=np.where(ro._node_mask > 0, graph.nodes, nodes),
+                        edges=np.where(ro._edge_mask > 0, graph.edges, edges),
+                        globals=rollout.advance_globals_np(graph.globals, ro.glbl_stats))
+                    pred = preds[step]
+                    n_node, n_edge = pred.n_node[i], pred.n_edge[i]
+                    np.testing.assert_allclose(pred.nodes[i*n_node:(i+1)*n_node],
+                                               graph.nodes, rtol=1e-4, atol=1e-5)
+                    np.testing.assert_allclose(pred.edges[i*n_edge:(i+1)*n_edge],
+                                               graph.edges, rtol=1e-4, atol=1e-5)
+                    np.testing.assert_allclose(pred.globals[i], graph.globals[0],
+                                               rtol=1e-5, atol=1e-6)
+    assert sorted(preds) == list(range(1, horizon + 1))
+    assert all(p.n_node.size == len(starts) for p in preds.values())
+
+
+def test_advance_globals_wraps_the_week(monkeypatch):
+    monkeypatch.setattr(mgt, "NTG", NTG)
+    stats = mgt._glbl_norm_stats()
+    ts = np.arange(7*NTG)
+    raw = np.stack([(ts//NTG) % 7, ts % NTG], axis=1)
+    glbls = ((raw - stats[0])/stats[1]).astype(np.float32)
+    nxt = rollout.advance_globals_np(glbls, stats)
+    np.testing.assert_allclose(nxt, np.roll(glbls, -1, axis=0), rtol=1e-6, atol=1e-6)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        np.testing.assert_allclose(sess.run(rollout.advance_globals(tf.constant(glbls), stats)),
+                                   nxt, rtol=1e-6, atol=1e-6)
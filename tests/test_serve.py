@@ -0,0 +1,135 @@
+import json
+import urllib.error
+import urllib.request
+
+import h5py
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+mgt = pytest.importorskip("my_graph_tools")
+graph_build = pytest.importorskip("graph_build")
+serve = pytest.importorskip("serve")
+
+
+class _EchoSession(object):
+    # Stands in for the restored model: returns the normalized node and
+    # edge features it is fed, so a prediction unnormalizes back to the
+    # request's own nn features
+    def __init__(self, graph=None):
+        self.batch_sizes = []
+        self.fail = False
+
+    def run(self, fetches, feed_dict):
+        if self.fail:
+            raise RuntimeError("session failed")
+        feeds = dict((k.name.split("/")[-1].split(":")[0], v) for k, v in feed_dict.items())
+        self.batch_sizes.append(len(feeds["globals"]))
+        return [feeds["nodes"], feeds["edges"]]
+
+    def close(self):
+        pass
+
+
+class _NoRestore(object):
+    def restore(self, sess, path):
+        pass
+
+
+def _write_city(path):
+    g = graph_build.build_graph(graph_build.random_nodes(20, seed=1), k=3)
+    graph_build.write_graph(path, g)
+    rng = np.random.default_rng(0)
+    n_node, n_edge = g["node_coords"].shape[0], len(g["senders"])
+    with h5py.File(path, 'a') as h5f:
+        h5f.create_dataset("edge_node_covs", data=rng.normal(size=(n_edge, 3)))
+        h5f.create_dataset("M", data=rng.normal(size=(n_node,)))
+        h5f.create_dataset("edge_stats", data=np.stack([rng.normal(size=13),
+                                                        rng.uniform(0.5, 2., 13)]))
+        h5f.create_dataset("node_stats", data=np.stack([rng.normal(size=4),
+                                                        rng.uniform(0.5, 2., 4)]))
+        h5f.create_dataset("glbl_stats", data=mgt._glbl_norm_stats())
+    return n_node, n_edge
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    path = str(tmp_path/"city.hdf5")
+    _write_city(path)
+    monkeypatch.setattr(serve.tf, "Session", _EchoSession)
+    monkeypatch.setattr(serve.tf.train, "Saver", _NoRestore)
+    srv = serve.InferenceServer(path, "unused.ckpt", max_batch=8, max_delay_ms=200.)
+    yield srv
+    srv.close()
+
+
+def _request(srv, seed):
+    rng = np.random.default_rng(seed)
+    edges = rng.uniform(0., 5., size=(srv.n_edge, 4))
+    edges[:, 3] += 1.
+    return {"edges": edges, "nodes": rng.uniform(0., 5., size=(srv.n_node, 3)),
+            "globals": (seed % 7, mgt.NTG - 1)}
+
+
+def test_batched_predictions_round_trip(server):
+    reqs = [_request(server, seed) for seed in range(5)]
+    futs = [server.submit(r) for r in reqs]
+    preds = [f.result(30) for f in futs]
+    # One batch of 5, padded to the next power of two
+    assert server.sess.batch_sizes == [8]
+    assert server.stats()["mean_batch"] == 5.
+    for req, pred in zip(reqs, preds):
+        e = np.asarray(req["edges"], dtype=mgt.FLOAT_DTYPE)[None]
+        n = np.asarray(req["nodes"], dtype=mgt.FLOAT_DTYPE)[None]
+        np.testing.assert_allclose(pred.edges, mgt._edge_nn_features(e, server.covs)[0],
+                                   rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(pred.nodes, mgt._node_nn_features(n, server.M)[0],
+                                   rtol=1e-5, atol=1e-5)
+        day = req["globals"][0]
+        np.testing.assert_array_equal(pred.globals, [[(day + 1) % 7, 0]])
+
+
+def _http(port, method, path, body=None):
+    data = None if body is None else body.encode()
+    req = urllib.request.Request("http://127.0.0.1:" + str(port) + path, data=data,
+                                 method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.status, json.loads(resp.read().decode())
+    except urllib.error.HTTPError as err:
+        return err.code, json.loads(err.read().decode())
+
+
+def test_http_status_codes(server):
+    httpd = serve.serve_http(server, port=0, block=False)
+    port = httpd.server_address[1]
+    try:
+        req = _request(server, 3)
+        good = json.dumps({"edges": req["edges"].tolist(), "nodes": req["nodes"].tolist(),
+                           "globals": list(req["globals"])})
+        code, body = _http(port, "POST", "/predict", good)
+        assert code == 200
+        pred = server.predict(req)
+        np.testing.assert_allclose(body["edges"], pred.edges, rtol=1e-6)
+        np.testing.assert_allclose(body["nodes"], pred.nodes, rtol=1e-6)
+        assert body["globals"] == pred.globals[0].tolist()
+
+        assert _http(port, "GET", "/stats")[0] == 200
+        assert _http(port, "GET", "/nope")[0] == 404
+        assert _http(port, "POST", "/nope", good)[0] == 404
+        assert _http(port, "POST", "/predict", "{not json")[0] == 400
+        assert _http(port, "POST", "/predict", json.dumps({"edges": []}))[0] == 400
+        short = json.dumps({"edges": [[1., 1., 1., 1.]], "nodes": req["nodes"].tolist(),
+                            "globals": [0, 0]})
+        assert _http(port, "POST", "/predict", short)[0] == 400
+
+        server.sess.fail = True
+        code, body = _http(port, "POST", "/predict", good)
+        assert code == 500
+        assert "session failed" in body["error"]
+        # The batching thread survives a failed batch
+        server.sess.fail = False
+        assert _http(port, "POST", "/predict", good)[0] == 200
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
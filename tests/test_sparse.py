@@ -0,0 +1,106 @@
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+
+NN = ("nn_edge_features", "nn_node_features", "nn_glbl_features")
+
+
+def _block(rng, T=9, n_ent=12, n_ft=4):
+    base = rng.normal(size=(n_ent, n_ft)).astype(mgt.FLOAT_DTYPE)
+    arr = np.repeat(base[None], T, axis=0)
+    act = rng.random((T, n_ent)) < 0.3
+    arr[act] = rng.normal(size=(act.sum(), n_ft))
+    # A changed row that only differs in its last feature
+    arr[2, 5, -1] += 1.
+    return arr, base
+
+
+def test_sparsify_densify_round_trip():
+    rng = np.random.default_rng(0)
+    arr, base = _block(rng)
+    blk = mgt.sparsify(arr, base)
+    assert blk.indptr[-1] == np.any(arr != base, axis=2).sum()
+    np.testing.assert_array_equal(mgt.densify(blk), arr)
+    out = np.full_like(arr, np.nan)
+    assert mgt.densify(blk, out=out) is out
+    np.testing.assert_array_equal(out, arr)
+    # No rows stored when nothing differs
+    empty = mgt.sparsify(np.repeat(base[None], 3, axis=0), base)
+    assert empty.index.size == 0
+    np.testing.assert_array_equal(mgt.densify(empty), np.repeat(base[None], 3, axis=0))
+
+
+def test_sparse_group_reads_like_dense(tmp_path):
+    rng = np.random.default_rng(1)
+    arr, base = _block(rng, T=23)
+    with h5py.File(str(tmp_path/"s.hdf5"), 'w') as h5f:
+        mgt.create_snapset(h5f, "edge_features", 0, 12, 4, layout="sparse", base=base)
+        for t0 in range(0, 23, 5):
+            mgt.write_snaps(h5f, "edge_features", t0, arr[t0:t0+5])
+        assert mgt.get_layout(h5f, "edge_features") == "sparse"
+        assert mgt.n_snaps(h5f, "edge_features") == 23
+        np.testing.assert_array_equal(mgt.read_snaps(h5f, "edge_features", 0, 23), arr)
+        # Reads wrap round the end like the dense layouts
+        np.testing.assert_array_equal(mgt.read_snaps(h5f, "edge_features", 20, 26),
+                                      arr[np.arange(20, 26) % 23])
+        np.testing.assert_array_equal(
+            mgt.densify(mgt.read_snaps_active(h5f, "edge_features", 4, 17)), arr[4:17])
+
+
+def test_sparse_groups_are_append_only(tmp_path):
+    rng = np.random.default_rng(2)
+    arr, base = _block(rng)
+    with h5py.File(str(tmp_path/"s.hdf5"), 'w') as h5f:
+        mgt.create_snapset(h5f, "edge_features", 0, 12, 4, layout="sparse", base=base)
+        with pytest.raises(ValueError):
+            mgt.write_snaps(h5f, "edge_features", 1, arr[:3])
+        mgt.write_snaps(h5f, "edge_features", 0, arr[:3])
+        # Neither a gap nor an overwrite of written snapshots
+        with pytest.raises(ValueError):
+            mgt.write_snaps(h5f, "edge_features", 4, arr[4:6])
+        with pytest.raises(ValueError):
+            mgt.write_snaps(h5f, "edge_features", 2, arr[2:6])
+        # SparseBlocks are stored as they are against the group's base
+        # rows, and rebased against any other
+        mgt.write_snaps(h5f, "edge_features", 3, mgt.sparsify(arr[3:5], base))
+        mgt.write_snaps(h5f, "edge_features", 5, mgt.sparsify(arr[5:], mgt.sparse_base(arr[5:])))
+        np.testing.assert_array_equal(mgt.read_snaps(h5f, "edge_features", 0, 9), arr)
+
+
+def _preprocess(path, **nn_kw):
+    mgt.EdgeNodeCovariance(path)
+    mgt.CalcMFactor(path)
+    mgt.create_nn_inputset(path, **nn_kw)
+    with h5py.File(path, 'r') as h5f:
+        T = mgt.n_snaps(h5f, 'edge_features')
+        out = dict((name, h5f[name][:]) for name in
+                   ("edge_node_covs", "M", "node_stats", "edge_stats", "glbl_stats"))
+        for name in NN:
+            out[name] = mgt.read_snaps(h5f, name, 0, T)
+        out["nn_layout"] = mgt.get_layout(h5f, "nn_edge_features")
+    return out
+
+
+@pytest.mark.parametrize("nn_layout", [None, "sparse"])
+def test_sparse_raw_features_match_timemajor(tmp_path, nn_layout):
+    dense, sparse = str(tmp_path/"dense.hdf5"), str(tmp_path/"sparse.hdf5")
+    bench_pipeline.make_synthetic_h5(dense, 40, ntg=10, car_frac=0.2)
+    bench_pipeline.make_synthetic_h5(sparse, 40, ntg=10, car_frac=0.2, layout="sparse")
+    with h5py.File(dense, 'r') as a, h5py.File(sparse, 'r') as b:
+        assert mgt.get_layout(b, "edge_features") == "sparse"
+        for name in ("edge_features", "node_features", "glbl_features"):
+            np.testing.assert_array_equal(mgt.read_snaps(b, name, 0, 70),
+                                          mgt.read_snaps(a, name, 0, 70))
+    want = _preprocess(dense)
+    got = _preprocess(sparse, layout=nn_layout)
+    assert want["nn_layout"] == "timemajor"
+    assert got["nn_layout"] == (nn_layout or "timemajor")
+    np.testing.assert_array_equal(got["edge_node_covs"], want["edge_node_covs"])
+    np.testing.assert_allclose(got["M"], want["M"], rtol=1e-12, atol=1e-12)
+    for name in ("node_stats", "edge_stats", "glbl_stats"):
+        np.testing.assert_allclose(got[name], want[name], rtol=1e-9, atol=1e-12)
+    for name in NN:
+        np.testing.assert_allclose(got[name], want[name], rtol=1e-5, atol=1e-6)
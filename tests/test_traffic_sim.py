@@ -0,0 +1,104 @@
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+graph_build = pytest.importorskip("graph_build")
+traffic_sim = pytest.importorskip("traffic_sim")
+
+
+def _sim(n_replica, seed=0, ntg=6):
+    g = graph_build.build_graph(graph_build.random_nodes(60, seed=1), k=3)
+    sim = traffic_sim.WhirlpoolSim(g["senders"], g["receivers"], g["node_coords"],
+                                   n_replica=n_replica, ntg=ntg, seed=seed)
+    sim.init_cars(200)
+    return sim
+
+
+def test_split_multinomial():
+    rng = np.random.default_rng(0)
+    probs = np.array([[0.2, 0.5, 0.3, 0.], [1., 0., 0., 0.], [0., 0.7, 0., 0.3]])
+    n = rng.integers(0, 50, size=(4000, 3))
+    counts = traffic_sim.split_multinomial(rng, n, traffic_sim.conditional_probs(probs))
+    np.testing.assert_array_equal(counts.sum(axis=-1), n)
+    assert np.all(counts[..., probs == 0] == 0)
+    share = counts.sum(axis=0)/n.sum(axis=0)[:, None]
+    np.testing.assert_allclose(share, probs, atol=0.01)
+
+
+def test_step_conserves_cars():
+    sim = _sim(3)
+    for _ in range(20):
+        sim.step()
+        np.testing.assert_array_equal(sim.edges.sum(axis=1), 200)
+        np.testing.assert_array_equal(sim.nodes.sum(axis=1), 200)
+
+
+def _covs(edges, nodes, receivers):
+    # np.cov per edge over the pairs (t, t+1) where it carries cars
+    T = edges.shape[0]
+    covs = np.zeros((edges.shape[1], 3))
+    for i in range(edges.shape[1]):
+        ts = np.flatnonzero(edges[:, i, 0] > 0)
+        if ts.size < 2:
+            continue
+        x = edges[ts, i, :3]
+        y = nodes[(ts + 1) % T, receivers[i]]
+        covs[i] = [np.cov(x[:, j], y[:, j])[0, 1] for j in range(3)]
+    return covs
+
+
+def test_ntg_defaults_to_the_pipeline(monkeypatch):
+    assert _sim(1, ntg=None).ntg == mgt.NTG
+    monkeypatch.setattr(mgt, "NTG", 6)
+    assert _sim(1, ntg=None).ntg == 6
+
+
+@pytest.mark.parametrize("layout", ["timemajor", "sparse", "snapshot"])
+def test_simulated_files_feed_the_pipeline(tmp_path, monkeypatch, layout):
+    monkeypatch.setattr(mgt, "NTG", 6)
+    nsteps = 70
+    if layout == "snapshot":
+        # Snapshot files always hold one week of NTG time groups
+        with pytest.raises(ValueError):
+            traffic_sim.simulate_to_h5(str(tmp_path/"bad{}.hdf5"), _sim(2), nsteps,
+                                       layout=layout)
+        with pytest.raises(ValueError):
+            traffic_sim.simulate_to_h5(str(tmp_path/"bad{}.hdf5"), _sim(2, ntg=4), 7*6,
+                                       layout=layout)
+        nsteps = 7*6
+    names = traffic_sim.simulate_to_h5(str(tmp_path/"sim{}.hdf5"), _sim(2), nsteps,
+                                       layout=layout, block=32)
+    # The same run, stepped by hand
+    ref = _sim(2)
+    hist_n, hist_e = [], []
+    for _ in range(nsteps):
+        hist_n.append(ref.nodes.copy())
+        hist_e.append(ref.edges.copy())
+        ref.step()
+    hist_n, hist_e = np.array(hist_n), np.array(hist_e)
+
+    for r, name in enumerate(names):
+        mgt.EdgeNodeCovariance(name)
+        with h5py.File(name, 'r') as h5f:
+            assert mgt.n_snaps(h5f, 'edge_features') == nsteps
+            edges = mgt.read_snaps(h5f, 'edge_features', 0, nsteps)
+            nodes = mgt.read_snaps(h5f, 'node_features', 0, nsteps)
+            glbls = mgt.read_snaps(h5f, 'glbl_features', 0, nsteps)
+            receivers = h5f['receivers'][:]
+            covs = h5f['edge_node_covs'][:]
+        np.testing.assert_array_equal(edges[..., 0], hist_e[:, r])
+        np.testing.assert_array_equal(nodes[..., 0], hist_n[:, r])
+        assert np.all(edges[..., 3] > 0)
+        np.testing.assert_array_equal(glbls[:, 0, 1], np.arange(nsteps) % 6)
+        np.testing.assert_array_equal(glbls[:, 0, 0], (np.arange(nsteps)//6) % 7)
+        assert np.any(covs[:, 0] != 0)
+        np.testing.assert_allclose(covs, _covs(edges.astype(np.float64), nodes, receivers),
+                                   rtol=1e-6, atol=1e-9)
+
+
+def test_one_file_per_replica(tmp_path):
+    with pytest.raises(ValueError):
+        traffic_sim.simulate_to_h5(str(tmp_path/"sim.hdf5"), _sim(2), 5)
+    names = traffic_sim.simulate_to_h5(str(tmp_path/"sim.hdf5"), _sim(1), 5)
+    assert names == [str(tmp_path/"sim.hdf5")]
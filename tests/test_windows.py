@@ -0,0 +1,74 @@
+import h5py
+import numpy as np
+import pytest
+
+mgt = pytest.importorskip("my_graph_tools")
+bench_pipeline = pytest.importorskip("bench_pipeline")
+
+T = 7*4
+NAMES = ["edge_features", "node_features"]
+RANGES = [(0, T), (5, T + 5), (3, 20), (T - 5, T), (T - 2, T), (0, 1)]
+
+
+@pytest.fixture(scope="module")
+def h5_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("windows")/"week.hdf5")
+    bench_pipeline.make_synthetic_h5(path, 10, ntg=4, car_frac=0.5)
+    return path
+
+
+def _counting_reads(monkeypatch):
+    real = mgt.read_snaps
+    reads = dict((name, 0) for name in NAMES)
+
+    def wrapped(h5f, name, t0, t1, out=None):
+        reads[name] += t1 - t0
+        return real(h5f, name, t0, t1, out=out)
+    monkeypatch.setattr(mgt, "read_snaps", wrapped)
+    return real, reads
+
+
+def _expected_reads(t0, t1, k):
+    # A full pass reuses the week's first k-1 snapshots for the windows
+    # that wrap onto them; a partial one reads each of its snapshots once
+    return T if t1 - t0 == T else t1 - t0 + k - 1
+
+
+@pytest.mark.parametrize("k", range(1, 8))
+@pytest.mark.parametrize("block", [1, 3, 5, 64])
+@pytest.mark.parametrize("t0,t1", RANGES)
+def test_windows_match_naive_reads(h5_path, monkeypatch, k, block, t0, t1):
+    with h5py.File(h5_path, 'r') as h5f:
+        naive = dict((name, [mgt.read_snaps(h5f, name, t, t + k) for t in range(t0, t1)])
+                     for name in NAMES)
+        real, reads = _counting_reads(monkeypatch)
+        windows = mgt.SnapshotWindows(h5f, NAMES, k=k, t0=t0, t1=t1, block=block)
+        assert len(windows) == t1 - t0
+        ts = []
+        for t, win in windows:
+            ts.append(t)
+            for name in NAMES:
+                np.testing.assert_array_equal(win[name], naive[name][t - t0])
+        assert ts == list(range(t0, t1))
+        assert reads == dict((name, _expected_reads(t0, t1, k)) for name in NAMES)
+
+        for name in NAMES:
+            reads[name] = 0
+        ts = []
+        for w0, views in windows.blocks():
+            n = len(views[NAMES[0]])
+            assert n == min(block, t1 - w0)
+            for name in NAMES:
+                assert views[name].shape[:2] == (n, k)
+                np.testing.assert_array_equal(views[name],
+                                              np.stack(naive[name][w0 - t0:w0 - t0 + n]))
+            ts.extend(range(w0, w0 + n))
+        assert ts == list(range(t0, t1))
+        assert reads == dict((name, _expected_reads(t0, t1, k)) for name in NAMES)
+
+
+def test_window_length_must_be_positive(h5_path):
+    with h5py.File(h5_path, 'r') as h5f:
+        with pytest.raises(ValueError):
+            mgt.SnapshotWindows(h5f, NAMES, k=0)
+        assert list(mgt.SnapshotWindows(h5f, NAMES, t0=5, t1=5)) == []
@@ -0,0 +1,198 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Named spans and counters for the preprocessing and training code.
+#
+# Disabled by default, in which case span() returns a shared no-op object
+# and count() returns straight away. Enable around the code of interest:
+#
+#   tracing.enable()
+#   mgt.create_nn_inputset(h5name)
+#   tracing.write_chrome_trace("nn.trace.json")   # chrome://tracing, Perfetto
+#   tracing.write_summary("nn.summary.json")
+#
+# or set MGT_TRACE=<file> to trace a whole run; a Chrome trace is written
+# there at exit and a summary next to it.
+#
+# Spans nest by time; span.count(name, n) attaches a counter to the span so
+# the summary can report rates (e.g. snapshots/s within create_nn_inputset).
+
+import atexit
+import collections
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from progressbar import progressbar
+
+_enabled = False
+_events = []
+_counters = collections.defaultdict(float)
+_t_origin = time.time()
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def count(self, name, value=1):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *args):
+        t1 = time.time()
+        _events.append({"name": self.name, "ph": "X",
+                        "ts": 1e6*(self.t0 - _t_origin), "dur": 1e6*(t1 - self.t0),
+                        "pid": os.getpid(), "tid": threading.current_thread().ident,
+                        "args": self.args})
+        return False
+
+    def count(self, name, value=1):
+        self.args[name] = self.args.get(name, 0) + value
+        count(name, value)
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    del _events[:]
+    _counters.clear()
+
+
+def span(name, **args):
+    """Context manager timing the enclosed block under name."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def count(name, value=1):
+    """Add value to a global counter, also recorded as a Chrome counter event."""
+    if not _enabled:
+        return
+    _counters[name] += value
+    _events.append({"name": name, "ph": "C", "ts": 1e6*(time.time() - _t_origin),
+                    "pid": os.getpid(), "args": {name: _counters[name]}})
+
+
+def progress(iterable, name):
+    """progressbar(iterable), with a span per item when tracing."""
+    if not _enabled:
+        return progressbar(iterable)
+    return _traced_iter(progressbar(iterable), name)
+
+
+def _traced_iter(iterable, name):
+    for item in iterable:
+        with span(name):
+            yield item
+
+
+def drain():
+    """Remove and return this process's events and counters, e.g. to send
+    them from a pool worker back to the parent, which passes them to merge()."""
+    state = {"events": list(_events), "counters": dict(_counters)}
+    reset()
+    return state
+
+
+def merge(state):
+    if state is None:
+        return
+    _events.extend(state["events"])
+    for key, val in state["counters"].items():
+        _counters[key] += val
+
+
+def summary():
+    """Per span name: calls, total/mean/max seconds and each attached
+    counter with its rate over the span's total time. Plus global counters."""
+    spans = collections.OrderedDict()
+    for ev in _events:
+        if ev["ph"] != "X":
+            continue
+        s = spans.setdefault(ev["name"], {"calls": 0, "total_s": 0., "max_s": 0.,
+                                          "counters": collections.defaultdict(float)})
+        dur = 1e-6*ev["dur"]
+        s["calls"] += 1
+        s["total_s"] += dur
+        s["max_s"] = max(s["max_s"], dur)
+        for key, val in ev["args"].items():
+            if isinstance(val, (int, float)):
+                s["counters"][key] += val
+    for s in spans.values():
+        s["mean_s"] = s["total_s"]/s["calls"]
+        counters = s.pop("counters")
+        for key, val in counters.items():
+            s[key] = val
+            if s["total_s"] > 0:
+                s[key+"_per_s"] = val/s["total_s"]
+    return {"spans": spans, "counters": dict(_counters)}
+
+
+def write_summary(path):
+    with open(path, 'w') as f:
+        json.dump(summary(), f, indent=1)
+
+
+def write_chrome_trace(path):
+    with open(path, 'w') as f:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms"}, f)
+
+
+def _write_at_exit(path):
+    # Forked children inherit the hook
+    if os.getpid() != _trace_pid:
+        return
+    write_chrome_trace(path)
+    write_summary(os.path.splitext(path)[0]+".summary.json")
+
+
+def _is_main_process():
+    # Spawned workers import this module afresh; multiprocessing.parent_process
+    # is new in Python 3.8
+    parent_process = getattr(multiprocessing, "parent_process", None)
+    if parent_process is not None:
+        return parent_process() is None
+    return multiprocessing.current_process().name == "MainProcess"
+
+
+_trace_pid = os.getpid()
+if os.environ.get("MGT_TRACE"):
+    enable()
+    # Only the process that was started with MGT_TRACE writes the trace,
+    # not every worker that inherits the environment
+    if _is_main_process():
+        atexit.register(_write_at_exit, os.environ["MGT_TRACE"])
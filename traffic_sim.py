@@ -0,0 +1,281 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Vectorized version of the whirlpool traffic simulator from toy_traffic.ipynb.
+#
+# The notebook moves cars one at a time: each car at node s draws a
+# truncated normal deviation r from the whirlpool direction and takes the
+# out-edge whose angle is closest to wdir - r. That choice only depends on
+# the node, so here the probability of each out-edge is computed once per
+# node, and every step all cars at a node are split over its out-edges with
+# one multinomial draw. Many independent replicas are stepped together.
+#
+#   sim = WhirlpoolSim(senders, receivers, node_pos, n_replica=64, seed=0)
+#   sim.init_cars(500)
+#   sim.run(50)                      # equilibrate
+#   simulate_to_h5("toys/sim{}.hdf5", sim, 5000)
+#
+# simulate_to_h5 writes one file per replica with the raw feature groups
+# (see create_snapset), so EdgeNodeCovariance, CalcMFactor and
+# create_nn_inputset run on it directly.
+
+from graph_nets import graphs
+import h5py
+import numpy as np
+from progressbar import progressbar
+
+import my_graph_tools as mgt
+
+pi = np.pi
+twopi = np.pi*2
+
+
+def csr_neighbors(senders, receivers, n_node):
+    """Out-edges of every node, as a padded (n_node, max_degree) table of edge
+    ids (-1 for padding) plus the CSR indptr."""
+    order = np.argsort(senders, kind='stable')
+    deg = np.bincount(senders, minlength=n_node)
+    indptr = np.concatenate([[0], np.cumsum(deg)])
+    slot = np.arange(len(senders)) - indptr[senders[order]]
+    table = np.full((n_node, max(deg.max(), 1)), -1, dtype=np.int64)
+    table[senders[order], slot] = order
+    return table, indptr
+
+
+def edge_angles(senders, receivers, node_pos):
+    d = node_pos[receivers] - node_pos[senders]
+    return np.arctan2(d[:, 1], d[:, 0])
+
+
+def whirl_dirs(node_pos, center=(0.5, 0.5)):
+    # Clockwise procession about center
+    d = node_pos - np.asarray(center)
+    wdir = np.arctan2(d[:, 1], d[:, 0]) - pi/2.
+    return np.where(wdir < -pi, wdir + twopi, wdir)
+
+
+def choice_probs(nbr_angles, valid, wdir, sigma=pi, ngrid=2048, chunk=512):
+    """Probability that a car at each node takes each of its out-edges.
+
+    Integrates the notebook's choose_nbr rule over a grid of the truncated
+    normal deviation r in [-pi, pi].
+    """
+    r = (np.arange(ngrid) + 0.5)*(twopi/ngrid) - pi
+    w = np.exp(-0.5*(r/sigma)**2)
+    w /= w.sum()
+    n_node, max_deg = nbr_angles.shape
+    probs = np.zeros((n_node, max_deg), dtype=np.float64)
+    for i0 in range(0, n_node, chunk):
+        i1 = min(i0 + chunk, n_node)
+        desire = wdir[i0:i1, None] - r[None, :]
+        desire = np.where(desire < -pi, desire + twopi, desire)
+        desire = np.where(desire > pi, desire - twopi, desire)
+        dth = np.abs(nbr_angles[i0:i1, None, :] - desire[:, :, None])
+        dth = np.where(dth < pi, dth, twopi - dth)
+        dth = np.where(valid[i0:i1, None, :], dth, np.inf)
+        best = np.argmin(dth, axis=2)
+        for j in range(max_deg):
+            probs[i0:i1, j] = ((best == j)*w).sum(axis=1)
+    return probs
+
+
+def conditional_probs(probs):
+    """probs[..., j] divided by the probability left for slots j and on, so
+    the last slot with any probability gets exactly 1."""
+    tail = np.cumsum(probs[..., ::-1], axis=-1)[..., ::-1]
+    return np.divide(probs, tail, out=np.zeros_like(probs), where=tail > 0)
+
+
+def split_multinomial(rng, n, cond_probs):
+    """Multinomial draws of n[...] trials each, from conditional_probs.
+
+    Generator.multinomial only takes an array of trial counts from numpy
+    1.22 on; drawing each slot's binomial share of the trials left gives the
+    same distribution with one vectorized draw per slot.
+    """
+    n = np.asarray(n)
+    counts = np.zeros(n.shape + cond_probs.shape[-1:], dtype=np.int64)
+    left = n.astype(np.int64)
+    for j in range(cond_probs.shape[-1]):
+        counts[..., j] = rng.binomial(left, cond_probs[..., j])
+        left -= counts[..., j]
+    return counts
+
+
+class WhirlpoolSim(object):
+    """n_replica independent copies of the whirlpool dynamics on one graph.
+
+    State is car counts per node and per edge, shape (n_replica, n_node)
+    and (n_replica, n_edge), plus the shared (day, tg) global.
+    """
+
+    def __init__(self, senders, receivers, node_pos, n_replica=1, sigma=pi,
+                 center=(0.5, 0.5), ntg=None, seed=None, nbr_angles=None,
+                 wdir=None):
+        self.senders = np.asarray(senders)
+        self.receivers = np.asarray(receivers)
+        self.node_pos = np.asarray(node_pos, dtype=np.float64)
+        self.n_node = self.node_pos.shape[0]
+        self.n_edge = self.senders.shape[0]
+        self.n_replica = n_replica
+        # Time groups per day; the pipeline reads (day, tg) against mgt.NTG
+        self.ntg = mgt.NTG if ntg is None else ntg
+        self.rng = np.random.default_rng(seed)
+
+        self.nbr_edges, self.indptr = csr_neighbors(self.senders, self.receivers,
+                                                    self.n_node)
+        if np.any(np.diff(self.indptr) == 0):
+            raise ValueError("Every node needs at least one out-edge")
+        self.valid = self.nbr_edges >= 0
+        if nbr_angles is None:
+            nbr_angles = edge_angles(self.senders, self.receivers, self.node_pos)
+        if wdir is None:
+            wdir = whirl_dirs(self.node_pos, center)
+        self.wdir = wdir
+        angles = np.where(self.valid, nbr_angles[self.nbr_edges], 0.)
+        self.probs = choice_probs(angles, self.valid, wdir, sigma)
+        self._cond_probs = conditional_probs(self.probs)
+        self._flat_valid = self.valid.ravel()
+        self._flat_edges = self.nbr_edges.ravel()[self._flat_valid]
+
+        self.nodes = np.zeros((n_replica, self.n_node), dtype=np.int64)
+        self.edges = np.zeros((n_replica, self.n_edge), dtype=np.int64)
+        self.t = 0
+        # Fixed for the life of the sim, reused every step
+        self._seg = (self.receivers[None, :]
+                     + self.n_node*np.arange(n_replica)[:, None]).ravel()
+        off = self.n_node*np.arange(n_replica)[:, None]
+        self._batch_senders = mgt._readonly((self.senders[None, :] + off).ravel())
+        self._batch_receivers = mgt._readonly((self.receivers[None, :] + off).ravel())
+
+    @property
+    def globals(self):
+        return np.array([(self.t//self.ntg) % 7, self.t % self.ntg])
+
+    def init_cars(self, ncar, select=None):
+        """Drop ncar cars per replica on random nodes of select, each on a
+        uniformly chosen out-edge. Defaults to the notebook's x>0.5, y<0.5
+        quadrant."""
+        if select is None:
+            select = np.flatnonzero((self.node_pos[:, 0] > 0.5)
+                                    & (self.node_pos[:, 1] < 0.5))
+        select = np.asarray(select)
+        R = self.n_replica
+        start = select[self.rng.integers(len(select), size=(R, ncar))]
+        deg = np.diff(self.indptr)[start]
+        slot = (self.rng.random((R, ncar))*deg).astype(np.int64)
+        eid = self.nbr_edges[start, slot]
+        rep = np.arange(R)[:, None]
+        self.nodes[:] = np.bincount((rep*self.n_node + start).ravel(),
+                                    minlength=R*self.n_node).reshape(R, self.n_node)
+        self.edges[:] = np.bincount((rep*self.n_edge + eid).ravel(),
+                                    minlength=R*self.n_edge).reshape(R, self.n_edge)
+        self.t = 0
+
+    def step(self):
+        # Cars on edges arrive at the receivers, then leave along new edges.
+        # State arrays are updated in place.
+        np.copyto(self.nodes, mgt._incoming_cars(self.edges, self.receivers,
+                                                 self.n_node, self._seg),
+                  casting='unsafe')
+        counts = split_multinomial(self.rng, self.nodes, self._cond_probs)
+        counts = counts.reshape(self.n_replica, -1)[:, self._flat_valid]
+        self.edges[:, self._flat_edges] = counts
+        self.t += 1
+
+    def run(self, nsteps):
+        for _ in range(nsteps):
+            self.step()
+
+    def graphs_tuple(self, out=None):
+        """Current state as a GraphsTuple with one graph per replica.
+
+        With out (an earlier return value) the features are written into its
+        arrays, so a stepping loop allocates no new tuples. The topology
+        arrays are shared read-only between all returned tuples.
+        """
+        R = self.n_replica
+        if out is None:
+            out = graphs.GraphsTuple(
+                nodes=np.zeros((R*self.n_node, 1), dtype=mgt.FLOAT_DTYPE),
+                edges=np.zeros((R*self.n_edge, 1), dtype=mgt.FLOAT_DTYPE),
+                globals=np.zeros((R, 2), dtype=mgt.FLOAT_DTYPE),
+                senders=self._batch_senders,
+                receivers=self._batch_receivers,
+                n_node=np.full(R, self.n_node, dtype=np.int32),
+                n_edge=np.full(R, self.n_edge, dtype=np.int32))
+        np.copyto(out.nodes[:, 0], self.nodes.ravel())
+        np.copyto(out.edges[:, 0], self.edges.ravel())
+        out.globals[:] = self.globals
+        return out
+
+
+def simulate_to_h5(h5name, sim, nsteps, layout="timemajor", codec="gzip",
+                   codec_opts=None, block=mgt.BLOCK_T):
+    """Step sim nsteps times, writing each replica to its own file in the
+    layout the preprocessing reads: nsteps snapshots of edge_features
+    (cars, 0, 0, edge length), node_features (cars, 0, 0) and glbl_features
+    (day, tg), plus senders, receivers and node_coords.
+
+    h5name is formatted with the replica index, e.g. "toys/sim{}.hdf5"; with
+    one replica it may be a plain file name. Returns the file names.
+    The snapshot layout always holds one full week, so it needs
+    nsteps == 7*mgt.NTG and sim.ntg == mgt.NTG.
+    """
+    R = sim.n_replica
+    if layout == "snapshot" and (nsteps != 7*mgt.NTG or sim.ntg != mgt.NTG):
+        raise ValueError("The snapshot layout needs one week of "
+                         + str(7*mgt.NTG) + " steps with ntg = " + str(mgt.NTG)
+                         + ", got " + str(nsteps) + " steps with ntg = " + str(sim.ntg))
+    if "{}" in h5name:
+        names = [h5name.format(r) for r in range(R)]
+    elif R == 1:
+        names = [h5name]
+    else:
+        raise ValueError("h5name needs a {} for the replica index with "
+                         + str(R) + " replicas")
+    lengths = np.linalg.norm(sim.node_pos[sim.receivers] - sim.node_pos[sim.senders], axis=1)
+    # Sparse edge groups' base rows: no cars, the edge lengths
+    edge_base = np.zeros((sim.n_edge, 4))
+    edge_base[:, 3] = lengths
+    h5s = [h5py.File(name, 'w') for name in names]
+    try:
+        for h5 in h5s:
+            h5.create_dataset("senders", data=sim.senders)
+            h5.create_dataset("receivers", data=sim.receivers)
+            h5.create_dataset("node_coords", data=sim.node_pos)
+            h5.attrs['n_nodes'] = sim.n_node
+            h5.attrs['n_edges'] = sim.n_edge
+            h5.attrs['ntg'] = sim.ntg
+            for name, n_ent, n_ft, base in (("edge_features", sim.n_edge, 4, edge_base),
+                                            ("node_features", sim.n_node, 3, None),
+                                            ("glbl_features", 1, 2, None)):
+                grp_layout = layout
+                if layout == "sparse" and name not in mgt.SPARSE_GROUPS:
+                    grp_layout = "timemajor"
+                mgt.create_snapset(h5, name, nsteps, n_ent, n_ft, layout=grp_layout,
+                                   codec=codec, codec_opts=codec_opts, base=base)
+
+        nbuf = np.zeros((block, R, sim.n_node), dtype=np.int64)
+        ebuf = np.zeros((block, R, sim.n_edge), dtype=np.int64)
+        gbuf = np.zeros((block, 1, 2), dtype=mgt.FLOAT_DTYPE)
+        # Feature blocks of one replica, refilled for each
+        nodes = np.zeros((block, sim.n_node, 3), dtype=mgt.FLOAT_DTYPE)
+        edges = np.zeros((block, sim.n_edge, 4), dtype=mgt.FLOAT_DTYPE)
+        edges[..., 3] = lengths
+        for s0 in progressbar(range(0, nsteps, block)):
+            n = min(block, nsteps - s0)
+            for i in range(n):
+                nbuf[i], ebuf[i], gbuf[i, 0] = sim.nodes, sim.edges, sim.globals
+                sim.step()
+            for r, h5 in enumerate(h5s):
+                nodes[:n, :, 0] = nbuf[:n, r]
+                edges[:n, :, 0] = ebuf[:n, r]
+                mgt.write_snaps(h5, "node_features", s0, nodes[:n])
+                mgt.write_snaps(h5, "edge_features", s0, edges[:n])
+                mgt.write_snaps(h5, "glbl_features", s0, gbuf[:n])
+    finally:
+        for h5 in h5s:
+            h5.close()
+    return names
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Mini-batch training of EncodeProcessDecode on (t, t+1) snapshot pairs.
+#
+# All snapshots share senders/receivers, so a batch of B snapshots is always
+# the same stacked graph. Its offset senders/receivers are built once and
+# baked into the TF graph as constants; each step only feeds the feature
+# arrays.
+#
+#   trainer = StaticBatchTrainer(h5name, batch_size=64)
+#   with tf.Session() as sess:
+#       sess.run(tf.global_variables_initializer())
+#       trainer.train(sess, 10000)
+#       trainer.saver.save(sess, "ckpts/model.ckpt")
+
+import time
+
+from graph_nets import graphs
+import numpy as np
+import tensorflow as tf
+
+import featstore
+import input_pipeline
+import my_graph_tools as mgt
+import tracing
+
+
+def throughput_summary(step_times, batch_size, n_elem):
+    """graphs/sec, examples/sec and step-time percentiles for a window of steps.
+
+    A graph is one (t, t+1) snapshot pair; examples are its node and edge
+    rows (n_elem per graph).
+    """
+    step_times = np.asarray(step_times)
+    total = step_times.sum()
+    ngraph = batch_size*len(step_times)
+    return {"graphs_per_s": ngraph/total,
+            "examples_per_s": ngraph*n_elem/total,
+            "step_ms_p50": 1e3*np.percentile(step_times, 50),
+            "step_ms_p90": 1e3*np.percentile(step_times, 90),
+            "step_ms_p99": 1e3*np.percentile(step_times, 99)}
+
+
+def static_batch_graph(topo, batch_size, n_node_ft, n_edge_ft, n_glbl_ft,
+                       dtype=None, name="static_batch"):
+    """GraphsTuple of batch_size stacked snapshots with placeholder features
+    and the (fixed) batched topology as constants. dtype defaults to
+    mgt.FLOAT_DTYPE."""
+    dtype = tf.as_dtype(mgt.FLOAT_DTYPE if dtype is None else dtype)
+    senders, receivers = mgt.batch_topology(topo, batch_size)
+    n_node = topo["n_node"]
+    n_edge = len(topo["senders"])
+    with tf.name_scope(name):
+        return graphs.GraphsTuple(
+            nodes=tf.placeholder(dtype, [batch_size*n_node, n_node_ft], name="nodes"),
+            edges=tf.placeholder(dtype, [batch_size*n_edge, n_edge_ft], name="edges"),
+            globals=tf.placeholder(dtype, [batch_size, n_glbl_ft], name="globals"),
+            senders=tf.constant(senders.astype(np.int32), name="senders"),
+            receivers=tf.constant(receivers.astype(np.int32), name="receivers"),
+            n_node=tf.constant(np.full(batch_size, n_node, dtype=np.int32), name="n_node"),
+            n_edge=tf.constant(np.full(batch_size, n_edge, dtype=np.int32), name="n_edge"))
+
+
+def feed_features(graph_ph, graph_np):
+    return {graph_ph.nodes: graph_np.nodes,
+            graph_ph.edges: graph_np.edges,
+            graph_ph.globals: graph_np.globals}
+
+
+class StaticBatchTrainer(object):
+    """Builds the batched model and loss, and runs the training loop."""
+
+    def __init__(self, h5_name, batch_size=64, num_processing_steps=3,
+                 learning_rate=1e-3, output_every=1, use_while_loop=False,
+                 num_workers=2, use_processes=False, seed=None, times=None):
+        self.h5_name = h5_name
+        self.batch_size = batch_size
+        with featstore.open_store(h5_name) as h5f:
+            topo = mgt.get_topology(h5f)
+            sample = mgt.snaps2graph(h5f, [0])
+        n_node_ft = sample.nodes.shape[1]
+        n_edge_ft = sample.edges.shape[1]
+        n_glbl_ft = sample.globals.shape[1]
+        self.n_elem = sample.nodes.shape[0] + sample.edges.shape[0]
+
+        self.input_ph = static_batch_graph(topo, batch_size, n_node_ft, n_edge_ft,
+                                           n_glbl_ft, name="input_batch")
+        self.target_ph = static_batch_graph(topo, batch_size, n_node_ft, n_edge_ft,
+                                            n_glbl_ft, name="target_batch")
+        self.model = mgt.EncodeProcessDecode(edge_output_size=n_edge_ft,
+                                             node_output_size=n_node_ft)
+        self.output_ops = self.model(self.input_ph, num_processing_steps,
+                                     output_every=output_every,
+                                     use_while_loop=use_while_loop)
+        self.loss = tf.add_n([
+            tf.losses.mean_squared_error(self.target_ph.nodes, out.nodes)
+            + tf.losses.mean_squared_error(self.target_ph.edges, out.edges)
+            for out in self.output_ops]) / len(self.output_ops)
+        self.optimizer = tf.train.AdamOptimizer(learning_rate)
+        self.grads_and_vars = self.optimizer.compute_gradients(self.loss)
+        self.step_op = self.optimizer.apply_gradients(self.grads_and_vars)
+        self.saver = tf.train.Saver()
+
+        # times restricts training to those snapshot pairs (e.g. one shard)
+        self._pipeline_kw = {"num_workers": num_workers, "times": times,
+                             "use_processes": use_processes, "seed": seed}
+
+    def batches(self):
+        # Cycles forever; partial batches at epoch ends are dropped so the
+        # batch topology never changes
+        pf = input_pipeline.PairPrefetcher(self.h5_name, batch_size=self.batch_size,
+                                           epochs=None, **self._pipeline_kw)
+        try:
+            for inp, tgt in pf:
+                if len(inp.n_node) == self.batch_size:
+                    yield inp, tgt
+        finally:
+            pf.close()
+
+    def train(self, sess, nsteps, log_every=100, log_fn=print):
+        """Runs nsteps optimizer steps. Returns the per-window logs."""
+        logs, losses, step_times = [], [], []
+        batches = self.batches()
+        for step in range(1, nsteps+1):
+            with tracing.span("train.wait_batch"):
+                inp, tgt = next(batches)
+            feed = feed_features(self.input_ph, inp)
+            feed.update(feed_features(self.target_ph, tgt))
+            t0 = time.time()
+            with tracing.span("train.session_run") as sp:
+                sp.count("graphs", self.batch_size)
+                loss, _ = sess.run([self.loss, self.step_op], feed_dict=feed)
+            step_times.append(time.time() - t0)
+            losses.append(loss)
+            if step % log_every == 0 or step == nsteps:
+                log = throughput_summary(step_times, self.batch_size, self.n_elem)
+                log.update({"step": step, "loss": float(np.mean(losses))})
+                logs.append(log)
+                if log_fn:
+                    log_fn(log)
+                losses, step_times = [], []
+        batches.close()
+        return logs